@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 ITRS Group Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure perfdata parsing throughput in entries per second.
+
+Compares parse_perfdata() with the previous parser, which split the perfdata on
+whitespace and then matched a regex and split on ';' for every entry.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from check_with_thresholds_as_perfdata_lib import parse_perfdata  # noqa: E402
+
+
+def legacy_parse_perfdata_entry(entry):
+    """Parse a single entry the way the previous parser did."""
+    label_value_match = re.match(r"(?P<label>\S+)=(?P<value>\d+(\.\d+)?)(?P<uom>[a-zA-Z%]*)", entry)
+    if not label_value_match:
+        return None, None, None, None, None, None, None
+    remaining = entry[label_value_match.end() :].lstrip(";")
+    thresholds = remaining.split(";")
+    fields = [threshold or None for threshold in thresholds[:4]]
+    fields += [None] * (4 - len(fields))
+    return (
+        label_value_match.group("label"),
+        label_value_match.group("value"),
+        label_value_match.group("uom"),
+        *fields,
+    )
+
+
+def legacy_parse_perfdata(perfdata):
+    """Parse the performance data the way the previous parser did."""
+    perfdata_entries = []
+    for entry in perfdata.split():
+        label, value, uom, warn, crit, min_val, max_val = legacy_parse_perfdata_entry(entry)
+        if label is not None:
+            perfdata_entries.append(
+                {
+                    "label": label,
+                    "value": value,
+                    "uom": uom,
+                    "warn": warn,
+                    "crit": crit,
+                    "min": min_val,
+                    "max": max_val,
+                }
+            )
+    return perfdata_entries
+
+
+def make_perfdata(entries):
+    """Return perfdata with the given number of entries, as a filesystem check would."""
+    return " ".join(f"'/fs{i}'={i % 100}%;80;90;0;100" for i in range(entries))
+
+
+def throughput(parser, perfdata, entries, min_time):
+    """Return the number of entries the parser handles per second."""
+    timer = timeit.Timer(lambda: parser(perfdata))
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=5, number=number))
+    if best < min_time:
+        number = max(number, int(number * min_time / max(best, 1e-9)))
+        best = min(timer.repeat(repeat=3, number=number))
+    return entries * number / best
+
+
+def main():
+    """Run the parser benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--entries",
+        type=int,
+        nargs="+",
+        default=[10, 1000, 100000],
+        help="Numbers of perfdata entries to parse",
+    )
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum seconds per timing")
+    args = parser.parse_args()
+
+    results = []
+    for entries in args.entries:
+        perfdata = make_perfdata(entries)
+        scanner = throughput(parse_perfdata, perfdata, entries, args.min_time)
+        legacy = throughput(legacy_parse_perfdata, perfdata, entries, args.min_time)
+        results.append(
+            {
+                "entries": entries,
+                "parse_perfdata_entries_per_second": round(scanner),
+                "legacy_entries_per_second": round(legacy),
+                "speedup": round(scanner / legacy, 2),
+            }
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
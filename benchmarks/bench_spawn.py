@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 ITRS Group Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the latency of running a plugin through the shell and directly.
+
+Both paths go through run_command(), the way the wrapper runs a check, with and
+without --no-shell.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from check_with_thresholds_as_perfdata_lib import run_command  # noqa: E402
+
+
+def spawn_latency(command, shell, runs):
+    """Return the wall time of each run of the command, in seconds."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run_command(command, shell=shell)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    """Run the spawn benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--command",
+        default="/bin/echo 'OK | metric=1;2;3;4'",
+        help="Command to run (default a trivial echo, so spawning dominates)",
+    )
+    parser.add_argument("-n", "--runs", type=int, default=500, help="Runs per path")
+    args = parser.parse_args()
+
+    results = {"command": args.command, "runs": args.runs}
+    for name, shell in (("shell", True), ("direct", False)):
+        times = spawn_latency(args.command, shell, args.runs)
+        results[name] = {
+            "median_us": round(statistics.median(times) * 1e6, 1),
+            "mean_us": round(statistics.mean(times) * 1e6, 1),
+            "min_us": round(min(times) * 1e6, 1),
+        }
+    results["speedup"] = round(results["shell"]["median_us"] / results["direct"]["median_us"], 2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 ITRS Group Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measure the throughput of --spool mode in check result files per second.
+
+Fills a temporary spool directory with Nagios check result files of synthetic
+perfdata and times one --spool --once run of the wrapper over them.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+from perfdata_generator import generate_plugin_output  # noqa: E402
+
+WRAPPER = os.path.join(BENCHMARKS_DIR, "..", "check_with_thresholds_as_perfdata.py")
+
+
+def write_check_results(spool, files, entries):
+    """Write the check result files into the spool directory, the way a collector would."""
+    for i in range(files):
+        output = generate_plugin_output(entries, seed=i % 100)
+        temporary = os.path.join(spool, f".c{i}")
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.write(
+                "### Nagios Service Check Result ###\n"
+                f"host_name=host{i}\nservice_description=Disk\nreturn_code=0\noutput={output}\n"
+            )
+        os.rename(temporary, os.path.join(spool, f"c{i}"))
+        with open(os.path.join(spool, f"c{i}.ok"), "w", encoding="utf-8"):
+            pass
+
+
+def main():
+    """Run the spool benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--files", type=int, default=20000, help="Check result files")
+    parser.add_argument("--entries", type=int, default=10, help="Perfdata entries per file")
+    parser.add_argument("--workers", type=int, help="Worker processes (default one per CPU)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        spool, output = os.path.join(tmpdir, "spool"), os.path.join(tmpdir, "output")
+        os.mkdir(spool)
+        write_check_results(spool, args.files, args.entries)
+        command = [sys.executable, WRAPPER, "--spool", spool, "--spool-output", output]
+        command += ["-w", "80", "-c", "90", "--once"]
+        if args.workers:
+            command += ["--workers", str(args.workers)]
+        start = time.perf_counter()
+        subprocess.run(command, check=True)
+        elapsed = time.perf_counter() - start
+
+    results = {
+        "files": args.files,
+        "entries": args.entries,
+        "workers": args.workers or os.cpu_count(),
+        "seconds": round(elapsed, 3),
+        "files_per_second": round(args.files / elapsed),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 ITRS Group Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the cold-start wall time and import time of the wrapper script.
+
+Each measurement starts a fresh interpreter. The wall time covers interpreter
+start-up, imports and argument parsing up to the point where the wrapper would
+run the plugin; the command given is outside /opt/opsview/monitoringscripts, so
+the wrapper stops there. The import time is measured through the import system,
+which uses cached bytecode, so it leaves out compiling a script run as __main__;
+only the wall time shows that cost, so the budgets apply to the wall time.
+
+Use --baseline to compare against another copy of the script, e.g. one from the
+previous release, and --budget to fail when either measurement is slower by more
+than that many percent. --max-wall-ms fails without a baseline:
+
+    git show v1.0:check_with_thresholds_as_perfdata.py > /tmp/baseline.py
+    benchmarks/bench_startup.py --baseline /tmp/baseline.py --budget 10
+    benchmarks/bench_startup.py --max-wall-ms 50
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "check_with_thresholds_as_perfdata.py"
+)
+CHECK_ARGS = ["-w", "80", "-c", "90", "-C", "/bin/true"]
+IMPORT_SNIPPET = (
+    "import importlib.util, sys, time\n"
+    "spec = importlib.util.spec_from_file_location('wrapper', sys.argv[1])\n"
+    "module = importlib.util.module_from_spec(spec)\n"
+    "start = time.perf_counter()\n"
+    "spec.loader.exec_module(module)\n"
+    "print(time.perf_counter() - start)\n"
+)
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--script", default=os.path.normpath(SCRIPT), help="Script to measure")
+    parser.add_argument("--baseline", help="Other copy of the script to compare against")
+    parser.add_argument("--python", default=sys.executable, help="Interpreter to run")
+    parser.add_argument("-n", "--runs", type=int, default=30, help="Runs per measurement")
+    parser.add_argument(
+        "--flags",
+        default="-I -S",
+        help="Interpreter flags for the optimised measurement (default '-I -S')",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        help="Fail if the script is more than this many percent slower than the baseline",
+    )
+    parser.add_argument(
+        "--max-wall-ms",
+        type=float,
+        help="Fail if the median wall time of the script is more than this many milliseconds",
+    )
+    return parser.parse_args()
+
+
+def wall_time(python, flags, script, runs):
+    """Return the wall times of running the script in a fresh interpreter."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [python, *flags, script, *CHECK_ARGS],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def import_time(python, flags, script, runs):
+    """Return the time taken to import the script in a fresh interpreter."""
+    times = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [python, *flags, "-c", IMPORT_SNIPPET, script],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        times.append(float(result.stdout))
+    return times
+
+
+def summarise(times):
+    """Return the summary statistics of a list of times, in milliseconds."""
+    return {
+        "min_ms": round(min(times) * 1000, 3),
+        "median_ms": round(statistics.median(times) * 1000, 3),
+        "max_ms": round(max(times) * 1000, 3),
+    }
+
+
+def measure(python, script, flags, runs):
+    """Measure the script with and without the optimised interpreter flags."""
+    results = {}
+    for name, run_flags in (("default", []), ("optimised", flags)):
+        results[name] = {
+            "wall": summarise(wall_time(python, run_flags, script, runs)),
+            "import": summarise(import_time(python, run_flags, script, runs)),
+        }
+    return results
+
+
+def main():
+    """Run the start-up benchmark and print the results as JSON."""
+    args = parse_arguments()
+    flags = args.flags.split()
+    report = {
+        "python": args.python,
+        "runs": args.runs,
+        "flags": flags,
+        "script": measure(args.python, args.script, flags, args.runs),
+    }
+    if args.baseline:
+        report["baseline"] = measure(args.python, args.baseline, flags, args.runs)
+    print(json.dumps(report, indent=2))
+
+    failures = []
+    for name in ("default", "optimised"):
+        script_ms = report["script"][name]["wall"]["median_ms"]
+        if args.baseline and args.budget is not None:
+            baseline_ms = report["baseline"][name]["wall"]["median_ms"]
+            regression = (script_ms - baseline_ms) / baseline_ms * 100
+            if regression > args.budget:
+                failures.append(
+                    f"Start-up regression of {regression:.1f}% ({name}) exceeds the budget "
+                    f"of {args.budget}%"
+                )
+        if args.max_wall_ms is not None and script_ms > args.max_wall_ms:
+            failures.append(
+                f"Start-up wall time of {script_ms} ms ({name}) exceeds the budget "
+                f"of {args.max_wall_ms} ms"
+            )
+    for failure in failures:
+        sys.stderr.write(failure + "\n")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
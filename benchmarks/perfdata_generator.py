@@ -0,0 +1,58 @@
+#
+# Copyright 2024 ITRS Group Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Generate synthetic plugin perfdata for the benchmarks."""
+import random
+
+UOMS = ["", "%", "s", "ms", "us", "B", "KB", "MB", "GB", "TB", "c"]
+LABEL_SHAPES = [
+    "metric_{i}",
+    "'/fs/{i}'",
+    "'C:\\ Drive {i}'",
+    "'eth{i} in'",
+    "'it''s {i}'",
+]
+THRESHOLD_SHAPES = [
+    "",
+    ";80;90",
+    ";80;90;0;100",
+    ";;90",
+    ";10:20;5:25",
+    ";@10:20;~:30",
+    ";10:;5:;0;",
+]
+VALUE_SHAPES = ["{n}", "{n}.5", "-{n}", "{n}e3", "-{n}.25E-2"]
+
+
+def generate_perfdata(entries, seed=0):
+    """Return perfdata with the given number of entries of varied shapes.
+
+    The same entries and seed always give the same perfdata, so results of
+    different runs can be compared.
+    """
+    rng = random.Random(seed)
+    return " ".join(
+        rng.choice(LABEL_SHAPES).format(i=i)
+        + "="
+        + rng.choice(VALUE_SHAPES).format(n=rng.randint(0, 1000))
+        + rng.choice(UOMS)
+        + rng.choice(THRESHOLD_SHAPES)
+        for i in range(entries)
+    )
+
+
+def generate_plugin_output(entries, seed=0):
+    """Return the complete output of a plugin reporting the given number of entries."""
+    return f"OK - {entries} metrics are fine | {generate_perfdata(entries, seed)}"
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 ITRS Group Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run the perfdata pipeline benchmarks and compare them with an earlier run.
+
+Times extract_perfdata, parse_perfdata, parse_perfdata_entries,
+parse_perfdata_entry and append_thresholds_to_perfdata on synthetic perfdata, and main() end to end
+against a fake plugin script. Save the results of one commit with --output and
+check another against them with --compare:
+
+    benchmarks/run_benchmarks.py --output before.json
+    benchmarks/run_benchmarks.py --compare before.json --max-regression 20
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import stat
+import sys
+import tempfile
+import timeit
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import check_with_thresholds_as_perfdata_lib as wrapper  # noqa: E402
+from perfdata_generator import generate_perfdata, generate_plugin_output  # noqa: E402
+
+DEFAULT_SIZES = [1, 100, 10000, 100000]
+WARNING, CRITICAL, STATIC = "80", "90", ["static_threshold=95"]
+
+
+def best_time(function, min_time):
+    """Return the best time of a single call of the function, in seconds."""
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+    if elapsed < min_time:
+        number = max(number, int(number * min_time / max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat=5, number=number)) / number
+
+
+def micro_benchmarks(sizes, min_time):
+    """Time each stage of the perfdata pipeline for every number of entries."""
+    results = {}
+    for size in sizes:
+        output = generate_plugin_output(size)
+        _, perfdata = wrapper.extract_perfdata(output)
+        entries = wrapper.parse_perfdata(perfdata)
+        first_entry = generate_perfdata(1, seed=size)
+        cases = {
+            "extract_perfdata": lambda: wrapper.extract_perfdata(output),
+            "parse_perfdata": lambda: wrapper.parse_perfdata(perfdata),
+            "parse_perfdata_entries": lambda: wrapper.parse_perfdata_entries(perfdata),
+            "parse_perfdata_entry": lambda: wrapper.parse_perfdata_entry(first_entry),
+            "append_thresholds_to_perfdata": lambda: wrapper.append_thresholds_to_perfdata(
+                perfdata, entries, WARNING, CRITICAL, STATIC
+            ),
+        }
+        for name, function in cases.items():
+            if name == "parse_perfdata_entry" and size != sizes[0]:
+                continue
+            seconds = best_time(function, min_time)
+            key = name if name == "parse_perfdata_entry" else f"{name}[{size}]"
+            results[key] = {"seconds": seconds, "entries": 1 if name.endswith("entry") else size}
+    return results
+
+
+def write_fake_plugin(directory, entries):
+    """Write a plugin script printing the given number of entries and return its path."""
+    output_path = os.path.join(directory, f"output_{entries}.txt")
+    with open(output_path, "w", encoding="utf-8") as output:
+        output.write(generate_plugin_output(entries) + "\n")
+    plugin_path = os.path.join(directory, f"check_fake_{entries}")
+    with open(plugin_path, "w", encoding="utf-8") as plugin:
+        plugin.write(f"#!/bin/sh\nexec cat {output_path}\n")
+    os.chmod(plugin_path, os.stat(plugin_path).st_mode | stat.S_IXUSR)
+    return plugin_path
+
+
+def run_main(argv):
+    """Run main() in process with the given arguments and discard its output."""
+    with patch.object(sys, "argv", ["check_with_thresholds_as_perfdata.py"] + argv), patch.object(
+        wrapper, "command_starts_with_an_opsview_path", return_value=True
+    ), contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        try:
+            wrapper.main()
+        except SystemExit:
+            pass
+
+
+def macro_benchmarks(sizes, min_time):
+    """Time main() end to end against a fake plugin for every number of entries.
+
+    The fake plugin lives outside /opt/opsview/monitoringscripts, so the path check
+    is bypassed for the benchmark.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            plugin = write_fake_plugin(directory, size)
+            argv = ["-w", WARNING, "-c", CRITICAL, "-s", STATIC[0], "-C", plugin]
+            results[f"main[{size}]"] = {
+                "seconds": best_time(lambda: run_main(argv), min_time),
+                "entries": size,
+            }
+    return results
+
+
+def compare(results, baseline, max_regression):
+    """Return the benchmarks which are more than max_regression percent slower."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]["seconds"], result["seconds"]
+        change = (after - before) / before * 100
+        result["change_percent"] = round(change, 1)
+        if change > max_regression:
+            regressions.append(f"{name}: {before:.6g}s -> {after:.6g}s ({change:+.1f}%)")
+    return regressions
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0], formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        help="Numbers of perfdata entries to benchmark with",
+    )
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum seconds per timing")
+    parser.add_argument("--no-macro", action="store_true", help="Skip the main() benchmarks")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=20.0,
+        help="Fail if a benchmark is this many percent slower than in --compare (default 20)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    """Run the benchmarks, print and save the results and check for regressions."""
+    args = parse_arguments()
+    results = micro_benchmarks(args.sizes, args.min_time)
+    if not args.no_macro:
+        results.update(macro_benchmarks(args.sizes, args.min_time))
+    for result in results.values():
+        result["entries_per_second"] = round(result["entries"] / result["seconds"])
+
+    regressions = []
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline:
+            regressions = compare(results, json.load(baseline)["results"], args.max_regression)
+
+    report = {"python": platform.python_version(), "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+    if regressions:
+        sys.stderr.write(
+            f"Benchmarks more than {args.max_regression}% slower than {args.compare}:\n"
+        )
+        sys.stderr.write("".join(f"  {regression}\n" for regression in regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/opt/opsview/python3/bin/python
+#
+# Copyright 2024 ITRS Group Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Forward a check to a running check_with_thresholds_as_perfdata.py server.
+
+Takes the same arguments as check_with_thresholds_as_perfdata.py. When no server is
+listening, the check is run in this process instead, with the same result.
+"""
+import json
+import os
+import socket
+import struct
+import sys
+
+SOCKET_ENVIRONMENT_VARIABLE = "CHECK_WITH_THRESHOLDS_AS_PERFDATA_SOCKET"
+# Seconds to wait for the server without --timeout, the default service check
+# timeout of Nagios
+DEFAULT_TIMEOUT = 60.0
+# Seconds to wait beyond --timeout, for the server to kill the command and answer
+TIMEOUT_MARGIN = 5.0
+
+
+def default_socket_path():
+    """Return the Unix socket path, kept in step with the server's default."""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or os.environ.get("TMPDIR") or "/tmp"
+    return os.environ.get(SOCKET_ENVIRONMENT_VARIABLE) or os.path.join(
+        runtime_dir, f"check_with_thresholds_as_perfdata-{os.getuid()}", "server.sock"
+    )
+
+
+def check_server_user(client, path):
+    """Raise PermissionError unless the server on the socket runs as this user.
+
+    Anyone able to create the socket could otherwise answer with any check result.
+    The peer credentials are used where the platform has them, and the owner of the
+    socket file elsewhere.
+    """
+    if hasattr(socket, "SO_PEERCRED"):
+        credentials = client.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+        )
+        uid = struct.unpack("3i", credentials)[1]
+    else:
+        uid = os.stat(path).st_uid
+    if uid != os.getuid():
+        raise PermissionError(f"The server on {path} runs as user {uid}, not {os.getuid()}")
+
+
+def request_timeout(argv):
+    """Return the seconds to wait for the server, from the --timeout in the arguments."""
+    timeout = None
+    for i, arg in enumerate(argv):
+        if arg in ("-t", "--timeout") and i + 1 < len(argv):
+            timeout = argv[i + 1]
+        elif arg.startswith("--timeout="):
+            timeout = arg[len("--timeout=") :]
+        elif arg.startswith("-t") and not arg.startswith("--") and len(arg) > 2:
+            timeout = arg[2:]
+    try:
+        return float(timeout) + TIMEOUT_MARGIN
+    except (TypeError, ValueError):
+        return DEFAULT_TIMEOUT
+
+
+def forward(argv, path, timeout=None):
+    """Send the arguments to the server and return its stdout, stderr and return code.
+
+    The command runs with the environment and working directory of this process.
+    Raises OSError, including socket.timeout after timeout seconds, or ValueError if
+    there is no complete response.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    request = {"argv": argv, "env": dict(os.environ), "cwd": os.getcwd()}
+    try:
+        client.connect(path)
+        check_server_user(client, path)
+        client.sendall(json.dumps(request).encode() + b"\n")
+        client.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        client.close()
+    response = json.loads(b"".join(chunks))
+    try:
+        return response["stdout"], response["stderr"], response["returncode"]
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Invalid response: {str(e)}") from None
+
+
+def run_in_process():
+    """Run the check in this process, exactly like the wrapper script does."""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from check_with_thresholds_as_perfdata_lib import main as wrapper_main
+
+    wrapper_main()
+
+
+def main():
+    """Forward the check to the server, or run it in process if there is none."""
+    argv = sys.argv[1:]
+    try:
+        stdout, stderr, returncode = forward(argv, default_socket_path(), request_timeout(argv))
+    except (OSError, ValueError):
+        # No server, a stale socket, a server run by another user, or a server that
+        # went away or did not answer in time
+        run_in_process()
+        return
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    sys.exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3976 @@
+#
+# Copyright 2024 ITRS Group Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run your check command and append warning and critical thresholds as perfdata.
+
+This is the implementation of check_with_thresholds_as_perfdata.py, kept in a
+module so that its compiled bytecode is cached instead of being compiled again
+on every check.
+"""
+# Only modules needed by every check are imported here. Everything else is imported
+# where it is used, as the start-up time is paid on every single check.
+import os
+import sys
+import re
+import functools
+from collections import namedtuple
+from types import SimpleNamespace
+
+DEFAULT_CONCURRENCY = 16
+READ_CHUNK_SIZE = 65536
+DEFAULT_CACHE_MAX_ENTRIES = 1000
+TEMPLATE_CACHE_SIZE = 256
+TIMEOUT_KILL_GRACE = 2.0
+# Perfdata kept from the output of a plugin when --max-output-bytes is given
+MAX_PERFDATA_BYTES = 1048576
+SOCKET_ENVIRONMENT_VARIABLE = "CHECK_WITH_THRESHOLDS_AS_PERFDATA_SOCKET"
+# Options naming files or directories, which the server resolves against the
+# working directory of the client
+PATH_OPTIONS = ("threshold_config", "baseline", "suppress_unchanged", "stats_file", "cache_file")
+DEFAULT_POLL_INTERVAL = 1.0
+SPOOL_BATCH_SIZE = 256
+# Nagios writes an empty NAME.ok file once the check result file NAME is complete
+SPOOL_MARKER_SUFFIX = ".ok"
+# inotify(7) event masks, and the size of struct inotify_event without its name.
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT_SIZE = 16
+# NRPE v2 packets: version, type, CRC32 of the packet with this field zeroed, result
+# code and a NUL-terminated buffer, padded to 1036 bytes like the C struct.
+NRPE_PACKET_FORMAT = "!hhIh1024s2x"
+NRPE_PACKET_VERSION = 2
+NRPE_QUERY_PACKET = 1
+NRPE_RESPONSE_PACKET = 2
+NRPE_RESPONSE_PACKET_WITH_MORE = 3
+NRPE_BUFFER_SIZE = 1024
+NRPE_DEFAULT_PORT = 5666
+NRPE_DEFAULT_TIMEOUT = 10
+NRPE_CIPHERS = "ALL:!MD5:@STRENGTH:@SECLEVEL=0"
+# The options of check_nrpe the built-in client understands, and what they set.
+NRPE_OPTIONS = {
+    "-H": "host",
+    "--host": "host",
+    "-p": "port",
+    "--port": "port",
+    "-c": "command",
+    "--command": "command",
+    "-t": "timeout",
+    "--timeout": "timeout",
+}
+NRPE_FLAGS = {
+    "-n": "no_ssl",
+    "--no-ssl": "no_ssl",
+    "-u": "unknown_timeout",
+    "--unknown-timeout": "unknown_timeout",
+    "-2": "v2_packets_only",
+    "--v2-packets-only": "v2_packets_only",
+}
+NAGIOS_STATES = ("OK", "WARNING", "CRITICAL", "UNKNOWN")
+OUTPUT_FORMATS = ("nagios", "json", "openmetrics")
+# The PerfdataProcessor settings that manifest records can set.
+MANIFEST_SETTINGS = (
+    "warning",
+    "critical",
+    "static",
+    "threshold_map",
+    "include",
+    "exclude",
+    "max_entries",
+    "evaluate",
+    "output_format",
+)
+# The JSON types of the manifest record fields, described as in their error messages.
+SETTING_TYPES = {
+    "command": "a string",
+    "warning": "a string or a number",
+    "critical": "a string or a number",
+    "static": "a string or a list of strings",
+    "threshold_map": "a string or a list of strings",
+    "include": "a string or a list of strings",
+    "exclude": "a string or a list of strings",
+    "max_entries": "an integer",
+    "evaluate": "true or false",
+    "output_format": "a string",
+}
+
+# The stats file holds a header and STATS_SLOTS per-plugin slots of 64-bit counters:
+# the plugin's key and name, one counter per return code (UNKNOWN counting anything
+# above 2), and a histogram of STATS_BUCKETS buckets per phase, where bucket i counts
+# the durations up to STATS_BUCKET_BASE * 2 ** (i / 2) seconds.
+STATS_MAGIC = b"CWTPSTA1"
+STATS_SLOTS = 256
+STATS_BUCKETS = 64
+STATS_BUCKET_BASE = 1e-6
+STATS_PHASES = (
+    "parse_arguments",
+    "execute_command",
+    "process_command_output",
+    "parse_perfdata",
+    "evaluate_perfdata",
+    "append_thresholds",
+    "total",
+)
+STATS_RETURN_CODES = ("OK", "WARNING", "CRITICAL", "UNKNOWN")
+STATS_NAME_WORDS = 30
+STATS_HEADER_WORDS = 2
+STATS_COUNTERS_OFFSET = 1 + STATS_NAME_WORDS
+STATS_HISTOGRAMS_OFFSET = STATS_COUNTERS_OFFSET + len(STATS_RETURN_CODES)
+STATS_SLOT_WORDS = STATS_HISTOGRAMS_OFFSET + len(STATS_PHASES) * STATS_BUCKETS
+STATS_FILE_SIZE = 8 * (STATS_HEADER_WORDS + STATS_SLOTS * STATS_SLOT_WORDS)
+
+# A baseline file holds a header and BASELINE_SLOTS per-label slots of 64-bit words:
+# the label's key, the number of values and the index of the next one, the running
+# sum and sum of squares of the values, and a ring buffer of the last window values.
+BASELINE_MAGIC = b"CWTPBAS1"
+BASELINE_SLOTS = 256
+BASELINE_HEADER_WORDS = 3
+BASELINE_VALUES_OFFSET = 5
+BASELINE_MIN_SAMPLES = 2
+DEFAULT_BASELINE_WINDOW = 60
+DEFAULT_BASELINE_DEVIATIONS = 3.0
+
+# A suppression file holds a "time<TAB>entry" line for every derived entry of the
+# check's last run, with the time the entry was last emitted.
+DEFAULT_HEARTBEAT = 3600.0
+
+# A threshold index holds a header of THRESHOLD_INDEX_HEADER_WORDS 64-bit words (the
+# magic, the mtime in nanoseconds and size of the source file and the number of
+# entries), a table of (key offset, key length, value offset, value length) words
+# per entry sorted by key, and the keys and values. A key is "host\0service" and a
+# value the warning, critical, static and threshold map settings separated by NUL,
+# with the items of the lists separated by THRESHOLD_INDEX_LIST_SEPARATOR.
+THRESHOLD_INDEX_MAGIC = b"CWTPTHI1"
+THRESHOLD_INDEX_HEADER_WORDS = 4
+THRESHOLD_INDEX_ENTRY_WORDS = 4
+THRESHOLD_INDEX_LIST_SEPARATOR = "\x1f"
+THRESHOLD_CONFIG_SETTINGS = ("warning", "critical", "static", "threshold_map")
+
+# A perfdata entry is 'label'=value[uom];[warn];[crit];[min];[max], where a quoted label
+# may contain spaces and '' stands for a quote. As with the split-and-regex parser
+# before it, an unquoted label ends at the last "=" followed by a value, and anything
+# after the UOM up to the next ";", as in 3KB/s or 10,5, is ignored. Anything else up
+# to the next space is matched as "other" so the whole perfdata string is scanned in
+# a single pass.
+PERFDATA_TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<label>'(?:[^']|'')*'|\S+)
+    =
+    (?P<value>[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?)
+    (?P<uom>[a-zA-Z%]*)[^;\s]*
+    (?:;(?P<warn>[^;\s]*)
+        (?:;(?P<crit>[^;\s]*)
+            (?:;(?P<min>[^;\s]*)
+                (?:;(?P<max>[^;\s]*)
+                    (?:;\S*)?
+    )?)?)?)?
+    (?=\s|\Z)
+    |(?P<other>\S+)
+    """,
+    re.VERBOSE,
+)
+
+# Commands containing any of these are run through the shell even with --no-shell.
+# A "#" starting a word starts a comment, while a "#" inside a word is literal.
+SHELL_OPERATOR_CHARACTERS = "|&;<>()"
+SHELL_EXPANSION_PATTERN = re.compile(r"[$`*?\[\]{}~\n]|(?:^|\s)#")
+ENVIRONMENT_ASSIGNMENT_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*=")
+
+# A --threshold-map rule is PATTERN=KEY=VALUE[,KEY=VALUE...]. The pattern ends at the
+# first "=" followed by one of the keys, so regular expressions may contain "=" too.
+# Flags of an expression without inline flags, which can be combined with others
+PLAIN_REGEX_FLAGS = re.compile("").flags
+THRESHOLD_MAP_RULE_PATTERN = re.compile(
+    r"(?P<pattern>.+?)=(?P<thresholds>(?:warning|critical|static)=.*)", re.DOTALL
+)
+
+# Nagios check result files escape newlines and backslashes in values as \n and \\.
+CHECK_RESULT_ESCAPE_PATTERN = re.compile(r"\\(.)")
+
+# Options understood by parse_common_arguments(), and the defaults of all options
+# parse_arguments() knows about, which the fast path has to return as well.
+COMMON_OPTIONS = {
+    "-w": "warning",
+    "--warning": "warning",
+    "-c": "critical",
+    "--critical": "critical",
+    "-s": "static",
+    "--static": "static",
+    "-C": "command",
+    "--command": "command",
+    "--threshold-config": "threshold_config",
+    "--host": "host",
+    "--service": "service",
+}
+ARGUMENT_DEFAULTS = {
+    "warning": None,
+    "critical": None,
+    "static": None,
+    "command": None,
+    "manifest": None,
+    "serve": None,
+    "concurrency": DEFAULT_CONCURRENCY,
+    "max_output_bytes": None,
+    "max_stderr_bytes": None,
+    "cache_ttl": None,
+    "cache_file": None,
+    "cache_max_entries": DEFAULT_CACHE_MAX_ENTRIES,
+    "single_flight_wait": None,
+    "no_shell": False,
+    "timeout": None,
+    "timeout_keep_perfdata": False,
+    "threshold_map": None,
+    "include": None,
+    "exclude": None,
+    "max_entries": None,
+    "evaluate": False,
+    "self_metrics": False,
+    "stats_file": None,
+    "stats": None,
+    "output_format": "nagios",
+    "spool": None,
+    "spool_output": None,
+    "workers": None,
+    "once": False,
+    "poll_interval": DEFAULT_POLL_INTERVAL,
+    "watch": None,
+    "watch_output": None,
+    "watch_count": None,
+    "builtin_nrpe": False,
+    "baseline": None,
+    "baseline_window": DEFAULT_BASELINE_WINDOW,
+    "baseline_deviations": DEFAULT_BASELINE_DEVIATIONS,
+    "suppress_unchanged": None,
+    "heartbeat": DEFAULT_HEARTBEAT,
+    "threshold_config": None,
+    "host": None,
+    "service": None,
+}
+
+
+def runtime_dir():
+    """Return the directory used for sockets and other per-user runtime files."""
+    return os.environ.get("XDG_RUNTIME_DIR") or os.environ.get("TMPDIR") or "/tmp"
+
+
+def private_runtime_dir():
+    """Return the directory of the user's runtime files, which only the user may access."""
+    return os.path.join(runtime_dir(), f"check_with_thresholds_as_perfdata-{os.getuid()}")
+
+
+def make_state_dir(directory):
+    """Create a directory in the private runtime directory, if the directory is in it.
+
+    The private runtime directory is checked to be a directory owned by the user and
+    inaccessible to others, without following symlinks, since another user may have
+    created it first in a shared directory such as /tmp. Raises OSError otherwise.
+    Other directories are left alone, as they were chosen on the command line.
+    """
+    private = private_runtime_dir()
+    if directory != private and not directory.startswith(private + os.sep):
+        return
+    try:
+        os.mkdir(private, 0o700)
+    except FileExistsError:
+        pass
+    fd = os.open(private, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    try:
+        stat = os.fstat(fd)
+    finally:
+        os.close(fd)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        raise PermissionError(f"{private} is not private to user {os.getuid()}")
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+
+def default_cache_path():
+    """Return the path of the command result cache shared by all wrapper processes."""
+    return os.path.join(private_runtime_dir(), "results.cache")
+
+
+def default_lock_dir():
+    """Return the directory holding the per-command single-flight lock files."""
+    return os.path.join(private_runtime_dir(), "locks")
+
+
+def default_stats_path():
+    """Return the path of the memory-mapped stats file shared by all wrapper processes."""
+    return os.path.join(private_runtime_dir(), "wrapper.stats")
+
+
+def default_baseline_dir():
+    """Return the directory holding the baseline file of each check."""
+    return os.path.join(private_runtime_dir(), "baselines")
+
+
+def default_suppression_dir():
+    """Return the directory holding the suppression file of each check."""
+    return os.path.join(private_runtime_dir(), "suppressions")
+
+
+def default_threshold_index_path(config):
+    """Return the path of the compiled index of the threshold config file."""
+    import zlib  # pylint: disable=import-outside-toplevel
+
+    checksum = zlib.crc32(os.path.abspath(config).encode())
+    return os.path.join(private_runtime_dir(), f"{checksum:08x}.thresholds")
+
+
+def default_socket_path():
+    """Return the Unix socket path shared by the server and the client."""
+    return os.environ.get(SOCKET_ENVIRONMENT_VARIABLE) or os.path.join(
+        private_runtime_dir(), "server.sock"
+    )
+
+
+def parse_common_arguments(argv):
+    """Parse a plain -w/-c/-s/-C command line without importing argparse.
+
+    Returns None for anything else, including --help and mistakes, so that
+    parse_arguments() can hand it to argparse.
+    """
+    values = dict(ARGUMENT_DEFAULTS)
+    i = 0
+    while i < len(argv):
+        if argv[i].startswith("--") and "=" in argv[i]:
+            option, value = argv[i].split("=", 1)
+            i += 1
+        elif i + 1 < len(argv):
+            option, value = argv[i], argv[i + 1]
+            i += 2
+        else:
+            return None
+
+        dest = COMMON_OPTIONS.get(option)
+        if dest is None or value.startswith("-"):
+            return None
+        if dest == "static":
+            values["static"] = (values["static"] or []) + [value]
+        else:
+            values[dest] = value
+
+    if values["command"] is None:
+        return None
+    return SimpleNamespace(**values)
+
+
+def parse_arguments(argv=None):
+    """Parse command line arguments."""
+    args = parse_common_arguments(sys.argv[1:] if argv is None else argv)
+    if args is not None:
+        return args
+
+    import argparse  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(description="Opsview Plugin Wrapper Script")
+    parser.add_argument("-w", "--warning", type=str, help="Warning threshold")
+    parser.add_argument("-c", "--critical", type=str, help="Critical threshold")
+    parser.add_argument(
+        "-s",
+        "--static",
+        type=str,
+        help="Static performance metric, e.g. 'label_postfix=value'",
+        action="append",
+    )
+    parser.add_argument(
+        "--threshold-map",
+        help="Thresholds for the labels matching a glob, or a regex prefixed with 're:', "
+        "e.g. '/var*=warning=80,critical=90,static=max=100'. Labels matching no rule are skipped",
+        metavar="RULE",
+        action="append",
+    )
+    parser.add_argument(
+        "--threshold-config",
+        help="File of JSON lines with the thresholds of each host and service, used when no "
+        "thresholds are given on the command line",
+        metavar="FILE",
+        type=str,
+    )
+    parser.add_argument(
+        "--host",
+        help="Host name to look up in the --threshold-config",
+        type=str,
+    )
+    parser.add_argument(
+        "--service",
+        help="Service name to look up in the --threshold-config",
+        type=str,
+    )
+    parser.add_argument(
+        "--include",
+        help="Only keep the perfdata entries whose label matches this glob, or 're:' regex",
+        metavar="PATTERN",
+        action="append",
+    )
+    parser.add_argument(
+        "--exclude",
+        help="Drop the perfdata entries whose label matches this glob, or 're:' regex",
+        metavar="PATTERN",
+        action="append",
+    )
+    parser.add_argument(
+        "--max-entries",
+        help="Drop the perfdata entries that would take the output beyond this many entries",
+        metavar="N",
+        type=int,
+    )
+    parser.add_argument(
+        "--evaluate",
+        help="Check the perfdata values against the Nagios ranges in the thresholds and exit "
+        "with the worst state, emitting range starts and ends as separate metrics",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--output-format",
+        help="Print the result as Nagios plugin output with perfdata (default), as a JSON "
+        "object or as OpenMetrics text",
+        choices=OUTPUT_FORMATS,
+        default="nagios",
+    )
+    parser.add_argument(
+        "--self-metrics",
+        help="Append the time taken by each phase of the wrapper and the CPU time and maximum "
+        "RSS of the command as wrapper_* perfdata",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--baseline",
+        help="Keep the recent values of every label in a file in this directory (default in "
+        "the runtime directory) and append their mean and upper band as perfdata",
+        metavar="DIRECTORY",
+        nargs="?",
+        const=default_baseline_dir(),
+        type=str,
+    )
+    parser.add_argument(
+        "--baseline-window",
+        help=f"Number of recent values of a label in its --baseline "
+        f"(default {DEFAULT_BASELINE_WINDOW})",
+        metavar="N",
+        type=int,
+        default=DEFAULT_BASELINE_WINDOW,
+    )
+    parser.add_argument(
+        "--baseline-deviations",
+        help="Standard deviations between the --baseline mean and its upper band "
+        f"(default {DEFAULT_BASELINE_DEVIATIONS})",
+        metavar="K",
+        type=float,
+        default=DEFAULT_BASELINE_DEVIATIONS,
+    )
+    parser.add_argument(
+        "--suppress-unchanged",
+        help="Only append the threshold entries that changed since they were last appended, "
+        "keeping them in a file in this directory (default in the runtime directory)",
+        metavar="DIRECTORY",
+        nargs="?",
+        const=default_suppression_dir(),
+        type=str,
+    )
+    parser.add_argument(
+        "--heartbeat",
+        help="Seconds after which unchanged threshold entries are appended again with "
+        f"--suppress-unchanged (default {DEFAULT_HEARTBEAT:g})",
+        metavar="SECONDS",
+        type=float,
+        default=DEFAULT_HEARTBEAT,
+    )
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument(
+        "-C",
+        "--command",
+        help="Command to execute (double quotes required)",
+        type=str,
+    )
+    mode.add_argument(
+        "--manifest",
+        help="File with one JSON check record per line, run concurrently",
+        type=str,
+    )
+    mode.add_argument(
+        "--serve",
+        help="Run as a server answering client requests on this Unix socket",
+        metavar="SOCKET",
+        nargs="?",
+        const=default_socket_path(),
+        type=str,
+    )
+    mode.add_argument(
+        "--spool",
+        help="Apply the thresholds to the Nagios check result files arriving in this directory",
+        metavar="DIRECTORY",
+        type=str,
+    )
+    mode.add_argument(
+        "--stats",
+        help="Print the p50, p95 and p99 phase timings of each plugin recorded in the stats file",
+        metavar="STATS_FILE",
+        nargs="?",
+        const=default_stats_path(),
+        type=str,
+    )
+    parser.add_argument(
+        "--stats-file",
+        help="Record the phase timings and return code of the check in this stats file "
+        "(default in the runtime directory)",
+        metavar="STATS_FILE",
+        nargs="?",
+        const=default_stats_path(),
+        type=str,
+    )
+    parser.add_argument(
+        "--concurrency",
+        help=f"Maximum number of manifest checks to run at once (default {DEFAULT_CONCURRENCY})",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+    )
+    parser.add_argument(
+        "--spool-output",
+        help="Directory the processed --spool check result files are written to",
+        metavar="DIRECTORY",
+        type=str,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of processes handling --spool files (default one per CPU)",
+        type=int,
+    )
+    parser.add_argument(
+        "--once",
+        help="Process the files already in the --spool directory and exit",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        help="Seconds between --spool directory listings where inotify is not available "
+        f"(default {DEFAULT_POLL_INTERVAL})",
+        metavar="SECONDS",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+    )
+    parser.add_argument(
+        "--watch",
+        help="Keep running the --command every this many seconds, writing one JSON result "
+        "per line",
+        metavar="SECONDS",
+        type=float,
+    )
+    parser.add_argument(
+        "--watch-output",
+        help="File or FIFO the --watch results are written to (default stdout)",
+        metavar="PATH",
+        type=str,
+    )
+    parser.add_argument(
+        "--watch-count",
+        help="Stop --watch after this many runs",
+        metavar="N",
+        type=int,
+    )
+    parser.add_argument(
+        "--max-output-bytes",
+        help="Stream the command output and keep only this many bytes of text besides perfdata",
+        type=int,
+    )
+    parser.add_argument(
+        "--max-stderr-bytes",
+        help="Stream the command output and keep only the last this many bytes of stderr",
+        type=int,
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        help="Reuse the result of the same command run within this many seconds",
+        metavar="SECONDS",
+        type=float,
+    )
+    parser.add_argument(
+        "--cache-file",
+        help="SQLite file holding the cached command results (default in the runtime directory)",
+        type=str,
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        help=f"Maximum number of cached command results (default {DEFAULT_CACHE_MAX_ENTRIES})",
+        type=int,
+        default=DEFAULT_CACHE_MAX_ENTRIES,
+    )
+    parser.add_argument(
+        "--single-flight-wait",
+        help="Wait up to this long for an identical command already running to share its result",
+        metavar="SECONDS",
+        type=float,
+    )
+    parser.add_argument(
+        "--no-shell",
+        help="Run the command directly instead of through /bin/sh, unless it uses shell syntax",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--builtin-nrpe",
+        help="Query the NRPE daemon of check_nrpe commands directly, running check_nrpe only "
+        "for options and errors the built-in client does not handle",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        help="Kill the command and its children and return UNKNOWN after this many seconds",
+        metavar="SECONDS",
+        type=float,
+    )
+    parser.add_argument(
+        "--timeout-keep-perfdata",
+        help="Keep the perfdata read before the command timed out",
+        action="store_true",
+    )
+
+    return parser.parse_args(argv)
+
+
+def strip_command_quotes(command):
+    """Remove one pair of surrounding quotes from the command."""
+    if command.startswith('"') and command.endswith('"'):
+        command = command[1:-1]
+    elif command.startswith("'") and command.endswith("'"):
+        command = command[1:-1]
+    return command
+
+
+def resolve_executable(name):
+    """Return the normalised absolute path of the executable, or None if it can not be found."""
+    if "/" in name:
+        return os.path.normpath(os.path.abspath(name))
+    for directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        path = os.path.join(directory or ".", name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return os.path.normpath(os.path.abspath(path))
+    return None
+
+
+def command_argv(command):
+    """Split the command into arguments for running it directly.
+
+    The first argument is resolved to the path of the executable. Returns None if
+    the command uses shell syntax such as pipes, redirects, variables or globbing,
+    and so has to be run through the shell.
+    """
+    import shlex  # pylint: disable=import-outside-toplevel
+
+    if SHELL_EXPANSION_PATTERN.search(command):
+        return None
+    lexer = shlex.shlex(command, posix=True, punctuation_chars=SHELL_OPERATOR_CHARACTERS)
+    lexer.whitespace_split = True
+    # Comments were left to the shell above, so "#" is kept inside words like sh does
+    lexer.commenters = ""
+    try:
+        argv = list(lexer)
+    except ValueError:
+        return None
+    if not argv or ENVIRONMENT_ASSIGNMENT_PATTERN.match(argv[0]):
+        return None
+    if any(arg and not arg.strip(SHELL_OPERATOR_CHARACTERS) for arg in argv):
+        return None
+    argv[0] = resolve_executable(argv[0]) or argv[0]
+    return argv
+
+
+def popen_arguments(command, shell=True):
+    """Return the arguments and keyword arguments to start the command with."""
+    argv = None if shell else command_argv(command)
+    if argv is None:
+        return command, {"shell": True}
+    # Without a shell and with inherited (non-inheritable by default) descriptors
+    # left alone, subprocess can start the plugin with posix_spawn.
+    return argv, {"shell": False, "close_fds": False}
+
+
+class PluginOutputReader:
+    """Keep plugin stdout in a bounded buffer while it is being read.
+
+    Follows the plugin output format: perfdata is everything after the '|' on the
+    first line, and everything after the first '|' in the long output. Only the
+    first max_text_bytes of the rest of the output are kept, and only the first
+    max_perfdata_bytes of the perfdata, cut after the last whole entry. The layout
+    of the output is kept, so output within the limits is processed exactly as if
+    it was read all at once.
+    """
+
+    FIRST_LINE_TEXT, FIRST_LINE_PERFDATA, LONG_TEXT, LONG_PERFDATA = range(4)
+
+    def __init__(self, max_text_bytes=None, max_perfdata_bytes=MAX_PERFDATA_BYTES):
+        self.max_text_bytes = max_text_bytes
+        self.max_perfdata_bytes = max_perfdata_bytes
+        self.data = bytearray()
+        self.text_bytes = self.perfdata_bytes = 0
+        self.text_cut = self.perfdata_cut = False
+        self.perfdata_start = 0
+        self.state = self.FIRST_LINE_TEXT
+
+    def add_text(self, data):
+        """Keep as much of the text as fits."""
+        if self.max_text_bytes is not None and self.text_bytes + len(data) > self.max_text_bytes:
+            data = data[: self.max_text_bytes - self.text_bytes]
+            self.text_cut = True
+        self.data += data
+        self.text_bytes += len(data)
+
+    def start_perfdata(self, state):
+        """Keep the '|' starting the perfdata of the first line or of the long output."""
+        if state == self.LONG_PERFDATA and self.text_cut and not self.data[-1:].isspace():
+            # Keep the perfdata apart from what is left of the long output before it
+            self.data += b"\n"
+        self.data += b"|"
+        self.perfdata_start = len(self.data)
+        self.state = state
+
+    def add_perfdata(self, data):
+        """Keep as much of the perfdata as fits, up to the end of its last whole entry."""
+        if self.perfdata_cut:
+            return
+        room = len(data)
+        if self.max_perfdata_bytes is not None:
+            room = self.max_perfdata_bytes - self.perfdata_bytes
+        if len(data) <= room:
+            self.data += data
+            self.perfdata_bytes += len(data)
+            return
+        self.data += data[:room]
+        self.perfdata_cut = True
+        if data[room : room + 1].isspace():
+            return
+        end = len(self.data)
+        while end > self.perfdata_start and not self.data[end - 1 : end].isspace():
+            end -= 1
+        del self.data[end:]
+
+    def feed(self, chunk):
+        """Consume the next chunk of stdout."""
+        pos, end = 0, len(chunk)
+        while pos < end:
+            if self.state in (self.FIRST_LINE_TEXT, self.LONG_TEXT):
+                pipe = chunk.find(b"|", pos)
+                newline = chunk.find(b"\n", pos)
+                if pipe != -1 and (newline == -1 or pipe < newline):
+                    self.add_text(chunk[pos:pipe])
+                    self.start_perfdata(
+                        self.FIRST_LINE_PERFDATA
+                        if self.state == self.FIRST_LINE_TEXT
+                        else self.LONG_PERFDATA
+                    )
+                    pos = pipe + 1
+                elif newline != -1:
+                    self.add_text(chunk[pos : newline + 1])
+                    self.state = self.LONG_TEXT
+                    pos = newline + 1
+                else:
+                    self.add_text(chunk[pos:])
+                    pos = end
+            elif self.state == self.FIRST_LINE_PERFDATA:
+                newline = chunk.find(b"\n", pos)
+                if newline == -1:
+                    self.add_perfdata(chunk[pos:])
+                    pos = end
+                else:
+                    self.add_perfdata(chunk[pos:newline])
+                    # The end of the first line is kept, so long output stays apart
+                    self.data += b"\n"
+                    self.state = self.LONG_TEXT
+                    pos = newline + 1
+            else:
+                self.add_perfdata(chunk[pos:])
+                pos = end
+
+    def getvalue(self):
+        """Return the kept output."""
+        return self.data.decode(errors="replace")
+
+
+class TailBuffer:
+    """Ring buffer keeping only the last max_bytes bytes written to it."""
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.data = bytearray()
+
+    def feed(self, chunk):
+        """Consume the next chunk, dropping the oldest bytes beyond max_bytes."""
+        if self.max_bytes is None:
+            self.data += chunk
+            return
+        if len(chunk) >= self.max_bytes:
+            self.data[:] = chunk[len(chunk) - self.max_bytes :]
+            return
+        self.data += chunk
+        if len(self.data) > self.max_bytes:
+            del self.data[: len(self.data) - self.max_bytes]
+
+    def getvalue(self):
+        """Return the kept bytes as text."""
+        return self.data.decode(errors="replace")
+
+
+def output_buffers(max_output_bytes=None, max_stderr_bytes=None):
+    """Return the buffers to read stdout and stderr into."""
+    if max_output_bytes is None:
+        return TailBuffer(), TailBuffer(max_stderr_bytes)
+    return PluginOutputReader(max_output_bytes), TailBuffer(max_stderr_bytes)
+
+
+def kill_process_group(process, grace=None):
+    """Send SIGTERM to the process group, and SIGKILL to whatever is left after grace seconds."""
+    import signal  # pylint: disable=import-outside-toplevel
+    import time  # pylint: disable=import-outside-toplevel
+
+    deadline = time.monotonic() + (TIMEOUT_KILL_GRACE if grace is None else grace)
+    for signum in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, signum)
+        except ProcessLookupError:
+            return
+        while time.monotonic() < deadline:
+            process.poll()
+            try:
+                os.killpg(process.pid, 0)
+            except ProcessLookupError:
+                return
+            time.sleep(0.01)
+
+
+def timed_out_result(command, timeout, elapsed, stdout, stderr, keep_perfdata=False):
+    """Return the UNKNOWN result of a command which was killed after the timeout."""
+    import subprocess  # pylint: disable=import-outside-toplevel
+
+    output = (
+        f"UNKNOWN - Command timed out after {timeout:g} seconds "
+        f"and was killed after running for {elapsed:.2f} seconds"
+    )
+    if keep_perfdata:
+        matches = list(PERFDATA_TOKEN_PATTERN.finditer(extract_perfdata(stdout)[1]))
+        if not stdout[-1:].isspace():
+            # The last entry may have been cut off while it was being written
+            matches = matches[:-1]
+        # Long output after the perfdata is not kept, only the valid entries
+        perfdata = " ".join(match.group() for match in matches if match.lastgroup != "other")
+        if perfdata:
+            output = f"{output} | {perfdata}"
+    return subprocess.CompletedProcess(command, 3, output, stderr)
+
+
+def stream_command(
+    command,
+    max_output_bytes=None,
+    max_stderr_bytes=None,
+    shell=True,
+    timeout=None,
+    keep_perfdata=False,
+):
+    """Run the command, reading stdout and stderr incrementally into bounded buffers.
+
+    With a timeout, the command runs in its own process group, which is killed
+    when the timeout expires.
+    """
+    import selectors  # pylint: disable=import-outside-toplevel
+    import subprocess  # pylint: disable=import-outside-toplevel
+    import time  # pylint: disable=import-outside-toplevel
+
+    stdout, stderr = output_buffers(max_output_bytes, max_stderr_bytes)
+    args, popen_options = popen_arguments(command, shell)
+    started = time.monotonic()
+    deadline = None if timeout is None else started + timeout
+
+    def timed_out(process):
+        kill_process_group(process)
+        process.wait()
+        return timed_out_result(
+            command,
+            timeout,
+            time.monotonic() - started,
+            stdout.getvalue(),
+            stderr.getvalue(),
+            keep_perfdata,
+        )
+
+    with subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=timeout is not None,
+        **popen_options,
+    ) as process, selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ, stdout)
+        selector.register(process.stderr, selectors.EVENT_READ, stderr)
+        while selector.get_map():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return timed_out(process)
+            for key, _ in selector.select(remaining):
+                chunk = os.read(key.fd, READ_CHUNK_SIZE)
+                if chunk:
+                    key.data.feed(chunk)
+                else:
+                    selector.unregister(key.fileobj)
+        # The command may close its output and keep running, so the deadline also
+        # applies to waiting for it to exit
+        try:
+            returncode = process.wait(None if deadline is None else deadline - time.monotonic())
+        except subprocess.TimeoutExpired:
+            return timed_out(process)
+    return subprocess.CompletedProcess(command, returncode, stdout.getvalue(), stderr.getvalue())
+
+
+def normalise_command(command):
+    """Return the command in a canonical form, so equivalent command lines compare equal."""
+    import shlex  # pylint: disable=import-outside-toplevel
+
+    command = strip_command_quotes(command.strip())
+    try:
+        return shlex.join(shlex.split(command))
+    except ValueError:
+        return command
+
+
+def result_key(command, options=None):
+    """Return the key of the command's result, run with the options of run_command().
+
+    The options are part of the key, as a command run with an output limit or a
+    timeout can give a different result.
+    """
+    key = normalise_command(command)
+    if options:
+        key += "\0" + repr(sorted(options.items()))
+    return key
+
+
+class ResultCache:
+    """Command results shared between wrapper processes through an SQLite file.
+
+    Results are served while they are younger than ttl seconds, and only the
+    max_entries most recent results are kept. The cache is an optimisation only:
+    if the file can not be used, every lookup is a miss.
+    """
+
+    def __init__(self, path, ttl, max_entries=DEFAULT_CACHE_MAX_ENTRIES):
+        import sqlite3  # pylint: disable=import-outside-toplevel
+
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.errors = (sqlite3.Error,)
+        old_umask = os.umask(0o077)
+        try:
+            make_state_dir(os.path.dirname(path))
+            self.connection = sqlite3.connect(path, timeout=5)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "command TEXT PRIMARY KEY, created REAL, "
+                "stdout TEXT, stderr TEXT, returncode INTEGER)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_created ON results (created)"
+            )
+        except (OSError, sqlite3.Error):
+            self.connection = None
+        finally:
+            os.umask(old_umask)
+
+    def get(self, command, newer_than=None, options=None):
+        """Return the fresh cached result of the command run with the options, or None."""
+        import subprocess  # pylint: disable=import-outside-toplevel
+        import time  # pylint: disable=import-outside-toplevel
+
+        if self.connection is None:
+            return None
+        oldest = time.time() - self.ttl
+        if newer_than is not None:
+            oldest = max(oldest, newer_than)
+        try:
+            row = self.connection.execute(
+                "SELECT stdout, stderr, returncode FROM results WHERE command = ? AND created > ?",
+                (result_key(command, options), oldest),
+            ).fetchone()
+        except self.errors:
+            return None
+        if row is None:
+            return None
+        return subprocess.CompletedProcess(command, row[2], row[0], row[1])
+
+    def put(self, command, result, options=None):
+        """Store the result of the command run with the options, evicting the oldest results."""
+        import time  # pylint: disable=import-outside-toplevel
+
+        if self.connection is None:
+            return
+        now = time.time()
+        try:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                    (
+                        result_key(command, options),
+                        now,
+                        result.stdout,
+                        result.stderr,
+                        result.returncode,
+                    ),
+                )
+                self.connection.execute(
+                    "DELETE FROM results WHERE command NOT IN "
+                    "(SELECT command FROM results ORDER BY created DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+        except self.errors:
+            pass
+
+
+class SingleFlight:
+    """Run each command once at a time, sharing the result with identical concurrent runs.
+
+    The first wrapper to lock the command's lock file runs it and stores the result.
+    Others wait for the lock to be released and reuse that result, or run the
+    command themselves after max_wait seconds, or if the first one failed.
+    """
+
+    POLL_INTERVAL = 0.01
+
+    def __init__(self, lock_dir, store, max_wait):
+        self.lock_dir = lock_dir
+        self.store = store
+        self.max_wait = max_wait
+
+    def lock_path(self, command, options=None):
+        """Return the path of the lock file of the command run with the options."""
+        import hashlib  # pylint: disable=import-outside-toplevel
+
+        digest = hashlib.sha256(result_key(command, options).encode()).hexdigest()
+        return os.path.join(self.lock_dir, f"{digest}.lock")
+
+    def run(self, command, run_command, options=None):
+        """Return the result of run_command(), or of an identical run already in flight.
+
+        Runs are identical if they are of the same command with the same options.
+        """
+        import fcntl  # pylint: disable=import-outside-toplevel
+        import time  # pylint: disable=import-outside-toplevel
+
+        started = time.time()
+        try:
+            make_state_dir(self.lock_dir)
+            os.makedirs(self.lock_dir, mode=0o700, exist_ok=True)
+            path = self.lock_path(command, options)
+            lock = open(path, "a", encoding="utf-8")  # pylint: disable=consider-using-with
+        except OSError:
+            return run_command()
+
+        with lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                result = self.wait_for_result(lock, command, started, options)
+                return run_command() if result is None else result
+
+            try:
+                result = run_command()
+                self.store.put(command, result, options)
+                return result
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def wait_for_result(self, lock, command, started, options=None):
+        """Wait for the running command to finish and return its result, or None."""
+        import fcntl  # pylint: disable=import-outside-toplevel
+        import time  # pylint: disable=import-outside-toplevel
+
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    return None
+                time.sleep(self.POLL_INTERVAL)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        return self.store.get(command, newer_than=started, options=options)
+
+
+def open_single_flight(args, cache):
+    """Return the single-flight runner configured on the command line, or None."""
+    if args.single_flight_wait is None:
+        return None
+    store = cache or ResultCache(
+        args.cache_file or default_cache_path(), args.single_flight_wait, args.cache_max_entries
+    )
+    return SingleFlight(default_lock_dir(), store, args.single_flight_wait)
+
+
+def open_result_cache(args):
+    """Return the result cache configured on the command line, or None."""
+    if args.cache_ttl is None:
+        return None
+    return ResultCache(
+        args.cache_file or default_cache_path(), args.cache_ttl, args.cache_max_entries
+    )
+
+
+NrpeRequest = namedtuple(
+    "NrpeRequest", ["host", "port", "query", "timeout", "timeout_state", "ssl", "v2_only"]
+)
+
+
+def parse_check_nrpe(command):
+    """Return the NrpeRequest of a check_nrpe command, or None.
+
+    None is returned for other commands, commands using shell syntax and check_nrpe
+    options the built-in client does not support, e.g. certificates or a config file.
+    """
+    argv = command_argv(command)
+    if argv is None or os.path.basename(argv[0]) != "check_nrpe":
+        return None
+
+    values, arguments, i = {}, [], 1
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+        if arg in ("-a", "--args"):
+            arguments = argv[i:]
+            break
+        if arg in NRPE_FLAGS:
+            values[NRPE_FLAGS[arg]] = True
+            continue
+        if arg.startswith("--") and "=" in arg:
+            arg, value = arg.split("=", 1)
+        elif arg in NRPE_OPTIONS and i < len(argv):
+            value = argv[i]
+            i += 1
+        elif arg[:2] in NRPE_OPTIONS and len(arg) > 2 and not arg.startswith("--"):
+            arg, value = arg[:2], arg[2:]
+        else:
+            return None
+        if arg not in NRPE_OPTIONS:
+            return None
+        values[NRPE_OPTIONS[arg]] = value
+
+    timeout, _, timeout_state = values.get("timeout", str(NRPE_DEFAULT_TIMEOUT)).partition(":")
+    try:
+        port, timeout = int(values.get("port", NRPE_DEFAULT_PORT)), int(timeout)
+        timeout_state = int(timeout_state) if timeout_state else None
+    except ValueError:
+        return None
+    if "host" not in values or timeout < 1 or timeout_state not in (None, 0, 1, 2, 3):
+        return None
+    if timeout_state is None:
+        timeout_state = 3 if values.get("unknown_timeout") else 2
+
+    return NrpeRequest(
+        values["host"],
+        port,
+        "!".join([values.get("command", "_NRPE_CHECK")] + arguments),
+        timeout,
+        timeout_state,
+        not values.get("no_ssl"),
+        bool(values.get("v2_packets_only")),
+    )
+
+
+def nrpe_packet(packet_type, result_code, text):
+    """Return an NRPE v2 packet holding the text."""
+    import struct  # pylint: disable=import-outside-toplevel
+    import zlib  # pylint: disable=import-outside-toplevel
+
+    buffer = text.encode()[: NRPE_BUFFER_SIZE - 1]
+    fields = (NRPE_PACKET_VERSION, packet_type, 0, result_code, buffer)
+    crc = zlib.crc32(struct.pack(NRPE_PACKET_FORMAT, *fields))
+    return struct.pack(NRPE_PACKET_FORMAT, NRPE_PACKET_VERSION, packet_type, crc, *fields[3:])
+
+
+def parse_nrpe_packet(packet):
+    """Return the type, result code and buffer of an NRPE v2 packet, or None if it is invalid."""
+    import struct  # pylint: disable=import-outside-toplevel
+    import zlib  # pylint: disable=import-outside-toplevel
+
+    if len(packet) != struct.calcsize(NRPE_PACKET_FORMAT):
+        return None
+    version, packet_type, crc, result_code, buffer = struct.unpack(NRPE_PACKET_FORMAT, packet)
+    if version != NRPE_PACKET_VERSION or zlib.crc32(packet[:4] + bytes(4) + packet[8:]) != crc:
+        return None
+    return packet_type, result_code, buffer.split(b"\0", 1)[0]
+
+
+def parse_nrpe_response(data, v2_only=False):
+    """Return the result code and output of the response packets, or None.
+
+    None is returned for anything check_nrpe would not simply print, and for output
+    filling a whole packet unless v2_only is set, as check_nrpe itself would have
+    used v3 packets and received the rest of it.
+    """
+    size = NRPE_BUFFER_SIZE + 12
+    if not data or len(data) % size:
+        return None
+    packets = [parse_nrpe_packet(data[i : i + size]) for i in range(0, len(data), size)]
+    if None in packets or packets[-1][0] != NRPE_RESPONSE_PACKET:
+        return None
+    if any(packet[0] != NRPE_RESPONSE_PACKET_WITH_MORE for packet in packets[:-1]):
+        return None
+    result_code, output = packets[0][1], b"".join(packet[2] for packet in packets)
+    if not output or result_code not in (0, 1, 2, 3):
+        return None
+    if len(packets) == 1 and len(output) >= NRPE_BUFFER_SIZE - 1 and not v2_only:
+        return None
+    return result_code, output.decode(errors="replace")
+
+
+class NrpeClient:
+    """Query NRPE daemons with v2 packets, the way check_nrpe does.
+
+    The daemon closes the connection after every response, so instead of keeping
+    connections open, the client keeps one TLS context and the last TLS session of
+    each daemon, which later connections resume instead of a full handshake.
+    """
+
+    def __init__(self):
+        self.context = None
+        self.sessions = {}
+
+    def ssl_context(self):
+        """Return the TLS context, which allows the anonymous ciphers NRPE uses by default."""
+        import ssl  # pylint: disable=import-outside-toplevel
+
+        if self.context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            context.maximum_version = ssl.TLSVersion.TLSv1_2
+            context.set_ciphers(NRPE_CIPHERS)
+            self.context = context
+        return self.context
+
+    def query(self, request):
+        """Send the request and return the result check_nrpe would return, or None.
+
+        None is returned when the daemon can not be reached or answers with anything
+        but a plain result, so that check_nrpe can be run to report it.
+        """
+        import socket  # pylint: disable=import-outside-toplevel
+        import ssl  # pylint: disable=import-outside-toplevel
+        import subprocess  # pylint: disable=import-outside-toplevel
+        import time  # pylint: disable=import-outside-toplevel
+
+        deadline = time.monotonic() + request.timeout
+        key, chunks = (request.host, request.port), []
+        try:
+            sock = socket.create_connection(key, request.timeout)
+            try:
+                if request.ssl:
+                    sock = self.ssl_context().wrap_socket(sock, session=self.sessions.get(key))
+                    self.sessions[key] = sock.session
+                sock.sendall(nrpe_packet(NRPE_QUERY_PACKET, 0, request.query))
+                while True:
+                    sock.settimeout(max(deadline - time.monotonic(), 0.001))
+                    try:
+                        chunk = sock.recv(READ_CHUNK_SIZE)
+                    except ssl.SSLEOFError:
+                        # The daemon closed the connection without a TLS close_notify
+                        break
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            finally:
+                sock.close()
+        except socket.timeout:
+            state = request.timeout_state
+            output = (
+                f"CHECK_NRPE STATE {NAGIOS_STATES[state]}: "
+                f"Socket timeout after {request.timeout} seconds.\n"
+            )
+            return subprocess.CompletedProcess(request.query, state, output, "")
+        except (OSError, ssl.SSLError, ValueError):
+            self.sessions.pop(key, None)
+            return None
+
+        response = parse_nrpe_response(b"".join(chunks), request.v2_only)
+        if response is None:
+            return None
+        result_code, output = response
+        return subprocess.CompletedProcess(request.query, result_code, output + "\n", "")
+
+
+NRPE_CLIENT = NrpeClient()
+
+
+def run_builtin_nrpe(command, timeout=None):
+    """Query the NRPE daemon of a check_nrpe command and return the result, or None.
+
+    None is returned for other commands and whenever check_nrpe has to be run to get
+    exactly its result, including when the wrapper's timeout is the shorter one.
+    """
+    request = parse_check_nrpe(command)
+    if request is None or (timeout is not None and timeout < request.timeout):
+        return None
+    return NRPE_CLIENT.query(request)
+
+
+def execute_command(command, cache=None, single_flight=None, run=None, **options):
+    """Execute the command and return the result.
+
+    The options are those of run_command(), which runs the command unless another
+    function taking the same arguments is given as run. With a cache, a fresh
+    result of the same command is returned instead of running it again, and with
+    single_flight, so is the result of an identical command already running.
+    """
+    command = strip_command_quotes(command)
+    run = run or run_command
+    if cache is not None:
+        result = cache.get(command, options=options)
+        if result is not None:
+            return result
+
+    if single_flight is not None:
+        return single_flight.run(command, lambda: run(command, **options), options)
+
+    result = run(command, **options)
+    if cache is not None:
+        cache.put(command, result, options)
+    return result
+
+
+def run_command(
+    command,
+    max_output_bytes=None,
+    max_stderr_bytes=None,
+    shell=True,
+    timeout=None,
+    keep_perfdata=False,
+    builtin_nrpe=False,
+):
+    """Run the command and return the result, exiting if it can not be run.
+
+    With max_output_bytes or max_stderr_bytes, the output is streamed into bounded
+    buffers instead of being read into memory in full. Without shell, the command
+    is run directly unless it uses shell syntax. With a timeout, the command and
+    its children are killed after that many seconds and the result is UNKNOWN,
+    with the perfdata read so far if keep_perfdata is set. With builtin_nrpe,
+    check_nrpe commands are answered by run_builtin_nrpe() where it can.
+    """
+    import subprocess  # pylint: disable=import-outside-toplevel
+
+    if builtin_nrpe and max_output_bytes is None and max_stderr_bytes is None:
+        result = run_builtin_nrpe(command, timeout)
+        if result is not None:
+            return result
+
+    try:
+        if max_output_bytes is not None or max_stderr_bytes is not None or timeout is not None:
+            result = stream_command(
+                command, max_output_bytes, max_stderr_bytes, shell, timeout, keep_perfdata
+            )
+        else:
+            args, popen_options = popen_arguments(command, shell)
+            result = subprocess.run(
+                args, capture_output=True, text=True, check=False, **popen_options
+            )
+    except FileNotFoundError:
+        sys.stderr.write(f"Error: Command not found: {command}\n")
+        sys.exit(127)
+    except Exception as e:  # pylint: disable=broad-except
+        # It's acceptable to have a broad except here
+        sys.stderr.write(f"Error: Failed to execute command: {str(e)}\n")
+        sys.exit(3)
+    return result
+
+
+def process_command_output(result):
+    """Process the command output and return stdout, stderr, and return code."""
+    if result.returncode > 2:
+        print(result.stdout)
+        sys.stderr.write(result.stderr)
+        sys.exit(result.returncode)
+    return result.stdout.strip(), result.stderr.strip(), result.returncode
+
+
+def extract_perfdata(stdout):
+    """Extract performance data from the command output."""
+    if "|" in stdout:
+        output, perfdata = stdout.split("|", 1)
+        perfdata = perfdata.strip()
+    else:
+        output, perfdata = stdout, ""
+    return output, perfdata
+
+
+def scan_perfdata(perfdata):
+    """Scan the performance data once and yield a tuple for every valid entry.
+
+    The tuples hold label, value, uom, warn, crit, min and max, with None for empty
+    fields. Tokens which are not valid entries are skipped.
+    """
+    for match in PERFDATA_TOKEN_PATTERN.finditer(perfdata):
+        if match.lastgroup != "other":
+            yield entry_from_match(match)
+
+
+def entry_from_match(match):
+    """Return label, value, uom, warn, crit, min and max of a matched perfdata entry."""
+    label, value, uom, warn, crit, min_val, max_val = match.group(
+        "label", "value", "uom", "warn", "crit", "min", "max"
+    )
+    return label, value, uom, warn or None, crit or None, min_val or None, max_val or None
+
+
+def split_perfdata(perfdata):
+    """Split the performance data into its entries, keeping quoted labels with spaces intact."""
+    return [match.group() for match in PERFDATA_TOKEN_PATTERN.finditer(perfdata)]
+
+
+def parse_perfdata(perfdata, perfdata_filter=None):
+    """Parse the performance data and return a list of dictionaries.
+
+    With a PerfdataFilter, the entries it drops are skipped without being parsed.
+    """
+    scan = scan_perfdata if perfdata_filter is None else perfdata_filter.scan
+    return [
+        {
+            "label": label,
+            "value": value,
+            "uom": uom,
+            "warn": warn,
+            "crit": crit,
+            "min": min_val,
+            "max": max_val,
+        }
+        for label, value, uom, warn, crit, min_val, max_val in scan(perfdata)
+    ]
+
+
+def perfdata_float(text):
+    """Return a perfdata field as a float, or None if it is empty or not a number."""
+    if not text:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def format_perfdata_float(number):
+    """Return the perfdata text of a float, or None for NaN."""
+    if number != number:  # pylint: disable=comparison-with-itself
+        return None
+    if number.is_integer() and abs(number) < 1e15:
+        return str(int(number))
+    return repr(number)
+
+
+class PerfdataEntry:
+    """A parsed perfdata entry, with its value, min and max converted to floats.
+
+    The text of the value, min and max is kept too, so that entries are written back
+    exactly as the plugin reported them. For compatibility, entries can also be read
+    like the dictionaries of parse_perfdata(), where entry["min"] is the text.
+    """
+
+    __slots__ = (
+        "label",
+        "uom",
+        "warn",
+        "crit",
+        "value",
+        "min",
+        "max",
+        "value_text",
+        "min_text",
+        "max_text",
+    )
+    FIELDS = ("label", "value", "uom", "warn", "crit", "min", "max")
+    TEXT_ATTRIBUTES = {"value": "value_text", "min": "min_text", "max": "max_text"}
+
+    def __init__(self, label, value, uom="", warn=None, crit=None, min_val=None, max_val=None):
+        self.label = label
+        self.uom = uom
+        self.warn = warn
+        self.crit = crit
+        self.value = float(value)
+        self.min = perfdata_float(min_val)
+        self.max = perfdata_float(max_val)
+        self.value_text = value
+        self.min_text = min_val
+        self.max_text = max_val
+
+    @classmethod
+    def from_dict(cls, entry):
+        """Return the entry for a dictionary returned by parse_perfdata()."""
+        return cls(
+            entry["label"],
+            entry["value"],
+            entry.get("uom") or "",
+            entry.get("warn"),
+            entry.get("crit"),
+            entry.get("min"),
+            entry.get("max"),
+        )
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, self.TEXT_ATTRIBUTES.get(key, key))
+
+    def get(self, key, default=None):
+        """Return the field like dict.get() on the entries of parse_perfdata()."""
+        return self[key] if key in self.FIELDS else default
+
+    def as_dict(self):
+        """Return the entry as a parse_perfdata() dictionary."""
+        return {field: self[field] for field in self.FIELDS}
+
+    def __eq__(self, other):
+        if not isinstance(other, PerfdataEntry):
+            return NotImplemented
+        return self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        return f"PerfdataEntry({', '.join(repr(self[field]) for field in self.FIELDS)})"
+
+
+class PerfdataColumns:
+    """Perfdata entries stored column by column, for batches of many entries.
+
+    Values, mins and maxes are arrays of doubles, with NaN for a missing min or max,
+    and the entries share their units. Iterating yields PerfdataEntry objects, so the
+    columns can be used wherever parsed entries are, though the numbers are written
+    back in their shortest form rather than as the plugin reported them.
+    """
+
+    def __init__(self):
+        from array import array  # pylint: disable=import-outside-toplevel
+
+        self.labels = []
+        self.uoms = []
+        self.warns = []
+        self.crits = []
+        self.values = array("d")
+        self.mins = array("d")
+        self.maxs = array("d")
+        self.shared_uoms = {}
+
+    @classmethod
+    def from_perfdata(cls, perfdata, perfdata_filter=None):
+        """Parse the performance data into columns, skipping the entries the filter drops."""
+        columns = cls()
+        scan = scan_perfdata if perfdata_filter is None else perfdata_filter.scan
+        for fields in scan(perfdata):
+            columns.append(*fields)
+        return columns
+
+    def append(self, label, value, uom="", warn=None, crit=None, min_val=None, max_val=None):
+        """Append an entry given as the text of its fields."""
+        nan = float("nan")
+        self.labels.append(label)
+        self.uoms.append(self.shared_uoms.setdefault(uom, uom))
+        self.warns.append(warn)
+        self.crits.append(crit)
+        self.values.append(float(value))
+        min_float, max_float = perfdata_float(min_val), perfdata_float(max_val)
+        self.mins.append(nan if min_float is None else min_float)
+        self.maxs.append(nan if max_float is None else max_float)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, i):
+        return PerfdataEntry(
+            self.labels[i],
+            format_perfdata_float(self.values[i]),
+            self.uoms[i],
+            self.warns[i],
+            self.crits[i],
+            format_perfdata_float(self.mins[i]),
+            format_perfdata_float(self.maxs[i]),
+        )
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self.labels)))
+
+
+def parse_perfdata_entries(perfdata, perfdata_filter=None):
+    """Parse the performance data and return a list of PerfdataEntry objects.
+
+    With a PerfdataFilter, the entries it drops are skipped without being parsed.
+    """
+    scan = scan_perfdata if perfdata_filter is None else perfdata_filter.scan
+    return [PerfdataEntry(*fields) for fields in scan(perfdata)]
+
+
+def as_perfdata_entries(parsed_perfdata):
+    """Return PerfdataEntry objects for entries parsed by any of the parse functions."""
+    if isinstance(parsed_perfdata, list) and (
+        not parsed_perfdata or isinstance(parsed_perfdata[0], PerfdataEntry)
+    ):
+        return parsed_perfdata
+    return [
+        PerfdataEntry.from_dict(entry) if isinstance(entry, dict) else entry
+        for entry in parsed_perfdata
+    ]
+
+
+def parse_perfdata_entry(entry):
+    """Parse a single performance data entry and return label, value, uom, warn, crit, min, max."""
+    match = PERFDATA_TOKEN_PATTERN.fullmatch(entry.strip())
+    if match is None or match.lastgroup == "other":
+        return None, None, None, None, None, None, None
+    return entry_from_match(match)
+
+
+def label_pattern(pattern):
+    """Return the regular expression for a label glob, or a regex prefixed with 're:'."""
+    if pattern.startswith("re:"):
+        return pattern[3:]
+
+    import fnmatch  # pylint: disable=import-outside-toplevel
+
+    return fnmatch.translate(pattern)
+
+
+class LabelPatterns:
+    """Label globs and 're:' regexes, matched in order against whole labels.
+
+    Each pattern is compiled on its own first, so an invalid one is reported by
+    itself. Runs of patterns without groups or global inline flags are then combined
+    into one regular expression with a named group per pattern, so a label is
+    matched against all of them in one pass. Other patterns keep an expression of
+    their own, as flags and group numbers would change meaning once combined.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = tuple(patterns)
+        self.regexes = []
+        run = []
+        for i, pattern in enumerate(self.patterns):
+            try:
+                regex = re.compile(label_pattern(pattern))
+            except re.error as e:
+                raise ValueError(f"Invalid label pattern {pattern!r}: {str(e)}") from None
+            if regex.groups or regex.flags != PLAIN_REGEX_FLAGS:
+                self.add_run(run)
+                run = []
+                self.regexes.append((regex, i))
+            else:
+                run.append((regex.pattern, i))
+        self.add_run(run)
+
+    def add_run(self, run):
+        """Add a regular expression combining a run of patterns, if there are any."""
+        if len(run) == 1:
+            self.regexes.append((re.compile(run[0][0]), run[0][1]))
+        elif run:
+            combined = "|".join(f"(?P<pattern{i}>{pattern})" for pattern, i in run)
+            try:
+                self.regexes.append((re.compile(combined), None))
+            except re.error as e:
+                raise ValueError(f"Invalid label patterns: {str(e)}") from None
+
+    def __eq__(self, other):
+        return isinstance(other, LabelPatterns) and self.patterns == other.patterns
+
+    def __hash__(self):
+        return hash(self.patterns)
+
+    def index(self, label):
+        """Return the index of the first pattern matching the whole label, or None."""
+        for regex, i in self.regexes:
+            match = regex.fullmatch(label)
+            if match is not None:
+                # Combined patterns have no groups of their own, so only theirs is set
+                return int(match.lastgroup[len("pattern") :]) if i is None else i
+        return None
+
+    def matches(self, label):
+        """Return True if any of the patterns matches the whole label."""
+        return self.index(label) is not None
+
+
+def parse_threshold_map_rule(rule):
+    """Return the label pattern and the warning, critical and static thresholds of a rule.
+
+    Raises ValueError if the rule is not of the form PATTERN=KEY=VALUE[,KEY=VALUE...].
+    """
+    match = THRESHOLD_MAP_RULE_PATTERN.fullmatch(rule)
+    if match is None:
+        raise ValueError("expected PATTERN=warning=...,critical=...,static=...")
+    pattern = match.group("pattern")
+
+    thresholds = {"warning": None, "critical": None, "static": []}
+    for item in match.group("thresholds").split(","):
+        key, _, value = item.partition("=")
+        if key not in thresholds or not value:
+            raise ValueError(f"invalid threshold {item!r}")
+        if key == "static":
+            if "=" not in value:
+                raise ValueError(f"static threshold {value!r} is not of the form postfix=value")
+            thresholds["static"].append(value)
+        else:
+            thresholds[key] = value
+    return pattern, (thresholds["warning"], thresholds["critical"], thresholds["static"])
+
+
+class ThresholdMap:
+    """Label patterns and their thresholds, compiled into LabelPatterns.
+
+    Most patterns end up in a single regular expression, so a label is matched
+    against all rules in one pass and the first matching rule wins.
+    """
+
+    def __init__(self, rules):
+        patterns, self.thresholds = [], []
+        for rule in rules:
+            try:
+                pattern, thresholds = parse_threshold_map_rule(rule)
+                LabelPatterns([pattern])
+            except ValueError as e:
+                raise ValueError(f"Invalid --threshold-map rule {rule!r}: {str(e)}") from None
+            patterns.append(pattern)
+            self.thresholds.append(thresholds)
+        self.rules = tuple(rules)
+        try:
+            self.patterns = LabelPatterns(patterns)
+        except ValueError as e:
+            raise ValueError(f"Invalid --threshold-map rules: {str(e)}") from None
+
+    def __eq__(self, other):
+        return isinstance(other, ThresholdMap) and self.rules == other.rules
+
+    def __hash__(self):
+        return hash(self.rules)
+
+    def lookup(self, label):
+        """Return the warning, critical and static thresholds for the label, or None."""
+        i = self.patterns.index(label)
+        return None if i is None else self.thresholds[i]
+
+
+def compile_threshold_map(rules):
+    """Return a ThresholdMap for the --threshold-map rules, or None if there are none.
+
+    Raises ValueError for an invalid rule.
+    """
+    if not rules or isinstance(rules, ThresholdMap):
+        return rules or None
+    if isinstance(rules, str):
+        rules = [rules]
+    return ThresholdMap(rules)
+
+
+def threshold_index_value(settings):
+    """Return the index value of the threshold settings."""
+    fields = []
+    for key in THRESHOLD_CONFIG_SETTINGS:
+        value = settings.get(key) or ""
+        if isinstance(value, list):
+            value = THRESHOLD_INDEX_LIST_SEPARATOR.join(value)
+        fields.append(value)
+    return "\0".join(fields).encode()
+
+
+def compile_threshold_config(config, index):
+    """Compile the threshold config file into the index file.
+
+    Every non-empty line that does not start with '#' must be a JSON object with
+    optional "host" and "service" keys, "*" by default, and the "warning",
+    "critical", "static" and "threshold_map" settings, of the types checked by
+    checked_settings(). The last line of a host and service wins. Raises ValueError
+    for an invalid line.
+    """
+    import json  # pylint: disable=import-outside-toplevel
+    import struct  # pylint: disable=import-outside-toplevel
+
+    stat = os.stat(config)
+    entries = {}
+    with open(config, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("not a JSON object")
+                record = checked_settings(record)
+                for key in ("host", "service"):
+                    if not isinstance(record.get(key, ""), str):
+                        raise ValueError(f"{key!r} must be a string")
+                settings = {
+                    key: record[key] for key in THRESHOLD_CONFIG_SETTINGS if record.get(key)
+                }
+                PerfdataProcessor(**settings)
+            except ValueError as e:
+                raise ValueError(f"Invalid line {number} in {config}: {str(e)}") from None
+            key = f"{record.get('host') or '*'}\0{record.get('service') or '*'}".encode()
+            entries[key] = threshold_index_value(settings)
+
+    keys = sorted(entries)
+    offset = 8 * (THRESHOLD_INDEX_HEADER_WORDS + THRESHOLD_INDEX_ENTRY_WORDS * len(keys))
+    table, data = [], []
+    for key in keys:
+        value = entries[key]
+        table += [offset, len(key), offset + len(key), len(value)]
+        data += [key, value]
+        offset += len(key) + len(value)
+
+    header = struct.pack("=8sQQQ", THRESHOLD_INDEX_MAGIC, stat.st_mtime_ns, stat.st_size, len(keys))
+    # Written under a temporary name and renamed, so that other checks never read a
+    # partly written index
+    temporary = f"{index}.{os.getpid()}.tmp"
+    data = header + struct.pack(f"={len(table)}Q", *table) + b"".join(data)
+    with open(temporary, "wb") as f:
+        # Padded to whole words, so that the index can be mapped as an array of them
+        f.write(data + bytes(-len(data) % 8))
+    os.replace(temporary, index)
+
+
+class ThresholdIndex:
+    """The compiled index of a threshold config file, looked up by binary search.
+
+    The index is memory-mapped, so a lookup only reads the O(log n) keys it compares
+    and the value it finds, however large the config.
+    """
+
+    def __init__(self, path):
+        import mmap  # pylint: disable=import-outside-toplevel
+
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self.map)
+        if (
+            size < 8 * THRESHOLD_INDEX_HEADER_WORDS
+            or size % 8
+            or self.map[:8] != THRESHOLD_INDEX_MAGIC
+        ):
+            self.map.close()
+            raise ValueError(f"{path} is not a threshold index")
+        self.words = memoryview(self.map).cast("Q")
+        self.mtime_ns, self.size, self.entries = self.words[1:THRESHOLD_INDEX_HEADER_WORDS]
+
+    def close(self):
+        """Unmap the index."""
+        self.words.release()
+        self.map.close()
+
+    def find(self, key):
+        """Return the value of the key, or None."""
+        words, low, high = self.words, 0, self.entries
+        while low < high:
+            middle = (low + high) // 2
+            entry = THRESHOLD_INDEX_HEADER_WORDS + middle * THRESHOLD_INDEX_ENTRY_WORDS
+            start = words[entry]
+            found = self.map[start : start + words[entry + 1]]
+            if found == key:
+                start = words[entry + 2]
+                return self.map[start : start + words[entry + 3]]
+            if found < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def lookup(self, host, service):
+        """Return the threshold settings of the host and service, or an empty dictionary.
+
+        The settings of the host and service are used if there are any, or else those
+        of the host for any service, any host for the service, or any host and service.
+        """
+        host, service = host or "*", service or "*"
+        for key in ((host, service), (host, "*"), ("*", service), ("*", "*")):
+            value = self.find("\0".join(key).encode())
+            if value is not None:
+                break
+        else:
+            return {}
+        settings = {}
+        fields = value.decode().split("\0")
+        for key, field in zip(THRESHOLD_CONFIG_SETTINGS, fields):
+            if field and key in ("static", "threshold_map"):
+                settings[key] = field.split(THRESHOLD_INDEX_LIST_SEPARATOR)
+            elif field:
+                settings[key] = field
+        return settings
+
+
+def fresh_threshold_index(index, stat):
+    """Return the ThresholdIndex if it was compiled from the config file with this stat, or None."""
+    try:
+        thresholds = ThresholdIndex(index)
+    except (OSError, ValueError):
+        return None
+    if (thresholds.mtime_ns, thresholds.size) == (stat.st_mtime_ns, stat.st_size):
+        return thresholds
+    thresholds.close()
+    return None
+
+
+def config_thresholds(config, host, service, index=None):
+    """Return the threshold settings of the host and service in the threshold config file.
+
+    The compiled index is used, and compiled again first if the config file's mtime
+    or size differ from those it was compiled from. Only one check compiles it, while
+    the others wait for it. Raises ValueError if the config can not be read or is
+    invalid.
+    """
+    import fcntl  # pylint: disable=import-outside-toplevel
+
+    index = index or default_threshold_index_path(config)
+    try:
+        stat = os.stat(config)
+        make_state_dir(os.path.dirname(index))
+        thresholds = fresh_threshold_index(index, stat)
+        if thresholds is None:
+            with open(f"{index}.lock", "a", encoding="utf-8") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # Another check may have compiled the index while this one waited
+                thresholds = fresh_threshold_index(index, stat)
+                if thresholds is None:
+                    compile_threshold_config(config, index)
+                    thresholds = ThresholdIndex(index)
+    except OSError as e:
+        raise ValueError(f"Cannot read threshold config: {str(e)}") from None
+    try:
+        return thresholds.lookup(host, service)
+    finally:
+        thresholds.close()
+
+
+def compile_label_patterns(patterns):
+    """Compile label globs and 're:' regexes into LabelPatterns, or None if there are none.
+
+    Raises ValueError for an invalid pattern.
+    """
+    if not patterns or isinstance(patterns, LabelPatterns):
+        return patterns or None
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return LabelPatterns(patterns)
+
+
+class PerfdataFilter:
+    """Keep the perfdata entries whose labels pass the include and exclude patterns.
+
+    With max_entries, entries are also dropped once keeping them and the thresholds
+    appended for them would take the output beyond max_entries entries. The filter
+    counts the entries it drops, so a new one is needed for every check.
+    """
+
+    def __init__(self, include=None, exclude=None, max_entries=None, derived_entries=None):
+        self.include = compile_label_patterns(include)
+        self.exclude = compile_label_patterns(exclude)
+        self.max_entries = max_entries
+        self.derived_entries = derived_entries or (lambda label: 0)
+        self.entries = 0
+        self.dropped = 0
+        self.kept = []
+
+    def keep(self, label):
+        """Return True if the entry with the (quoted) label is kept."""
+        label = label.replace("'", "")
+        if (self.include is not None and not self.include.matches(label)) or (
+            self.exclude is not None and self.exclude.matches(label)
+        ):
+            return False
+        if self.max_entries is not None:
+            entries = 1 + self.derived_entries(label)
+            if self.entries + entries > self.max_entries:
+                return False
+            self.entries += entries
+        return True
+
+    def scan(self, perfdata):
+        """Like scan_perfdata(), but skip the dropped entries and remember the kept ones."""
+        for match in PERFDATA_TOKEN_PATTERN.finditer(perfdata):
+            if match.lastgroup == "other":
+                self.kept.append(match.group())
+            elif self.keep(match.group("label")):
+                self.kept.append(match.group())
+                yield entry_from_match(match)
+            else:
+                self.dropped += 1
+
+    def perfdata(self):
+        """Return the kept perfdata, with a wrapper_dropped_entries metric if any were dropped."""
+        return " ".join(self.kept + self.wrapper_perfdata())
+
+    def wrapper_perfdata(self):
+        """Return the wrapper_dropped_entries metric if any entries were dropped."""
+        return [f"wrapper_dropped_entries={self.dropped}"] if self.dropped else []
+
+
+def derived_entry_count(warning, critical, static, split_ranges=False):
+    """Return the number of threshold entries appended for a label with these thresholds."""
+    return sum(
+        len(threshold_values(threshold, split_ranges))
+        for threshold in (warning, critical)
+        if threshold
+    ) + len(static or [])
+
+
+def derived_entry_counter(warning, critical, static, threshold_map=None, split_ranges=False):
+    """Return a function giving the number of threshold entries appended for a label."""
+    if threshold_map is None:
+        count = derived_entry_count(warning, critical, static, split_ranges)
+        return lambda label: count
+
+    def count_for_label(label):
+        thresholds = threshold_map.lookup(label)
+        if thresholds is None:
+            return 0
+        return derived_entry_count(*thresholds, split_ranges)
+
+    return count_for_label
+
+
+def parse_filtered_perfdata(perfdata, perfdata_filter=None):
+    """Parse the performance data and return the kept perfdata and its PerfdataEntry objects."""
+    perfdata_entries = parse_perfdata_entries(perfdata, perfdata_filter)
+    if perfdata_filter is not None:
+        perfdata = perfdata_filter.perfdata()
+    return perfdata, perfdata_entries
+
+
+class NagiosRange:
+    """A Nagios threshold range: 10, 10:, ~:10, 10:20 or @10:20."""
+
+    __slots__ = ("start", "end", "inside", "bounds")
+
+    def __init__(self, text):
+        self.inside = text.startswith("@")
+        start, colon, end = text[self.inside :].rpartition(":")
+        if not start and not end:
+            raise ValueError("empty range")
+        if not colon:
+            start = "0"
+        self.start = float("-inf") if start == "~" else float(start or 0)
+        self.end = float(end) if end else float("inf")
+        if self.start > self.end:
+            raise ValueError("start is greater than end")
+        # A plain number is emitted as it is, anything else as its finite start and end
+        if not colon and not self.inside:
+            self.bounds = [("", text)]
+        else:
+            self.bounds = [("_start", start or "0")] if start != "~" else []
+            if end:
+                self.bounds.append(("_end", end))
+
+    def alerts(self, value):
+        """Return True if the value is outside the range, or inside it for an @ range."""
+        return (self.start <= value <= self.end) == self.inside
+
+
+NAGIOS_RANGES = {}
+
+
+def nagios_range(text):
+    """Return the NagiosRange for the text, parsing every distinct range only once.
+
+    Raises ValueError for an invalid range.
+    """
+    parsed = NAGIOS_RANGES.get(text)
+    if parsed is None:
+        try:
+            parsed = NAGIOS_RANGES[text] = NagiosRange(text)
+        except ValueError as e:
+            raise ValueError(f"Invalid range {text!r}: {str(e)}") from None
+    return parsed
+
+
+def threshold_values(threshold, split_ranges=False):
+    """Return (label suffix, value) pairs of the metrics emitted for a threshold."""
+    if not split_ranges:
+        return [("", threshold)]
+    return nagios_range(threshold).bounds
+
+
+def check_ranges(warning, critical, threshold_map=None):
+    """Parse every warning and critical threshold as a range, raising ValueError if invalid."""
+    rules = [(warning, critical, None)]
+    if threshold_map is not None:
+        rules = threshold_map.thresholds
+    for rule in rules:
+        for threshold in rule[:2]:
+            if threshold:
+                nagios_range(threshold)
+
+
+def evaluate_perfdata(perfdata_entries, warning, critical, threshold_map=None):
+    """Return the worst state of the perfdata values: 0 OK, 1 WARNING or 2 CRITICAL.
+
+    A value is CRITICAL if it alerts against the critical range, otherwise WARNING if
+    it alerts against the warning range. Evaluation stops at the first CRITICAL value.
+    """
+    warning_range = nagios_range(warning) if warning else None
+    critical_range = nagios_range(critical) if critical else None
+    state = 0
+    for entry in as_perfdata_entries(perfdata_entries):
+        if threshold_map is not None:
+            thresholds = threshold_map.lookup(entry.label.replace("'", ""))
+            if thresholds is None:
+                continue
+            warning_range = nagios_range(thresholds[0]) if thresholds[0] else None
+            critical_range = nagios_range(thresholds[1]) if thresholds[1] else None
+        value = entry.value
+        if critical_range is not None and critical_range.alerts(value):
+            return 2
+        if warning_range is not None and warning_range.alerts(value):
+            state = 1
+    return state
+
+
+def derived_perfdata_entries(
+    parsed_perfdata,
+    warning,
+    critical,
+    static=[],
+    threshold_map=None,
+    split_ranges=False,
+):
+    """Return the threshold entries appended for the parsed entries, as dictionaries.
+
+    The parsed entries may be the dictionaries of parse_perfdata(), PerfdataEntry
+    objects or PerfdataColumns.
+
+    With a threshold map the thresholds of each label come from its first matching
+    rule instead, and labels matching no rule get none. With split_ranges, thresholds
+    that are not plain numbers are returned as their _start and _end values.
+    """
+    derived_entries = []
+    for entry in as_perfdata_entries(parsed_perfdata):
+        label = entry.label.replace("'", "")
+        if threshold_map is not None:
+            thresholds = threshold_map.lookup(label)
+            if thresholds is None:
+                continue
+            warning, critical, static = thresholds
+        fields = {
+            "uom": entry.uom,
+            "warn": None,
+            "crit": None,
+            "min": entry.min_text,
+            "max": entry.max_text,
+        }
+
+        if warning:
+            for suffix, value in threshold_values(warning, split_ranges):
+                derived_entries.append(
+                    dict(label=f"{label}_warning_threshold{suffix}", value=value, **fields)
+                )
+
+        if critical:
+            for suffix, value in threshold_values(critical, split_ranges):
+                derived_entries.append(
+                    dict(label=f"{label}_critical_threshold{suffix}", value=value, **fields)
+                )
+
+        if static:
+            for s in static:
+                label_postfix, value = s.split("=")
+                derived_entries.append(
+                    dict(label=f"{label}_{label_postfix}", value=value, **fields)
+                )
+
+    return derived_entries
+
+
+def format_derived_entry(entry):
+    """Return the perfdata string of a derived threshold entry."""
+    min_str = f";{entry['min']}" if entry["min"] else ";"
+    max_str = f";{entry['max']}" if entry["max"] else ";"
+    return f"'{entry['label']}'={entry['value']}{entry['uom']};;{min_str}{max_str}".strip(";")
+
+
+def append_thresholds_to_perfdata(
+    perfdata,
+    parsed_perfdata,
+    warning,
+    critical,
+    static=[],
+    threshold_map=None,
+    split_ranges=False,
+):
+    """Append warning and critical thresholds to the performance data.
+
+    The thresholds are those of derived_perfdata_entries(), which takes the same
+    arguments.
+    """
+    if not warning and not critical and not static and threshold_map is None:
+        return perfdata
+
+    perfdata_strings = split_perfdata(perfdata)
+    perfdata_strings.extend(
+        format_derived_entry(entry)
+        for entry in derived_perfdata_entries(
+            parsed_perfdata, warning, critical, static, threshold_map, split_ranges
+        )
+    )
+    return " ".join(sorted(perfdata_strings))
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def output_template(
+    schema, extra_labels, warning, critical, static=(), threshold_map=None, split_ranges=False
+):
+    """Return the output template for perfdata with the label schema and thresholds, or None.
+
+    The schema holds the label, uom, min and max text of every entry, and the extra
+    labels those of the wrapper's own metrics. The template is the sorted output with
+    the derived entries filled in and None in place of the entries and extra metrics,
+    together with the place of each of them. As output is sorted by label, the places
+    hold for any values, unless one label is a prefix of another up to its "=", in
+    which case None is returned. Results are kept in an LRU cache; see cache_info().
+    """
+    entries = [
+        PerfdataEntry(label, "0", uom, None, None, min_text, max_text)
+        for label, uom, min_text, max_text in schema
+    ]
+    derived = [
+        format_derived_entry(entry)
+        for entry in derived_perfdata_entries(
+            entries, warning, critical, list(static), threshold_map, split_ranges
+        )
+    ]
+    keys = [f"{label}=" for label in [entry[0] for entry in schema] + list(extra_labels)]
+    keys += [text[: text.index("'=") + 2] for text in derived]
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    if any(keys[order[i + 1]].startswith(keys[order[i]]) for i in range(len(order) - 1)):
+        return None
+
+    template, places = [None] * len(keys), [0] * (len(keys) - len(derived))
+    for place, i in enumerate(order):
+        if i < len(places):
+            places[i] = place
+        else:
+            template[place] = derived[i - len(places)]
+    return template, places
+
+
+def append_thresholds_from_template(
+    perfdata_strings,
+    parsed_perfdata,
+    extra_perfdata,
+    warning,
+    critical,
+    static=[],
+    threshold_map=None,
+    split_ranges=False,
+):
+    """Like append_thresholds_to_perfdata(), but fill in a cached output template.
+
+    The perfdata strings are the entries of the perfdata and the extra perfdata the
+    wrapper's own metrics, which are sorted in with them. None is returned when there
+    is no template, e.g. when some strings are not valid perfdata entries.
+    """
+    if not warning and not critical and not static and threshold_map is None:
+        return None
+    if len(perfdata_strings) != len(parsed_perfdata):
+        return None
+    schema = tuple(
+        (entry.label, entry.uom, entry.min_text, entry.max_text)
+        for entry in as_perfdata_entries(parsed_perfdata)
+    )
+    extra_labels = tuple(text.partition("=")[0] for text in extra_perfdata)
+    template = output_template(
+        schema, extra_labels, warning, critical, tuple(static or ()), threshold_map, split_ranges
+    )
+    if template is None:
+        return None
+
+    output, places = template
+    output = output.copy()
+    for place, text in zip(places, perfdata_strings + extra_perfdata):
+        output[place] = text
+    return " ".join(output)
+
+
+def perfdata_number(text):
+    """Return a perfdata field as an int or float, None if it is empty, or else the text."""
+    if not text:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def json_result(output, perfdata_entries, returncode):
+    """Return the check result as a JSON object."""
+    import json  # pylint: disable=import-outside-toplevel
+
+    return json.dumps(
+        {
+            "output": output,
+            "returncode": returncode,
+            "perfdata": [
+                {
+                    "label": entry["label"].replace("'", ""),
+                    "value": perfdata_number(entry["value"]),
+                    "uom": entry["uom"],
+                    "warn": entry["warn"],
+                    "crit": entry["crit"],
+                    "min": perfdata_number(entry["min"]),
+                    "max": perfdata_number(entry["max"]),
+                }
+                for entry in perfdata_entries
+            ],
+        }
+    )
+
+
+def openmetrics_label_value(text):
+    """Escape a label value for the OpenMetrics text format."""
+    return text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def openmetrics_result(perfdata_entries, returncode):
+    """Return the check result as OpenMetrics text, with a perfdata gauge per entry.
+
+    Entries whose value is not a number, like threshold ranges, are left out.
+    """
+    lines = ["# TYPE perfdata gauge", "# HELP perfdata Plugin perfdata and appended thresholds"]
+    for entry in perfdata_entries:
+        value = perfdata_number(entry["value"])
+        if not isinstance(value, (int, float)):
+            continue
+        label = openmetrics_label_value(entry["label"].replace("'", ""))
+        labels = f'label="{label}"'
+        if entry["uom"]:
+            labels += f',uom="{openmetrics_label_value(entry["uom"])}"'
+        lines.append(f"perfdata{{{labels}}} {value}")
+    lines += [
+        "# TYPE check_return_code gauge",
+        "# HELP check_return_code Exit code of the check",
+        f"check_return_code {returncode}",
+        "# EOF",
+    ]
+    return "\n".join(lines)
+
+
+def structured_result(output_format, output, perfdata_entries, returncode):
+    """Return the check result in the JSON or OpenMetrics output format."""
+    if output_format == "json":
+        return json_result(output, perfdata_entries, returncode)
+    return openmetrics_result(perfdata_entries, returncode)
+
+
+def command_starts_with_an_opsview_path(command):
+    """Return True if the command is a path in the Opsview monitoring scripts directory."""
+    return command.strip("'\"").startswith("/opt/opsview/monitoringscripts/")
+
+
+def command_error(command, shell=True):
+    """Return an error message if the command may not be run, None otherwise."""
+    argv = None if shell else command_argv(strip_command_quotes(command))
+    if not command_starts_with_an_opsview_path(command) or (
+        argv is not None and not command_starts_with_an_opsview_path(argv[0])
+    ):
+        return (
+            "Error: Command MUST start with a path in the /opt/opsview/monitoringscripts directory"
+        )
+    return None
+
+
+def exit_if_command_does_not_start_with_an_opsview_path(command, shell=True):
+    """Validate that the command is a valid path to a plugin, as command_error() does."""
+    error = command_error(command, shell)
+    if error:
+        sys.stderr.write(error + "\n")
+        sys.exit(3)
+
+
+def exit_if_executable_is_not_an_opsview_path(command):
+    """Validate that the executable run without a shell is a valid path to a plugin."""
+    exit_if_command_does_not_start_with_an_opsview_path(command, shell=False)
+
+
+def processor_options(args):
+    """Return the settings of the PerfdataProcessor given on the command line.
+
+    Without thresholds on the command line, those of the host and service in the
+    --threshold-config are used, raising ValueError if it can not be read.
+    """
+    thresholds = {key: getattr(args, key) for key in THRESHOLD_CONFIG_SETTINGS}
+    if args.threshold_config and args.command and not any(thresholds.values()):
+        thresholds.update(config_thresholds(args.threshold_config, args.host, args.service))
+    options = {
+        **thresholds,
+        "include": args.include,
+        "exclude": args.exclude,
+        "max_entries": args.max_entries,
+        "evaluate": args.evaluate,
+        "output_format": args.output_format,
+        "self_metrics": args.self_metrics,
+    }
+    # Services sharing a command, but not their host and service, keep their state in
+    # separate files. The history of values only depends on the labels kept, while
+    # the threshold entries of the suppression state depend on all the settings.
+    labels = (args.host, args.service, args.include, args.exclude)
+    check = (args.host, args.service, *options.values())
+    return {
+        **options,
+        "baseline_file": baseline_path(args.baseline, args.command, args.baseline_window, labels),
+        "baseline_window": args.baseline_window,
+        "baseline_deviations": args.baseline_deviations,
+        "suppression_file": suppression_path(args.suppress_unchanged, args.command, check),
+        "heartbeat": args.heartbeat,
+    }
+
+
+def command_options(args):
+    """Return the options for running the command given on the command line."""
+    return {
+        "max_output_bytes": args.max_output_bytes,
+        "max_stderr_bytes": args.max_stderr_bytes,
+        "shell": not args.no_shell,
+        "timeout": args.timeout,
+        "keep_perfdata": args.timeout_keep_perfdata,
+        "builtin_nrpe": args.builtin_nrpe,
+    }
+
+
+def threshold_error(warning, critical, static, threshold_map=None, baseline=False):
+    """Return an error message if the thresholds are missing or conflicting, None otherwise."""
+    if threshold_map is not None:
+        if warning or critical or static:
+            return "--threshold-map cannot be combined with --warning, --critical or --static"
+        return None
+    if not warning and not critical and not static and not baseline:
+        return "--static, --warning, or --critical must be provided"
+    return None
+
+
+def child_usage():
+    """Return the resource usage of the finished children of the process, or None."""
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+class SelfMetrics:
+    """Time the phases of a check and report them, with the command's resource usage.
+
+    Each lap() costs a single clock read, so timing every check is cheap enough to
+    do whether or not the metrics are reported.
+
+    The resource usage of children adds up over the life of the process, so
+    children selects what is reported: "total" for a process running a single
+    check, "delta" for the CPU time since the metrics were created, when the
+    process runs one command at a time (the maximum RSS cannot be taken apart like
+    that), and None when checks run concurrently and their usage cannot be told
+    apart.
+    """
+
+    def __init__(self, started, clock, children="total"):
+        self.started = self.last = started
+        self.clock = clock
+        self.timings = []
+        self.children = children
+        self.usage_before = child_usage() if children == "delta" else None
+
+    def lap(self, phase):
+        """Record the time since the previous lap as the duration of the phase."""
+        now = self.clock()
+        self.timings.append((phase, now - self.last))
+        self.last = now
+
+    def perfdata(self):
+        """Return the timings and the resource usage of the command as wrapper_* perfdata."""
+        entries = [f"wrapper_{phase}={seconds:.6f}s" for phase, seconds in self.timings]
+        entries.append(f"wrapper_total={self.last - self.started:.6f}s")
+        usage = child_usage() if self.children else None
+        if usage is None:
+            return " ".join(entries)
+
+        user_cpu, system_cpu = usage.ru_utime, usage.ru_stime
+        if self.usage_before is not None:
+            user_cpu -= self.usage_before.ru_utime
+            system_cpu -= self.usage_before.ru_stime
+        entries += [
+            f"wrapper_child_user_cpu={user_cpu:.6f}s",
+            f"wrapper_child_system_cpu={system_cpu:.6f}s",
+        ]
+        if self.children == "total":
+            # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+            max_rss = usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+            entries.append(f"wrapper_child_max_rss={max_rss}KB")
+        return " ".join(entries)
+
+
+def stats_bucket(seconds):
+    """Return the index of the histogram bucket counting the duration."""
+    if seconds <= STATS_BUCKET_BASE:
+        return 0
+    import math  # pylint: disable=import-outside-toplevel
+
+    return min(STATS_BUCKETS - 1, math.ceil(2 * math.log2(seconds / STATS_BUCKET_BASE)))
+
+
+def histogram_percentile(counts, fraction):
+    """Return the upper bound in seconds of the bucket holding the given fraction of counts."""
+    threshold = fraction * sum(counts)
+    total = 0
+    for i, count in enumerate(counts):
+        total += count
+        if count and total >= threshold:
+            return STATS_BUCKET_BASE * 2 ** (i / 2)
+    return None
+
+
+class StatsFile:
+    """Per-plugin histograms of the phase timings and return codes of checks.
+
+    The histograms are 64-bit counters in a memory-mapped file shared by every wrapper
+    process, and are incremented in place without locking. Two processes incrementing
+    the same counter at the same instant can lose one of the increments, which is
+    acceptable for these statistics. Only claiming the slot of a new plugin takes a
+    lock, which happens once per plugin.
+    """
+
+    def __init__(self, path):
+        import mmap  # pylint: disable=import-outside-toplevel
+
+        make_state_dir(os.path.dirname(path))
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            size = os.fstat(self.fd).st_size
+            if size == 0:
+                os.ftruncate(self.fd, STATS_FILE_SIZE)
+            elif size != STATS_FILE_SIZE:
+                raise ValueError(f"{path} is not a stats file")
+            self.map = mmap.mmap(self.fd, STATS_FILE_SIZE)
+        except BaseException:
+            os.close(self.fd)
+            raise
+        self.words = memoryview(self.map).cast("Q")
+        if self.map[:8] == bytes(8):
+            self.words[1] = STATS_SLOTS
+            self.map[:8] = STATS_MAGIC
+        if self.map[:8] != STATS_MAGIC or self.words[1] != STATS_SLOTS:
+            self.close()
+            raise ValueError(f"{path} is not a stats file")
+
+    def close(self):
+        """Unmap and close the file."""
+        self.words.release()
+        self.map.close()
+        os.close(self.fd)
+
+    @staticmethod
+    def key(name):
+        """Return the non-zero 64-bit key of the plugin name."""
+        import hashlib  # pylint: disable=import-outside-toplevel
+
+        return int.from_bytes(hashlib.blake2b(name, digest_size=8).digest(), "little") or 1
+
+    def slot(self, name, create=False):
+        """Return the index of the first word of the plugin's slot, or None."""
+        name = name.encode()[: 8 * STATS_NAME_WORDS]
+        key = self.key(name)
+        for probe in range(STATS_SLOTS):
+            base = STATS_HEADER_WORDS + (key + probe) % STATS_SLOTS * STATS_SLOT_WORDS
+            if self.words[base] == key:
+                return base
+            if self.words[base] == 0:
+                if not create:
+                    return None
+                base = self.claim(base, key, name)
+                if base is not None:
+                    return base
+        return None
+
+    def claim(self, base, key, name):
+        """Claim the empty slot for the plugin and return it, or None if it was taken."""
+        import fcntl  # pylint: disable=import-outside-toplevel
+
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if self.words[base] == 0:
+                start = 8 * (base + 1)
+                self.map[start : start + len(name)] = name
+                # The key is written last, so that a slot with a key always has a name
+                self.words[base] = key
+            return base if self.words[base] == key else None
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def record(self, name, timings, returncode):
+        """Count the return code and the phase timings of a check of the plugin."""
+        base = self.slot(name, create=True)
+        if base is None:
+            return
+        words = self.words
+        words[base + STATS_COUNTERS_OFFSET + min(max(returncode, 0), 3)] += 1
+        for phase, seconds in timings:
+            if phase in STATS_PHASES:
+                histogram = (
+                    base + STATS_HISTOGRAMS_OFFSET + STATS_PHASES.index(phase) * STATS_BUCKETS
+                )
+                words[histogram + stats_bucket(seconds)] += 1
+
+    def plugins(self):
+        """Return the name, return code counts and phase histograms of every plugin."""
+        plugins = []
+        for slot in range(STATS_SLOTS):
+            base = STATS_HEADER_WORDS + slot * STATS_SLOT_WORDS
+            if self.words[base] == 0:
+                continue
+            name = self.map[8 * (base + 1) : 8 * (base + STATS_COUNTERS_OFFSET)]
+            counters = self.words[base + STATS_COUNTERS_OFFSET : base + STATS_HISTOGRAMS_OFFSET]
+            histograms = {}
+            for i, phase in enumerate(STATS_PHASES):
+                start = base + STATS_HISTOGRAMS_OFFSET + i * STATS_BUCKETS
+                histograms[phase] = self.words[start : start + STATS_BUCKETS].tolist()
+            plugins.append(
+                (name.rstrip(b"\0").decode(errors="replace"), counters.tolist(), histograms)
+            )
+        return sorted(plugins)
+
+
+def plugin_name(command):
+    """Return the plugin executable of the command, which stats are recorded under."""
+    words = strip_command_quotes(command or "").split(None, 1)
+    return words[0] if words else ""
+
+
+def record_stats(path, command, metrics, code):
+    """Record the check in the stats file, ignoring any error so the check is unaffected."""
+    returncode = code if isinstance(code, int) else 0 if code is None else 3
+    timings = metrics.timings + [("total", metrics.clock() - metrics.started)]
+    try:
+        stats = StatsFile(path)
+    except (OSError, ValueError):
+        return
+    try:
+        stats.record(plugin_name(command), timings, returncode)
+    finally:
+        stats.close()
+
+
+def print_stats(path):
+    """Print the percentiles of the phase timings of every plugin and return the exit code."""
+    if not os.path.exists(path):
+        sys.stderr.write(f"Error: Cannot read stats: {path} does not exist\n")
+        return 3
+    try:
+        stats = StatsFile(path)
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"Error: Cannot read stats: {str(e)}\n")
+        return 3
+    try:
+        plugins = stats.plugins()
+    finally:
+        stats.close()
+
+    for name, counters, histograms in plugins:
+        print(
+            f"{name}: {sum(counters)} checks, "
+            + ", ".join(f"{count} {state}" for state, count in zip(STATS_RETURN_CODES, counters))
+        )
+        print(f"  {'phase':<24} {'count':>8} {'p50':>10} {'p95':>10} {'p99':>10}")
+        for phase, counts in histograms.items():
+            if not any(counts):
+                continue
+            percentiles = [histogram_percentile(counts, p) for p in (0.5, 0.95, 0.99)]
+            print(
+                f"  {phase:<24} {sum(counts):>8} "
+                + " ".join(f"{f'{seconds:.6f}s':>10}" for seconds in percentiles)
+            )
+    return 0
+
+
+class BaselineFile:
+    """The rolling mean and standard deviation of the recent values of each label of a check.
+
+    The last window values of every label are kept in a ring buffer in a memory-mapped
+    file, with their running sum and sum of squares, so adding a value and reading
+    the baseline take constant time whatever the window. The sums are recomputed
+    from the ring buffer every time it wraps around, so rounding errors do not build
+    up. The file is locked while it is open, so each check should have its own.
+    """
+
+    def __init__(self, path, window=DEFAULT_BASELINE_WINDOW):
+        import fcntl  # pylint: disable=import-outside-toplevel
+        import mmap  # pylint: disable=import-outside-toplevel
+
+        self.window = window
+        self.slot_words = BASELINE_VALUES_OFFSET + window
+        size = 8 * (BASELINE_HEADER_WORDS + BASELINE_SLOTS * self.slot_words)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            file_size = os.fstat(self.fd).st_size
+            if file_size == 0:
+                os.ftruncate(self.fd, size)
+            elif file_size != size:
+                raise ValueError(f"{path} is not a baseline file of {window} values")
+            self.map = mmap.mmap(self.fd, size)
+        except BaseException:
+            os.close(self.fd)
+            raise
+        self.words = memoryview(self.map).cast("Q")
+        self.floats = memoryview(self.map).cast("d")
+        if self.map[:8] == bytes(8):
+            self.words[1], self.words[2] = BASELINE_SLOTS, window
+            self.map[:8] = BASELINE_MAGIC
+        if self.map[:8] != BASELINE_MAGIC or tuple(self.words[1:3]) != (BASELINE_SLOTS, window):
+            self.close()
+            raise ValueError(f"{path} is not a baseline file of {window} values")
+
+    def close(self):
+        """Unmap, unlock and close the file."""
+        self.words.release()
+        self.floats.release()
+        self.map.close()
+        os.close(self.fd)
+
+    def slot(self, label):
+        """Return the index of the first word of the label's slot, or None if all are taken."""
+        key = StatsFile.key(label.encode())
+        for probe in range(BASELINE_SLOTS):
+            base = BASELINE_HEADER_WORDS + (key + probe) % BASELINE_SLOTS * self.slot_words
+            if self.words[base] == 0:
+                self.words[base] = key
+            if self.words[base] == key:
+                return base
+        return None
+
+    def add(self, label, value):
+        """Add the value of the label and return the mean and standard deviation before it.
+
+        None is returned while there are fewer than BASELINE_MIN_SAMPLES earlier values,
+        and for labels that do not fit in the file.
+        """
+        base = self.slot(label)
+        if base is None:
+            return None
+        words, floats = self.words, self.floats
+        count, position = words[base + 1], words[base + 2]
+        total, squares = floats[base + 3], floats[base + 4]
+        baseline = None
+        if count >= BASELINE_MIN_SAMPLES:
+            mean = total / count
+            baseline = mean, max(squares / count - mean * mean, 0.0) ** 0.5
+
+        values = base + BASELINE_VALUES_OFFSET
+        if count == self.window:
+            old = floats[values + position]
+            total, squares = total - old, squares - old * old
+        else:
+            count += 1
+        floats[values + position] = value
+        position = (position + 1) % self.window
+        if position == 0:
+            recent = floats[values : values + count]
+            total, squares = sum(recent), sum(x * x for x in recent)
+        else:
+            total, squares = total + value, squares + value * value
+        words[base + 1], words[base + 2] = count, position
+        floats[base + 3], floats[base + 4] = total, squares
+        return baseline
+
+
+def command_digest(command, settings=()):
+    """Return a digest of the command and settings, naming the files that keep its state."""
+    import hashlib  # pylint: disable=import-outside-toplevel
+
+    key = "\0".join([strip_command_quotes(command)] + [repr(setting) for setting in settings])
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def baseline_path(directory, command, window=DEFAULT_BASELINE_WINDOW, settings=()):
+    """Return the path of the baseline file of the check in the directory, or None.
+
+    The check is the command with the settings that change the values recorded,
+    such as the host, service and label filters, so that services sharing a command
+    do not add their values to the same baseline. Other settings, such as the
+    thresholds, can change without starting a new baseline.
+    """
+    if not directory or not command:
+        return None
+    return os.path.join(directory, f"{command_digest(command, settings)}-{window}.baseline")
+
+
+def baseline_perfdata_entries(parsed_perfdata, path, window, deviations):
+    """Add the values to the baseline file and return the baseline entries, as dictionaries.
+
+    Every label with enough history gets a _baseline entry with the mean of its
+    recent values and an _upper_band entry that many standard deviations above it.
+    Any error with the file is ignored, so the check is unaffected.
+    """
+    derived_entries = []
+    try:
+        make_state_dir(os.path.dirname(path))
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        baseline = BaselineFile(path, window)
+    except (OSError, ValueError):
+        return derived_entries
+    infinity = float("inf")
+    try:
+        for entry in as_perfdata_entries(parsed_perfdata):
+            if abs(entry.value) == infinity:
+                continue
+            label = entry.label.replace("'", "")
+            mean_deviation = baseline.add(label, entry.value)
+            if mean_deviation is None:
+                continue
+            mean, deviation = mean_deviation
+            fields = {
+                "uom": entry.uom,
+                "warn": None,
+                "crit": None,
+                "min": entry.min_text,
+                "max": entry.max_text,
+            }
+            for postfix, value in (
+                ("baseline", mean),
+                ("upper_band", mean + deviations * deviation),
+            ):
+                derived_entries.append(
+                    dict(
+                        label=f"{label}_{postfix}",
+                        value=format_perfdata_float(round(value, 6)),
+                        **fields,
+                    )
+                )
+    finally:
+        baseline.close()
+    return derived_entries
+
+
+def suppression_path(directory, command, settings=()):
+    """Return the path of the suppression file of the check in the directory, or None.
+
+    The check is the command with its settings, as any of them may change the
+    threshold entries.
+    """
+    if not directory or not command:
+        return None
+    return os.path.join(directory, f"{command_digest(command, settings)}.suppression")
+
+
+def changed_derived_entries(derived_entries, path, heartbeat, now=None):
+    """Return the derived entries to emit, those that changed since they were last emitted.
+
+    An entry is emitted when its label, value, uom, min or max differ from every
+    entry of the last run, or when it was last emitted heartbeat seconds ago. The
+    file is updated with the entries of this run. If it can not be written, every
+    entry is emitted, so that none is lost.
+    """
+    import time  # pylint: disable=import-outside-toplevel
+
+    now = time.time() if now is None else now
+    emitted = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                emitted_at, _, text = line.rstrip("\n").partition("\t")
+                emitted[text] = float(emitted_at)
+    except (OSError, ValueError):
+        emitted = {}
+
+    changed, state = [], {}
+    for entry in derived_entries:
+        text = format_derived_entry(entry)
+        emitted_at = emitted.get(text)
+        # A clock set back also emits the entry, rather than suppressing it for long
+        if emitted_at is None or not 0 <= now - emitted_at < heartbeat:
+            changed.append(entry)
+            emitted_at = now
+        state[text] = emitted_at
+    if not changed and state == emitted:
+        return changed
+
+    try:
+        make_state_dir(os.path.dirname(path))
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        # Written under a temporary name and renamed, so that a check killed while
+        # writing never leaves a partial file to suppress entries with
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.writelines(f"{emitted_at!r}\t{text}\n" for text, emitted_at in state.items())
+        os.replace(temporary, path)
+    except OSError:
+        return derived_entries
+    return changed
+
+
+CheckResult = namedtuple("CheckResult", ["stdout", "stderr", "returncode"])
+
+
+class PerfdataProcessor:
+    """Apply thresholds to the results of a plugin, configured once for any number of them.
+
+    The settings are validated and compiled when the processor is created, raising
+    ValueError if they are invalid. Without a baseline_file or suppression_file,
+    process() keeps no state between calls, so a single processor can be shared by
+    every check with the same settings. Both files hold the history of one check,
+    which each call reads and updates, so a processor given either of them must
+    only process the results of that check.
+
+    With cache_templates, the Nagios output is filled into templates cached by
+    output_template(), which pays off when the same checks are processed over and
+    over, as in the server and manifest modes.
+
+    With a suppression_file, the threshold entries are only appended when they
+    changed since the last run of the check, or every heartbeat seconds, as
+    changed_derived_entries() keeps track of in the file.
+    """
+
+    def __init__(
+        self,
+        warning=None,
+        critical=None,
+        static=None,
+        threshold_map=None,
+        include=None,
+        exclude=None,
+        max_entries=None,
+        evaluate=False,
+        output_format="nagios",
+        self_metrics=False,
+        cache_templates=False,
+        baseline_file=None,
+        baseline_window=DEFAULT_BASELINE_WINDOW,
+        baseline_deviations=DEFAULT_BASELINE_DEVIATIONS,
+        suppression_file=None,
+        heartbeat=DEFAULT_HEARTBEAT,
+    ):
+        if isinstance(static, str):
+            static = [static]
+        self.threshold_map = compile_threshold_map(threshold_map)
+        error = threshold_error(warning, critical, static, self.threshold_map, baseline_file)
+        if error:
+            raise ValueError(error)
+        if baseline_window < 1:
+            raise ValueError("--baseline-window must be at least 1")
+        if heartbeat < 0:
+            raise ValueError("--heartbeat must be at least 0")
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Invalid output format {output_format!r}")
+        if max_entries is not None and max_entries < 1:
+            raise ValueError("--max-entries must be at least 1")
+        if evaluate:
+            check_ranges(warning, critical, self.threshold_map)
+
+        self.warning, self.critical, self.static = warning, critical, static or []
+        self.include = compile_label_patterns(include)
+        self.exclude = compile_label_patterns(exclude)
+        self.max_entries = max_entries
+        self.filtering = (
+            self.include is not None or self.exclude is not None or max_entries is not None
+        )
+        self.derived_entries = derived_entry_counter(
+            warning, critical, self.static, self.threshold_map, evaluate
+        )
+        if baseline_file is not None:
+            thresholds_per_label = self.derived_entries
+            self.derived_entries = lambda label: thresholds_per_label(label) + 2
+        self.evaluate = bool(evaluate)
+        self.output_format = output_format
+        self.self_metrics = self_metrics
+        self.cache_templates = cache_templates
+        self.baseline_file = baseline_file
+        self.baseline_window = baseline_window
+        self.baseline_deviations = baseline_deviations
+        self.suppression_file = suppression_file
+        self.heartbeat = heartbeat
+
+    def process(self, stdout, stderr, returncode, metrics=None):
+        """Apply the thresholds to the output of a plugin and return a CheckResult.
+
+        The result holds what the wrapper prints to stdout and stderr, and its exit
+        code. With a SelfMetrics, the time taken by each phase is recorded in it.
+        """
+        lap = metrics.lap if metrics is not None else lambda phase: None
+        structured = self.output_format != "nagios"
+        if returncode > 2:
+            if structured:
+                stdout = structured_result(self.output_format, stdout.strip(), [], returncode)
+            return CheckResult(stdout + "\n", stderr, returncode)
+
+        stdout, stderr = stdout.strip(), stderr.strip()
+        output, perfdata = extract_perfdata(stdout)
+        lap("process_command_output")
+        if not perfdata:
+            return CheckResult(
+                structured_result(self.output_format, stdout, [], 3) + "\n" if structured else "",
+                f"Error: No performance data found. Got the following output:\n{stdout}\n",
+                3,
+            )
+
+        perfdata_filter = None
+        if self.filtering:
+            perfdata_filter = PerfdataFilter(
+                self.include, self.exclude, self.max_entries, self.derived_entries
+            )
+        perfdata, perfdata_entries = parse_filtered_perfdata(perfdata, perfdata_filter)
+        lap("parse_perfdata")
+
+        if self.evaluate:
+            returncode = max(
+                returncode,
+                evaluate_perfdata(
+                    perfdata_entries, self.warning, self.critical, self.threshold_map
+                ),
+            )
+            lap("evaluate_perfdata")
+
+        baseline_entries = []
+        if self.baseline_file is not None:
+            baseline_entries = baseline_perfdata_entries(
+                perfdata_entries,
+                self.baseline_file,
+                self.baseline_window,
+                self.baseline_deviations,
+            )
+            lap("update_baseline")
+
+        thresholds = (self.warning, self.critical, self.static, self.threshold_map, self.evaluate)
+        self_metrics = self.self_metrics and metrics is not None
+        if structured:
+            derived_entries = derived_perfdata_entries(perfdata_entries, *thresholds)
+            if self.suppression_file is not None:
+                derived_entries = changed_derived_entries(
+                    derived_entries, self.suppression_file, self.heartbeat
+                )
+            perfdata_entries += derived_entries
+            perfdata_entries += baseline_entries
+            lap("append_thresholds")
+            wrapper_perfdata = perfdata_filter.wrapper_perfdata() if perfdata_filter else []
+            if self_metrics:
+                wrapper_perfdata.append(metrics.perfdata())
+            perfdata_entries += parse_perfdata(" ".join(wrapper_perfdata))
+            output = structured_result(
+                self.output_format, output.strip(), perfdata_entries, returncode
+            )
+        else:
+            if baseline_entries:
+                perfdata = " ".join(
+                    [perfdata] + [format_derived_entry(e) for e in baseline_entries]
+                )
+            updated_perfdata = None
+            if self.suppression_file is not None:
+                derived_entries = changed_derived_entries(
+                    derived_perfdata_entries(perfdata_entries, *thresholds),
+                    self.suppression_file,
+                    self.heartbeat,
+                )
+                updated_perfdata = " ".join(
+                    sorted(
+                        split_perfdata(perfdata)
+                        + [format_derived_entry(e) for e in derived_entries]
+                    )
+                )
+            elif self.cache_templates and not baseline_entries:
+                updated_perfdata = append_thresholds_from_template(
+                    perfdata_filter.kept if perfdata_filter else split_perfdata(perfdata),
+                    perfdata_entries,
+                    perfdata_filter.wrapper_perfdata() if perfdata_filter else [],
+                    *thresholds,
+                )
+            if updated_perfdata is None:
+                updated_perfdata = append_thresholds_to_perfdata(
+                    perfdata, perfdata_entries, *thresholds
+                )
+            lap("append_thresholds")
+            if self_metrics:
+                updated_perfdata = f"{updated_perfdata} {metrics.perfdata()}"
+            if updated_perfdata:
+                output = f"{output}| {updated_perfdata}"
+        return CheckResult(output + "\n", stderr + "\n" if stderr else "", returncode)
+
+
+def render_check_result(stdout, stderr, returncode, warning, critical, static=None, **settings):
+    """Apply the thresholds to a finished command and return the stdout, stderr and exit code.
+
+    The settings are those of PerfdataProcessor. To process many results with the
+    same settings, create the processor once instead.
+    """
+    return PerfdataProcessor(warning, critical, static, **settings).process(
+        stdout, stderr, returncode
+    )
+
+
+async def read_stream_async(stream, sink):
+    """Feed everything read from the stream into the sink."""
+    while True:
+        chunk = await stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            return
+        sink.feed(chunk)
+
+
+async def kill_process_group_async(process, grace=None):
+    """Send SIGTERM to the process group, and SIGKILL to whatever is left after grace seconds."""
+    import asyncio  # pylint: disable=import-outside-toplevel
+    import signal  # pylint: disable=import-outside-toplevel
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (TIMEOUT_KILL_GRACE if grace is None else grace)
+    for signum in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, signum)
+        except ProcessLookupError:
+            return
+        while loop.time() < deadline:
+            try:
+                os.killpg(process.pid, 0)
+            except ProcessLookupError:
+                return
+            await asyncio.sleep(0.01)
+
+
+async def run_command_async(
+    command,
+    max_output_bytes=None,
+    max_stderr_bytes=None,
+    shell=True,
+    timeout=None,
+    keep_perfdata=False,
+    builtin_nrpe=False,
+    env=None,
+    cwd=None,
+):
+    """Run the command in a subprocess without blocking the event loop.
+
+    Takes the same options as run_command(), and the environment and working
+    directory to run the command with, by default those of this process.
+    """
+    import asyncio  # pylint: disable=import-outside-toplevel
+
+    command = strip_command_quotes(command)
+    if builtin_nrpe and max_output_bytes is None and max_stderr_bytes is None:
+        result = await asyncio.to_thread(run_builtin_nrpe, command, timeout)
+        if result is not None:
+            return result.stdout, result.stderr, result.returncode
+    args, popen_options = popen_arguments(command, shell)
+    popen_options.update(start_new_session=timeout is not None, env=env, cwd=cwd)
+    pipes = {"stdout": asyncio.subprocess.PIPE, "stderr": asyncio.subprocess.PIPE}
+    if popen_options.pop("shell"):
+        process = await asyncio.create_subprocess_shell(args, **pipes, **popen_options)
+    else:
+        try:
+            process = await asyncio.create_subprocess_exec(*args, **pipes, **popen_options)
+        except FileNotFoundError:
+            return "", f"Error: Command not found: {command}\n", 127
+    if max_output_bytes is None and max_stderr_bytes is None and timeout is None:
+        stdout, stderr = await process.communicate()
+        return (
+            stdout.decode(errors="replace"),
+            stderr.decode(errors="replace"),
+            process.returncode,
+        )
+
+    stdout, stderr = output_buffers(max_output_bytes, max_stderr_bytes)
+    started = asyncio.get_running_loop().time()
+    try:
+        # Waiting for the command to exit is within the timeout too, as it may close
+        # its output and keep running
+        _, _, returncode = await asyncio.wait_for(
+            asyncio.gather(
+                read_stream_async(process.stdout, stdout),
+                read_stream_async(process.stderr, stderr),
+                process.wait(),
+            ),
+            timeout,
+        )
+    except asyncio.TimeoutError:
+        await kill_process_group_async(process)
+        await process.wait()
+        result = timed_out_result(
+            command,
+            timeout,
+            asyncio.get_running_loop().time() - started,
+            stdout.getvalue(),
+            stderr.getvalue(),
+            keep_perfdata,
+        )
+        return result.stdout, result.stderr, result.returncode
+    return stdout.getvalue(), stderr.getvalue(), returncode
+
+
+def checked_settings(record):
+    """Return the record with the types of its settings checked against SETTING_TYPES.
+
+    Numeric thresholds are turned into strings and single strings into lists, as
+    they would be given on the command line. Raises ValueError for a setting of the
+    wrong type.
+    """
+    checked = dict(record)
+    for key, value in record.items():
+        expected = SETTING_TYPES.get(key)
+        if value is None or expected is None:
+            continue
+        if expected == "a string or a number" and type(value) in (int, float):
+            value = checked[key] = str(value)
+        elif expected == "a string or a list of strings" and isinstance(value, str):
+            value = checked[key] = [value]
+        if expected == "an integer":
+            valid = type(value) is int
+        elif expected == "true or false":
+            valid = isinstance(value, bool)
+        elif expected == "a string or a list of strings" and isinstance(value, list):
+            valid = all(isinstance(item, str) for item in value)
+        else:
+            valid = isinstance(value, str)
+        if not valid:
+            raise ValueError(f"{key!r} must be {expected}")
+    return checked
+
+
+def read_manifest(path, defaults):
+    """Read the manifest file and return a list of check records.
+
+    Each non-empty line that does not start with '#' must be a JSON object with a
+    "command" key and optional "id", "warning", "critical", "static", "threshold_map",
+    "include", "exclude", "max_entries", "evaluate" and "output_format" keys. Missing
+    keys fall back to the options given on the command line. A record with a value
+    of the wrong type gets an error instead, reported as its result.
+    """
+    import json  # pylint: disable=import-outside-toplevel
+
+    records = []
+    with open(path, encoding="utf-8") as manifest:
+        for line_number, line in enumerate(manifest, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            record = dict(defaults, id=line_number)
+            try:
+                entry = json.loads(line)
+                if not isinstance(entry, dict):
+                    raise ValueError("record is not a JSON object")
+                entry = checked_settings(entry)
+            except ValueError as e:
+                record["error"] = f"Error: Invalid manifest record on line {line_number}: {e}"
+            else:
+                record.update({key: value for key, value in entry.items() if value is not None})
+            records.append(record)
+    return records
+
+
+async def run_manifest_record(record, semaphore, options):
+    """Run a single manifest record and return its result record."""
+    result = {"id": record["id"], "command": record.get("command")}
+    settings = {key: record[key] for key in MANIFEST_SETTINGS if record.get(key) is not None}
+
+    if "error" in record:
+        error = record["error"]
+    elif not record.get("command"):
+        error = "Error: --command must be provided"
+    else:
+        try:
+            processor = PerfdataProcessor(cache_templates=True, **settings)
+        except ValueError as e:
+            error = f"Error: {str(e)}"
+        else:
+            error = command_error(record["command"], options["shell"])
+
+    if error:
+        result.update(stdout="", stderr=error + "\n", returncode=3)
+        return result
+
+    async with semaphore:
+        try:
+            stdout, stderr, returncode = await run_command_async(record["command"], **options)
+        except Exception as e:  # pylint: disable=broad-except
+            # One failing check must not take down the rest of the batch
+            result.update(
+                stdout="", stderr=f"Error: Failed to execute command: {str(e)}\n", returncode=3
+            )
+            return result
+
+    stdout, stderr, returncode = processor.process(stdout, stderr, returncode)
+    result.update(stdout=stdout, stderr=stderr, returncode=returncode)
+    return result
+
+
+async def run_manifest_records(records, concurrency, options, out):
+    """Run all manifest records concurrently and write one JSON result per line."""
+    import asyncio  # pylint: disable=import-outside-toplevel
+    import json  # pylint: disable=import-outside-toplevel
+
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [run_manifest_record(record, semaphore, options) for record in records]
+    for task in asyncio.as_completed(tasks):
+        out.write(json.dumps(await task) + "\n")
+        out.flush()
+
+
+def run_manifest(args):
+    """Run every check in the manifest and return the exit code of the batch."""
+    import asyncio  # pylint: disable=import-outside-toplevel
+
+    if args.concurrency < 1:
+        sys.stderr.write("Error: --concurrency must be at least 1\n")
+        return 3
+
+    defaults = {
+        key: value for key, value in processor_options(args).items() if key in MANIFEST_SETTINGS
+    }
+    try:
+        records = read_manifest(args.manifest, defaults)
+    except OSError as e:
+        sys.stderr.write(f"Error: Cannot read manifest: {str(e)}\n")
+        return 3
+
+    asyncio.run(run_manifest_records(records, args.concurrency, command_options(args), sys.stdout))
+    return 0
+
+
+async def execute_command_async(args, options):
+    """Run the command given in the arguments like run_check() does, without blocking.
+
+    With --cache-ttl or --single-flight-wait, execute_command() looks up and stores
+    the result from a worker thread, while the command still runs on the event loop.
+    """
+    import asyncio  # pylint: disable=import-outside-toplevel
+    import subprocess  # pylint: disable=import-outside-toplevel
+
+    if args.cache_ttl is None and args.single_flight_wait is None:
+        return await run_command_async(args.command, **options)
+    loop = asyncio.get_running_loop()
+
+    def run_on_loop(command, **options):
+        future = asyncio.run_coroutine_threadsafe(run_command_async(command, **options), loop)
+        stdout, stderr, returncode = future.result()
+        return subprocess.CompletedProcess(command, returncode, stdout, stderr)
+
+    def execute():
+        # The cache is opened in the worker thread, as SQLite connections must stay
+        # in the thread that opened them
+        cache = open_result_cache(args)
+        result = execute_command(
+            args.command, cache, open_single_flight(args, cache), run_on_loop, **options
+        )
+        return result.stdout, result.stderr, result.returncode
+
+    return await asyncio.to_thread(execute)
+
+
+async def run_check_argv_async(argv, env=None, cwd=None):
+    """Run a check for the given command line arguments and return stdout, stderr and exit code.
+
+    This is what main() does for a single check, without touching the process' own
+    streams or exiting, so that many checks can be served from one process. With the
+    environment and working directory of a client, the command runs with them, and
+    relative paths given as options are relative to the working directory.
+    """
+    import contextlib  # pylint: disable=import-outside-toplevel
+    import io  # pylint: disable=import-outside-toplevel
+    from time import perf_counter  # pylint: disable=import-outside-toplevel
+
+    # Checks are served concurrently, so the usage of their commands cannot be told apart
+    metrics = SelfMetrics(perf_counter(), perf_counter, children=None)
+    stdout, stderr = io.StringIO(), io.StringIO()
+    try:
+        # No await happens while the streams are redirected, so other requests
+        # served by the same event loop can not write into them.
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            args = parse_arguments(argv)
+    except SystemExit as e:
+        return stdout.getvalue(), stderr.getvalue(), e.code or 0
+    metrics.lap("parse_arguments")
+
+    if not args.command:
+        return "", "Error: Only --command checks can be run through the server\n", 3
+    if cwd is not None:
+        for key in PATH_OPTIONS:
+            if getattr(args, key):
+                setattr(args, key, os.path.join(cwd, getattr(args, key)))
+
+    result = await run_check_async(args, metrics, env, cwd)
+    if args.stats_file is not None:
+        record_stats(args.stats_file, args.command, metrics, result[2])
+    return result
+
+
+async def run_check_async(args, metrics, env=None, cwd=None):
+    """Run the check given in the parsed arguments and return stdout, stderr and exit code."""
+    try:
+        processor = PerfdataProcessor(cache_templates=True, **processor_options(args))
+    except ValueError as e:
+        return "", f"Error: {str(e)}\n", 3
+    options = command_options(args)
+    error = command_error(args.command, options["shell"])
+    if error:
+        return "", error + "\n", 3
+    if env is not None or cwd is not None:
+        options.update(env=env, cwd=cwd)
+
+    try:
+        stdout, stderr, returncode = await execute_command_async(args, options)
+    except Exception as e:  # pylint: disable=broad-except
+        # It's acceptable to have a broad except here
+        return "", f"Error: Failed to execute command: {str(e)}\n", 3
+    metrics.lap("execute_command")
+    return processor.process(stdout, stderr, returncode, metrics)
+
+
+async def handle_client(reader, writer):
+    """Answer a single client request of the form {"argv": [...], "env": {...}, "cwd": "..."}.
+
+    The environment and working directory are optional, and those of the server are
+    used without them.
+    """
+    import json  # pylint: disable=import-outside-toplevel
+
+    try:
+        request = json.loads(await reader.readline())
+        env, cwd = request.get("env"), request.get("cwd")
+        stdout, stderr, returncode = await run_check_argv_async(
+            [str(arg) for arg in request["argv"]],
+            None if env is None else {str(key): str(value) for key, value in sorted(env.items())},
+            None if cwd is None else str(cwd),
+        )
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        stdout, stderr, returncode = "", f"Error: Invalid request: {str(e)}\n", 3
+    try:
+        writer.write(
+            json.dumps({"stdout": stdout, "stderr": stderr, "returncode": returncode}).encode()
+            + b"\n"
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def remove_stale_socket(path):
+    """Remove a socket file left behind by a server that is no longer running."""
+    import socket  # pylint: disable=import-outside-toplevel
+
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+    else:
+        raise OSError(f"Another server is already listening on {path}")
+    finally:
+        probe.close()
+
+
+async def serve(path, ready=None):
+    """Serve check requests on the Unix socket until SIGTERM or SIGINT."""
+    import asyncio  # pylint: disable=import-outside-toplevel
+    import contextlib  # pylint: disable=import-outside-toplevel
+    import signal  # pylint: disable=import-outside-toplevel
+
+    make_state_dir(os.path.dirname(os.path.abspath(path)))
+    remove_stale_socket(path)
+    old_umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(handle_client, path=path)
+    finally:
+        os.umask(old_umask)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        with contextlib.suppress(ValueError, RuntimeError):
+            # Signal handlers can only be installed from the main thread
+            loop.add_signal_handler(signum, stop.set)
+    if ready is not None:
+        ready(stop)
+    try:
+        async with server:
+            await stop.wait()
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+
+
+def run_server(args):
+    """Run the check server and return its exit code."""
+    import asyncio  # pylint: disable=import-outside-toplevel
+
+    try:
+        asyncio.run(serve(args.serve))
+    except OSError as e:
+        sys.stderr.write(f"Error: Cannot serve on {args.serve}: {str(e)}\n")
+        return 3
+    return 0
+
+
+def unescape_check_result_value(value):
+    """Undo the escaping of newlines and backslashes in a check result file value."""
+    return CHECK_RESULT_ESCAPE_PATTERN.sub(
+        lambda match: "\n" if match.group(1) == "n" else match.group(1), value
+    )
+
+
+def escape_check_result_value(value):
+    """Escape backslashes and newlines for a check result file value."""
+    return value.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def rewrite_check_result(text, processor):
+    """Apply the processor to the output in a Nagios check result file and return the new file.
+
+    The output and return_code lines are replaced and every other line is kept.
+    Results without perfdata are returned unchanged. With a structured output format,
+    the result is returned in that format instead.
+    """
+    lines = text.split("\n")
+    fields = {}
+    for i, line in enumerate(lines):
+        key = line.partition("=")[0]
+        if key in ("output", "return_code"):
+            fields[key] = i
+    if "output" not in fields:
+        return text
+
+    output = unescape_check_result_value(lines[fields["output"]][len("output=") :])
+    try:
+        returncode = int(lines[fields["return_code"]][len("return_code=") :])
+    except (KeyError, ValueError):
+        returncode = 0
+    if not extract_perfdata(output)[1]:
+        return text
+
+    stdout, _, returncode = processor.process(output, "", returncode)
+    if processor.output_format != "nagios":
+        return stdout
+    lines[fields["output"]] = "output=" + escape_check_result_value(stdout[:-1])
+    if "return_code" in fields:
+        lines[fields["return_code"]] = f"return_code={returncode}"
+    return "\n".join(lines)
+
+
+def spool_files(path):
+    """Return the names of the complete files in the spool directory, skipping hidden ones.
+
+    A check result file is complete once its .ok marker file exists.
+    """
+    with os.scandir(path) as entries:
+        names = {
+            entry.name
+            for entry in entries
+            if not entry.name.startswith(".") and entry.is_file(follow_symlinks=False)
+        }
+    return sorted(
+        name[: -len(SPOOL_MARKER_SUFFIX)]
+        for name in names
+        if name.endswith(SPOOL_MARKER_SUFFIX) and name[: -len(SPOOL_MARKER_SUFFIX)] in names
+    )
+
+
+def inotify_watch(path):
+    """Return an inotify descriptor for files written or moved into the directory, or None.
+
+    inotify is called through ctypes, so None is returned where it is not available.
+    """
+    import ctypes  # pylint: disable=import-outside-toplevel
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class SpoolWatcher:
+    """Report the names of the complete files arriving in the spool directory.
+
+    The first call of files() lists the directory. After that, inotify events for
+    .ok marker files are read, falling back to listing the directory every poll
+    interval where inotify is not available, or again after the kernel's event queue
+    overflowed.
+    """
+
+    def __init__(self, path, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.fd = inotify_watch(path)
+        self.rescan = True
+
+    def files(self, timeout=None):
+        """Return the names of the new files, waiting up to timeout seconds for any."""
+        import select  # pylint: disable=import-outside-toplevel
+        import struct  # pylint: disable=import-outside-toplevel
+        import time  # pylint: disable=import-outside-toplevel
+
+        timeout = self.poll_interval if timeout is None else timeout
+        if self.fd is None:
+            if not self.rescan:
+                time.sleep(timeout)
+            self.rescan = False
+            return spool_files(self.path)
+        if self.rescan:
+            self.rescan = False
+            return spool_files(self.path)
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        names, offset = [], 0
+        while offset < len(data):
+            _, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = os.fsdecode(
+                data[offset + INOTIFY_EVENT_SIZE : offset + INOTIFY_EVENT_SIZE + length].rstrip(
+                    b"\0"
+                )
+            )
+            offset += INOTIFY_EVENT_SIZE + length
+            if mask & IN_Q_OVERFLOW:
+                self.rescan = True
+            elif (
+                name.endswith(SPOOL_MARKER_SUFFIX)
+                and not name.startswith(".")
+                and not mask & IN_ISDIR
+            ):
+                names.append(name[: -len(SPOOL_MARKER_SUFFIX)])
+        return names
+
+    def close(self):
+        """Stop watching the directory."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def recover_spool_claims(path):
+    """Move the files claimed by spool workers that are gone back into the spool directory.
+
+    Every worker claims files by renaming them into its own .claimed.PID directory,
+    so a worker that died leaves its unfinished files there. The .ok marker files are
+    moved last, so the check result files are complete when they are seen.
+    """
+    with os.scandir(path) as entries:
+        claims = [entry.path for entry in entries if entry.name.startswith(".claimed.")]
+    for claim in claims:
+        try:
+            os.kill(int(claim.rsplit(".", 1)[1]), 0)
+            continue
+        except (ProcessLookupError, ValueError):
+            pass
+        except PermissionError:
+            continue
+        names = sorted(os.listdir(claim), key=lambda name: name.endswith(SPOOL_MARKER_SUFFIX))
+        for name in names:
+            os.rename(os.path.join(claim, name), os.path.join(path, name))
+        os.rmdir(claim)
+
+
+class SpoolWorker:
+    """Claim spool files, apply the thresholds to them and write them to the output directory.
+
+    One worker runs in each process of the pool, set up by init_spool_worker().
+    """
+
+    instance = None
+
+    def __init__(self, settings, spool, output):
+        self.processor = PerfdataProcessor(cache_templates=True, **settings)
+        self.spool = spool
+        self.output = output
+        self.claim = os.path.join(spool, f".claimed.{os.getpid()}")
+        os.makedirs(self.claim, exist_ok=True)
+
+    def process(self, names):
+        """Process the named files and return the number processed and the errors."""
+        processed, errors = 0, []
+        for name in names:
+            claimed = os.path.join(self.claim, name)
+            marker = name + SPOOL_MARKER_SUFFIX
+            try:
+                # Renaming is atomic, so only one worker (of any spool process) gets the file
+                os.rename(os.path.join(self.spool, name), claimed)
+            except FileNotFoundError:
+                continue
+            try:
+                os.rename(os.path.join(self.spool, marker), os.path.join(self.claim, marker))
+                with open(claimed, "rb") as f:
+                    text = f.read().decode("utf-8", "surrogateescape")
+                data = rewrite_check_result(text, self.processor).encode("utf-8", "surrogateescape")
+                # Written under a hidden name and renamed, so readers of the output
+                # directory only ever see complete files
+                temporary = os.path.join(self.output, f".{name}.tmp")
+                with open(temporary, "wb") as f:
+                    f.write(data)
+                os.replace(temporary, os.path.join(self.output, name))
+                # The marker follows the rewritten file, for readers of the output directory
+                os.replace(os.path.join(self.claim, marker), os.path.join(self.output, marker))
+                os.unlink(claimed)
+            except OSError as e:
+                errors.append(f"Error: Cannot process spool file {name}: {str(e)}")
+                continue
+            processed += 1
+        return processed, errors
+
+
+def init_spool_worker(settings, spool, output):
+    """Set up the SpoolWorker of a pool process."""
+    SpoolWorker.instance = SpoolWorker(settings, spool, output)
+
+
+def process_spool_files(names):
+    """Process the named spool files in a pool process."""
+    return SpoolWorker.instance.process(names)
+
+
+def spool_batches(names, workers):
+    """Split the names into batches, spreading them over the workers."""
+    size = max(1, min(SPOOL_BATCH_SIZE, -(-len(names) // workers)))
+    return [names[i : i + size] for i in range(0, len(names), size)]
+
+
+def run_spool(args):
+    """Process the check result files arriving in the spool directory and return the exit code."""
+    import concurrent.futures  # pylint: disable=import-outside-toplevel
+    import signal  # pylint: disable=import-outside-toplevel
+
+    workers = args.workers or os.cpu_count() or 1
+    settings = processor_options(args)
+    del settings["self_metrics"]
+    try:
+        PerfdataProcessor(**settings)
+    except ValueError as e:
+        sys.stderr.write(f"Error: {str(e)}\n")
+        return 3
+    if not args.spool_output:
+        sys.stderr.write("Error: --spool-output must be provided with --spool\n")
+        return 3
+    if workers < 1:
+        sys.stderr.write("Error: --workers must be at least 1\n")
+        return 3
+
+    try:
+        os.makedirs(args.spool_output, exist_ok=True)
+        recover_spool_claims(args.spool)
+        watcher = SpoolWatcher(args.spool, args.poll_interval)
+    except OSError as e:
+        sys.stderr.write(f"Error: Cannot use spool directory: {str(e)}\n")
+        return 3
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    pending, futures = set(), {}
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            workers,
+            initializer=init_spool_worker,
+            initargs=(settings, args.spool, args.spool_output),
+        ) as pool:
+            while True:
+                names = [
+                    name for name in watcher.files(0.05 if futures else None) if name not in pending
+                ]
+                for batch in spool_batches(names, workers):
+                    futures[pool.submit(process_spool_files, batch)] = batch
+                    pending.update(batch)
+                if args.once:
+                    concurrent.futures.wait(futures)
+                for future in [future for future in futures if future.done()]:
+                    pending.difference_update(futures.pop(future))
+                    for error in future.result()[1]:
+                        sys.stderr.write(error + "\n")
+                if args.once:
+                    break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    recover_spool_claims(args.spool)
+    return 0
+
+
+async def run_watch_tick(command, processor, options, frame, out):
+    """Run the command once for --watch and write its result as a JSON line."""
+    import json  # pylint: disable=import-outside-toplevel
+    import time  # pylint: disable=import-outside-toplevel
+
+    start = time.monotonic()
+    # Overlapping runs are skipped, so only this tick's command ran since
+    metrics = SelfMetrics(time.perf_counter(), time.perf_counter, children="delta")
+    try:
+        result = await run_command_async(command, **options)
+        metrics.lap("execute_command")
+        stdout, stderr, returncode = processor.process(*result, metrics)
+    except Exception as e:  # pylint: disable=broad-except
+        # It's acceptable to have a broad except here
+        stdout, stderr, returncode = "", f"Error: Failed to execute command: {str(e)}\n", 3
+    frame.update(
+        duration=round(time.monotonic() - start, 6),
+        stdout=stdout,
+        stderr=stderr,
+        returncode=returncode,
+    )
+    out.write(json.dumps(frame) + "\n")
+    out.flush()
+
+
+async def watch(command, processor, options, interval, out, count=None):
+    """Run the command every interval seconds until SIGTERM or SIGINT, or count runs.
+
+    Runs are scheduled at fixed offsets from the start on the monotonic clock, so
+    they do not drift. A run that is due while the previous one is still going is
+    skipped rather than queued, and so are runs missed because the process was not
+    scheduled for longer than the interval. Every result reports the runs skipped
+    before it, and the lag of its start behind the schedule.
+    """
+    import asyncio  # pylint: disable=import-outside-toplevel
+    import contextlib  # pylint: disable=import-outside-toplevel
+    import signal  # pylint: disable=import-outside-toplevel
+    import time  # pylint: disable=import-outside-toplevel
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        with contextlib.suppress(ValueError, RuntimeError):
+            # Signal handlers can only be installed from the main thread
+            loop.add_signal_handler(signum, stop.set)
+
+    start, tick, runs, skipped, running = loop.time(), 0, 0, 0, None
+    while count is None or runs < count:
+        scheduled = start + tick * interval
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stop.wait(), max(0, scheduled - loop.time()))
+        if stop.is_set():
+            break
+        missed = max(0, int((loop.time() - scheduled) // interval))
+        tick, skipped, scheduled = (
+            tick + missed + 1,
+            skipped + missed,
+            scheduled + missed * interval,
+        )
+        if running is not None and not running.done():
+            skipped += 1
+            continue
+        frame = {
+            "tick": tick - 1,
+            "time": time.time(),
+            "lag": round(loop.time() - scheduled, 6),
+            "skipped": skipped,
+        }
+        running = asyncio.create_task(run_watch_tick(command, processor, options, frame, out))
+        runs, skipped = runs + 1, 0
+    if running is not None:
+        await running
+
+
+def run_watch(args):
+    """Run the check given on the command line repeatedly and return the exit code."""
+    import asyncio  # pylint: disable=import-outside-toplevel
+
+    if not args.command:
+        sys.stderr.write("Error: --watch only works with --command\n")
+        return 3
+    if args.watch <= 0:
+        sys.stderr.write("Error: --watch must be greater than 0\n")
+        return 3
+    try:
+        processor = PerfdataProcessor(cache_templates=True, **processor_options(args))
+    except ValueError as e:
+        sys.stderr.write(f"Error: {str(e)}\n")
+        return 3
+    options = command_options(args)
+    error = command_error(args.command, options["shell"])
+    if error:
+        sys.stderr.write(error + "\n")
+        return 3
+
+    try:
+        out = open(args.watch_output, "w", encoding="utf-8") if args.watch_output else sys.stdout
+    except OSError as e:
+        sys.stderr.write(f"Error: Cannot open watch output: {str(e)}\n")
+        return 3
+    try:
+        asyncio.run(watch(args.command, processor, options, args.watch, out, args.watch_count))
+    except BrokenPipeError:
+        # The reader of the FIFO or pipe went away
+        pass
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+def main():
+    """Run the plugin command and append warning and critical thresholds (and/or a static value) as perfdata."""
+    from time import perf_counter  # pylint: disable=import-outside-toplevel
+
+    metrics = SelfMetrics(perf_counter(), perf_counter)
+    args = parse_arguments()
+    metrics.lap("parse_arguments")
+
+    if args.watch is not None:
+        sys.exit(run_watch(args))
+
+    if args.manifest:
+        sys.exit(run_manifest(args))
+
+    if args.serve:
+        sys.exit(run_server(args))
+
+    if args.spool:
+        sys.exit(run_spool(args))
+
+    if args.stats:
+        sys.exit(print_stats(args.stats))
+
+    try:
+        run_check(args, metrics)
+    except SystemExit as e:
+        if args.stats_file is not None:
+            record_stats(args.stats_file, args.command, metrics, e.code)
+        raise
+
+
+def run_check(args, metrics):
+    """Run the check given on the command line, print its result and exit."""
+    try:
+        processor = PerfdataProcessor(**processor_options(args))
+    except ValueError as e:
+        sys.stderr.write(f"Error: {str(e)}\n")
+        sys.exit(3)
+
+    exit_if_command_does_not_start_with_an_opsview_path(args.command, not args.no_shell)
+
+    cache = open_result_cache(args)
+    result = execute_command(
+        args.command,
+        cache=cache,
+        single_flight=open_single_flight(args, cache),
+        **command_options(args),
+    )
+    metrics.lap("execute_command")
+
+    stdout, stderr, returncode = processor.process(
+        result.stdout, result.stderr, result.returncode, metrics
+    )
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    sys.exit(returncode)
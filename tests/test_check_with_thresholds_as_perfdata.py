@@ -14,18 +14,73 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import json
 import os
+import socket
+import statistics
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
 from unittest.mock import patch, MagicMock
 from io import StringIO
+from types import SimpleNamespace
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from check_with_thresholds_as_perfdata import (
+import check_with_thresholds_as_perfdata_client as client
+from check_with_thresholds_as_perfdata_lib import (
+    BaselineFile,
+    MAX_PERFDATA_BYTES,
+    NagiosRange,
+    NrpeClient,
+    PerfdataColumns,
+    PerfdataEntry,
+    PerfdataFilter,
+    PerfdataProcessor,
+    PluginOutputReader,
+    ResultCache,
+    SelfMetrics,
+    SingleFlight,
+    SpoolWatcher,
+    StatsFile,
+    TailBuffer,
+    ThresholdIndex,
+    ThresholdMap,
+    command_argv,
+    compile_threshold_config,
+    config_thresholds,
+    default_cache_path,
+    default_socket_path,
+    default_threshold_index_path,
+    execute_command,
     main,
+    make_state_dir,
+    nrpe_packet,
+    parse_check_nrpe,
+    parse_common_arguments,
+    run_command_async,
+    serve,
     append_thresholds_to_perfdata,
+    baseline_path,
+    changed_derived_entries,
+    evaluate_perfdata,
+    histogram_percentile,
     parse_arguments,
     parse_perfdata,
+    parse_perfdata_entry,
+    parse_perfdata_entries,
+    private_runtime_dir,
+    output_template,
+    recover_spool_claims,
+    render_check_result,
+    rewrite_check_result,
+    run_builtin_nrpe,
+    spool_files,
+    suppression_path,
 )
 
 OK_OUTPUT = "OK - Disk space is sufficient | '/var'=55%;80;90;0;100"
@@ -70,6 +125,34 @@ TRIPLE_PART_CMD_LINE_ARGS = [
 ]
 
 
+def run_main(argv, stdout="", outputs=None, env=None):
+    """Run main() with argv and return its exit code, stdout and stderr.
+
+    The command prints stdout and exits with 0. In manifest mode, outputs maps each
+    command to the stdout, stderr and exit code it gives instead.
+    """
+
+    async def fake_run_command_async(command, **_limits):
+        return outputs[command]
+
+    with patch.dict(os.environ, env or {}), patch.object(
+        sys, "argv", ["script_name"] + argv
+    ), patch("sys.stdout", new_callable=StringIO) as mock_stdout, patch(
+        "sys.stderr", new_callable=StringIO
+    ) as mock_stderr, patch(
+        "subprocess.run", return_value=MagicMock(stdout=stdout, stderr="", returncode=0)
+    ), patch(
+        "check_with_thresholds_as_perfdata_lib.run_command_async", new=fake_run_command_async
+    ):
+        try:
+            main()
+        except SystemExit as e:
+            code = e.code
+        else:
+            raise AssertionError("main() did not exit")
+    return code, mock_stdout.getvalue(), mock_stderr.getvalue()
+
+
 class TestOpsviewPluginWrapper(unittest.TestCase):
 
     def test_append_thresholds_to_perfdata(self):
@@ -636,5 +719,1904 @@ class TestOpsviewPluginWrapper(unittest.TestCase):
         self.assertEqual(expected_output, mock_stderr.getvalue())
 
 
+class TestPerfdataScanner(unittest.TestCase):
+
+    def test_parse_quoted_labels_with_spaces(self):
+        self.assertEqual(
+            parse_perfdata("'C:\\ Label'=10GB;80;90 'it''s'=1"),
+            [
+                {
+                    "label": "'C:\\ Label'",
+                    "value": "10",
+                    "uom": "GB",
+                    "warn": "80",
+                    "crit": "90",
+                    "min": None,
+                    "max": None,
+                },
+                {
+                    "label": "'it''s'",
+                    "value": "1",
+                    "uom": "",
+                    "warn": None,
+                    "crit": None,
+                    "min": None,
+                    "max": None,
+                },
+            ],
+        )
+
+    def test_parse_negative_and_scientific_values(self):
+        self.assertEqual(
+            parse_perfdata_entry("temp=-1.5e3C;~:10;@-5:5;-273;"),
+            ("temp", "-1.5e3", "C", "~:10", "@-5:5", "-273", None),
+        )
+
+    def test_empty_threshold_fields_keep_their_position(self):
+        self.assertEqual(
+            parse_perfdata_entry("load=1.5;;4;0;8"), ("load", "1.5", "", None, "4", "0", "8")
+        )
+
+    def test_entries_the_split_parser_accepted_are_still_parsed(self):
+        self.assertEqual(
+            parse_perfdata_entry("c=3KB/s;80;90"), ("c", "3", "KB", "80", "90", None, None)
+        )
+        self.assertEqual(parse_perfdata_entry("h=10,5"), ("h", "10", "", None, None, None, None))
+        self.assertEqual(parse_perfdata_entry("x=a=5"), ("x=a", "5", "", None, None, None, None))
+        perfdata = "c=3KB/s h=10,5"
+        self.assertEqual(
+            append_thresholds_to_perfdata(perfdata, parse_perfdata(perfdata), "80", None),
+            "'c_warning_threshold'=80KB 'h_warning_threshold'=80 c=3KB/s h=10,5",
+        )
+
+    def test_invalid_entries_are_skipped_but_kept_in_output(self):
+        perfdata = "'C:\\ Label'=10GB;;;0;100 time=U junk"
+        perfdata_entries = parse_perfdata(perfdata)
+        self.assertEqual([entry["label"] for entry in perfdata_entries], ["'C:\\ Label'"])
+        self.assertEqual(
+            append_thresholds_to_perfdata(perfdata, perfdata_entries, "80", None),
+            "'C:\\ Label'=10GB;;;0;100 'C:\\ Label_warning_threshold'=80GB;;;0;100 junk time=U",
+        )
+
+
+class TestDirectExec(unittest.TestCase):
+
+    def test_plain_command_is_split_and_resolved(self):
+        self.assertEqual(
+            command_argv(
+                "/opt/opsview/monitoringscripts/plugins/check_nrpe -H host -a '-D -p /var'"
+            ),
+            ["/opt/opsview/monitoringscripts/plugins/check_nrpe", "-H", "host", "-a", "-D -p /var"],
+        )
+        self.assertEqual(command_argv("sh -c 'exit 1|2'")[1:], ["-c", "exit 1|2"])
+        self.assertTrue(os.path.isabs(command_argv("sh -c 'exit 1|2'")[0]))
+        self.assertEqual(
+            command_argv("/opt/opsview/monitoringscripts/../../../bin/sh")[0], "/bin/sh"
+        )
+
+    def test_hash_inside_a_word_is_kept(self):
+        self.assertEqual(
+            command_argv("/opt/opsview/plugin -a foo#bar 'a'#b")[1:], ["-a", "foo#bar", "a#b"]
+        )
+        with patch("os.posix_spawn", wraps=os.posix_spawn) as mock_posix_spawn:
+            result = execute_command("printf '%s' foo#bar", shell=False)
+        self.assertEqual(mock_posix_spawn.call_count, 1)
+        self.assertEqual(result.stdout, "foo#bar")
+
+    def test_shell_syntax_needs_the_shell(self):
+        for command in (
+            "/opt/opsview/plugin | head",
+            "/opt/opsview/plugin > /tmp/out",
+            "/opt/opsview/plugin && true",
+            "/opt/opsview/plugin -p /var/*",
+            "/opt/opsview/plugin -H $HOST",
+            "LANG=C /opt/opsview/plugin",
+            "/opt/opsview/plugin 'unbalanced",
+            "/opt/opsview/plugin -H host # comment",
+            "/opt/opsview/plugin -a #1",
+        ):
+            self.assertIsNone(command_argv(command), command)
+
+    def test_command_runs_without_shell(self):
+        with patch("os.posix_spawn", wraps=os.posix_spawn) as mock_posix_spawn:
+            result = execute_command("sh -c 'echo \"OK | a=1\"; exit 1'", shell=False)
+        self.assertEqual((result.stdout, result.returncode), ("OK | a=1\n", 1))
+        self.assertEqual(mock_posix_spawn.call_count, 1)
+        result = execute_command("sh -c 'echo OK' | tr O K", shell=False)
+        self.assertEqual(result.stdout, "KK\n")
+
+    @patch("sys.stderr", new_callable=StringIO)
+    @patch("subprocess.run")
+    def test_resolved_executable_must_be_an_opsview_path(self, mock_subprocess_run, mock_stderr):
+        test_args = [
+            "script_name",
+            "-w",
+            "80",
+            "--no-shell",
+            "-C",
+            "/opt/opsview/monitoringscripts/../../../bin/sh -c true",
+        ]
+        with patch.object(sys, "argv", test_args):
+            with self.assertRaises(SystemExit) as cm:
+                main()
+        self.assertEqual(cm.exception.code, 3)
+        self.assertIn("MUST start with a path", mock_stderr.getvalue())
+        mock_subprocess_run.assert_not_called()
+
+
+@patch("check_with_thresholds_as_perfdata_lib.TIMEOUT_KILL_GRACE", 0.2)
+class TestTimeout(unittest.TestCase):
+
+    def assertProcessGone(self, pid):
+        for _ in range(100):
+            try:
+                with open(f"/proc/{pid}/stat", encoding="utf-8") as stat:
+                    if stat.read().rpartition(")")[2].split()[0] == "Z":
+                        return
+            except FileNotFoundError:
+                return
+            time.sleep(0.01)
+        self.fail(f"process {pid} is still running")
+
+    def test_hung_command_is_killed_with_its_children(self):
+        started = time.monotonic()
+        result = execute_command(
+            'sleep 30 & echo "OK | child=$!"; wait', timeout=0.2, keep_perfdata=True
+        )
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(result.returncode, 3)
+        self.assertRegex(
+            result.stdout,
+            r"^UNKNOWN - Command timed out after 0.2 seconds "
+            r"and was killed after running for 0\.\d\d seconds \| child=\d+$",
+        )
+        self.assertProcessGone(int(result.stdout.rpartition("=")[2]))
+
+    def test_command_ignoring_sigterm_is_killed(self):
+        result = execute_command(
+            "trap '' TERM; echo 'OK | a=1;2 b=3'; printf 'c=4;'; sleep 30",
+            timeout=0.2,
+            keep_perfdata=True,
+        )
+        self.assertEqual(result.returncode, 3)
+        self.assertTrue(result.stdout.startswith("UNKNOWN - Command timed out after 0.2 seconds"))
+        self.assertTrue(result.stdout.endswith(" | a=1;2 b=3"))
+
+    def test_command_finishing_in_time_is_not_affected(self):
+        result = execute_command("echo 'OK | a=1'; echo err >&2; exit 1", timeout=5)
+        self.assertEqual(
+            (result.stdout, result.stderr, result.returncode), ("OK | a=1\n", "err\n", 1)
+        )
+
+    def test_command_closing_its_output_is_killed(self):
+        command = "echo 'OK | a=1'; exec >&- 2>&-; sleep 30"
+        started = time.monotonic()
+        result = execute_command(command, timeout=0.2, keep_perfdata=True)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(result.returncode, 3)
+        self.assertTrue(result.stdout.endswith("seconds | a=1"))
+        started = time.monotonic()
+        stdout, _, returncode = asyncio.run(
+            run_command_async(command, timeout=0.2, keep_perfdata=True)
+        )
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(returncode, 3)
+        self.assertTrue(stdout.endswith("seconds | a=1"))
+
+    def test_long_output_is_not_kept_as_perfdata(self):
+        result = execute_command(
+            "printf 'OK | a=1;2;3\\nStill checking /var\\n'; sleep 30",
+            timeout=0.2,
+            keep_perfdata=True,
+        )
+        self.assertEqual(result.returncode, 3)
+        self.assertTrue(result.stdout.endswith("seconds | a=1;2;3"))
+
+    def test_timeout_in_manifest_and_server_mode(self):
+        stdout, stderr, returncode = asyncio.run(
+            run_command_async("echo 'OK | a=1'; sleep 30", timeout=0.2, keep_perfdata=True)
+        )
+        self.assertEqual(returncode, 3)
+        self.assertTrue(stdout.endswith("seconds | a=1"))
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, "cache")
+
+    @patch("subprocess.run")
+    def test_fresh_result_is_served_from_cache(self, mock_subprocess_run):
+        mock_subprocess_run.return_value = subprocess.CompletedProcess("cmd", 1, OK_OUTPUT, "err")
+        cache = ResultCache(self.path, ttl=60)
+        first = execute_command("\"/opt/opsview/plugin  -H 'host'\"", cache=cache)
+        second = execute_command("/opt/opsview/plugin -H host", cache=ResultCache(self.path, 60))
+
+        self.assertEqual(mock_subprocess_run.call_count, 1)
+        self.assertEqual(
+            (second.stdout, second.stderr, second.returncode), (first.stdout, "err", 1)
+        )
+
+    @patch("subprocess.run")
+    def test_expired_result_is_not_used(self, mock_subprocess_run):
+        mock_subprocess_run.return_value = subprocess.CompletedProcess("cmd", 0, OK_OUTPUT, "")
+        cache = ResultCache(self.path, ttl=60)
+        execute_command("/opt/opsview/plugin", cache=cache)
+        with patch("time.time", return_value=time.time() + 61):
+            self.assertIsNone(cache.get("/opt/opsview/plugin"))
+            execute_command("/opt/opsview/plugin", cache=cache)
+        self.assertEqual(mock_subprocess_run.call_count, 2)
+
+    def test_only_the_most_recent_results_are_kept(self):
+        cache = ResultCache(self.path, ttl=60, max_entries=2)
+        for command in ("a", "b", "c"):
+            cache.put(command, subprocess.CompletedProcess(command, 0, command, ""))
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual([cache.get(command).stdout for command in ("b", "c")], ["b", "c"])
+
+    @patch("subprocess.run")
+    def test_results_are_kept_apart_by_run_options(self, mock_subprocess_run):
+        mock_subprocess_run.return_value = subprocess.CompletedProcess("cmd", 0, OK_OUTPUT, "")
+        cache = ResultCache(self.path, ttl=60)
+        timed_out = execute_command("sleep 30", cache=cache, timeout=0.05)
+        self.assertEqual(timed_out.returncode, 3)
+        self.assertEqual(execute_command("sleep 30", cache=cache).stdout, OK_OUTPUT)
+        self.assertEqual(
+            execute_command("sleep 30", cache=cache, timeout=0.05).stdout, timed_out.stdout
+        )
+        self.assertEqual(mock_subprocess_run.call_count, 1)
+
+    def test_default_files_are_in_a_private_directory(self):
+        with patch.dict(os.environ, {"XDG_RUNTIME_DIR": self.tmpdir.name}):
+            path = default_cache_path()
+            ResultCache(path, ttl=60).put("a", subprocess.CompletedProcess("a", 0, "a", ""))
+            self.assertEqual(ResultCache(path, ttl=60).get("a").stdout, "a")
+        self.assertEqual(os.stat(os.path.dirname(path)).st_mode & 0o777, 0o700)
+
+    def test_private_directory_of_another_user_or_mode_is_not_used(self):
+        with patch.dict(os.environ, {"XDG_RUNTIME_DIR": self.tmpdir.name}):
+            path = default_cache_path()
+            os.mkdir(os.path.dirname(path), 0o777)
+            os.chmod(os.path.dirname(path), 0o777)
+            cache = ResultCache(path, ttl=60)
+            cache.put("a", subprocess.CompletedProcess("a", 0, "a", ""))
+            self.assertIsNone(cache.get("a"))
+            self.assertFalse(os.path.exists(path))
+
+            os.rmdir(os.path.dirname(path))
+            os.mkdir(os.path.join(self.tmpdir.name, "elsewhere"), 0o700)
+            os.symlink("elsewhere", os.path.dirname(path))
+            with self.assertRaises(OSError):
+                make_state_dir(os.path.dirname(path))
+            with patch("os.getuid", return_value=os.getuid() + 1):
+                os.makedirs(private_runtime_dir(), 0o700)
+                with self.assertRaises(PermissionError):
+                    make_state_dir(private_runtime_dir())
+
+    def test_unusable_cache_file_is_a_miss(self):
+        cache = ResultCache(os.path.join(self.tmpdir.name, "missing", "cache"), ttl=60)
+        cache.put("a", subprocess.CompletedProcess("a", 0, "a", ""))
+        self.assertIsNone(cache.get("a"))
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.runs = []
+
+    def single_flight(self, max_wait):
+        store = ResultCache(os.path.join(self.tmpdir.name, "cache"), ttl=max_wait)
+        return SingleFlight(os.path.join(self.tmpdir.name, "locks"), store, max_wait)
+
+    def slow_command(self, seconds):
+        def run_command():
+            self.runs.append(threading.get_ident())
+            time.sleep(seconds)
+            return subprocess.CompletedProcess("cmd", 1, f"run {len(self.runs)}", "")
+
+        return run_command
+
+    def run_concurrently(self, max_wait, seconds):
+        results = {}
+
+        def run(name):
+            results[name] = self.single_flight(max_wait).run(
+                "/opt/opsview/plugin", self.slow_command(seconds)
+            )
+
+        first = threading.Thread(target=run, args=("first",))
+        first.start()
+        while not self.runs:
+            time.sleep(0.001)
+        run("second")
+        first.join()
+        return results
+
+    def test_identical_command_waits_for_the_running_one(self):
+        results = self.run_concurrently(max_wait=5, seconds=0.2)
+        self.assertEqual(len(self.runs), 1)
+        self.assertEqual(results["first"].stdout, "run 1")
+        self.assertEqual((results["second"].stdout, results["second"].returncode), ("run 1", 1))
+
+    def test_command_runs_itself_after_the_maximum_wait(self):
+        results = self.run_concurrently(max_wait=0.05, seconds=0.3)
+        self.assertEqual(len(self.runs), 2)
+        self.assertEqual(results["second"].stdout, "run 2")
+
+    def test_earlier_result_is_not_reused(self):
+        single_flight = self.single_flight(max_wait=5)
+        single_flight.run("/opt/opsview/plugin", self.slow_command(0))
+        result = single_flight.run("/opt/opsview/plugin", self.slow_command(0))
+        self.assertEqual(result.stdout, "run 2")
+
+
+class TestManifestMode(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write_manifest(self, *lines):
+        path = os.path.join(self.tmpdir.name, "manifest.jsonl")
+        with open(path, "w", encoding="utf-8") as manifest:
+            manifest.write("\n".join(lines) + "\n")
+        return path
+
+    def run_manifest(self, argv, outputs):
+        code, stdout, _ = run_main(argv, outputs=outputs)
+        results = [json.loads(line) for line in stdout.splitlines()]
+        return code, sorted(results, key=lambda result: result["id"])
+
+    def test_manifest_runs_every_record_with_its_own_thresholds(self):
+        path = self.write_manifest(
+            "# disk checks",
+            json.dumps(
+                {"command": "/opt/opsview/monitoringscripts/plugins/check_var", "warning": "80"}
+            ),
+            "",
+            json.dumps({"command": "/opt/opsview/monitoringscripts/plugins/check_tmp"}),
+        )
+        outputs = {
+            "/opt/opsview/monitoringscripts/plugins/check_var": (OK_OUTPUT, "", 0),
+            "/opt/opsview/monitoringscripts/plugins/check_tmp": (
+                "CRITICAL | '/tmp'=95%;80;90;0;100\n",
+                "",
+                2,
+            ),
+        }
+        code, results = self.run_manifest(["-c", "90", "--manifest", path], outputs)
+
+        self.assertEqual(code, 0)
+        self.assertEqual([result["id"] for result in results], [2, 4])
+        self.assertEqual(
+            results[0]["stdout"],
+            "OK - Disk space is sufficient | '/var'=55%;80;90;0;100 "
+            "'/var_critical_threshold'=90%;;;0;100 "
+            "'/var_warning_threshold'=80%;;;0;100\n",
+        )
+        self.assertEqual(results[0]["returncode"], 0)
+        self.assertEqual(
+            results[1]["stdout"],
+            "CRITICAL | '/tmp'=95%;80;90;0;100 '/tmp_critical_threshold'=90%;;;0;100\n",
+        )
+        self.assertEqual(results[1]["returncode"], 2)
+
+    def test_manifest_records_with_regex_flags_in_their_threshold_map(self):
+        command = "/opt/opsview/monitoringscripts/plugins/check_var"
+        path = self.write_manifest(
+            json.dumps({"command": command, "threshold_map": ["re:(?i)/VAR=warning=80"]}),
+            json.dumps({"command": command, "threshold_map": ["re:(?i=warning=80"]}),
+        )
+        code, results = self.run_manifest(["--manifest", path], {command: (OK_OUTPUT, "", 0)})
+
+        self.assertEqual(code, 0)
+        self.assertIn("'/var_warning_threshold'=80%;;;0;100", results[0]["stdout"])
+        self.assertEqual(results[1]["returncode"], 3)
+        self.assertIn("Invalid --threshold-map rule", results[1]["stderr"])
+
+    def test_manifest_reports_invalid_records(self):
+        path = self.write_manifest(
+            "not json",
+            json.dumps({"command": "/bin/echo foo", "warning": "80"}),
+            json.dumps({"command": "/opt/opsview/monitoringscripts/plugins/check_var"}),
+        )
+        code, results = self.run_manifest(["--manifest", path], {})
+
+        self.assertEqual(code, 0)
+        self.assertEqual([result["returncode"] for result in results], [3, 3, 3])
+        self.assertIn("Invalid manifest record on line 1", results[0]["stderr"])
+        self.assertIn("MUST start with a path", results[1]["stderr"])
+        self.assertIn("must be provided", results[2]["stderr"])
+
+    def test_manifest_checks_the_types_of_record_values(self):
+        command = "/opt/opsview/monitoringscripts/plugins/check_var"
+        path = self.write_manifest(
+            json.dumps({"command": command, "warning": "80", "max_entries": "5"}),
+            json.dumps({"command": command, "warning": 80, "critical": 90.5, "evaluate": True}),
+            json.dumps({"command": command, "warning": "80", "evaluate": "yes"}),
+            json.dumps({"command": command, "static": ["max=100", 100]}),
+            json.dumps({"command": 5, "warning": "80"}),
+        )
+        code, results = self.run_manifest(["--manifest", path], {command: (OK_OUTPUT, "", 0)})
+
+        self.assertEqual(code, 0)
+        self.assertEqual([result["returncode"] for result in results], [3, 0, 3, 3, 3])
+        self.assertIn("'max_entries' must be an integer", results[0]["stderr"])
+        self.assertEqual(
+            results[1]["stdout"],
+            "OK - Disk space is sufficient | '/var'=55%;80;90;0;100 "
+            "'/var_critical_threshold'=90.5%;;;0;100 '/var_warning_threshold'=80%;;;0;100\n",
+        )
+        self.assertIn("'evaluate' must be true or false", results[2]["stderr"])
+        self.assertIn("'static' must be a string or a list of strings", results[3]["stderr"])
+        self.assertIn("'command' must be a string", results[4]["stderr"])
+
+    @patch("sys.stderr", new_callable=StringIO)
+    def test_manifest_that_cannot_be_read(self, mock_stderr):
+        test_args = ["script_name", "--manifest", os.path.join(self.tmpdir.name, "missing")]
+        with patch.object(sys, "argv", test_args):
+            with self.assertRaises(SystemExit) as cm:
+                main()
+        self.assertEqual(cm.exception.code, 3)
+        self.assertIn("Error: Cannot read manifest", mock_stderr.getvalue())
+
+    def test_render_check_result_passes_unknown_through(self):
+        self.assertEqual(
+            render_check_result("UNKNOWN - oops", "trace", 3, "80", None),
+            ("UNKNOWN - oops\n", "trace", 3),
+        )
+
+
+class TestServerMode(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.socket_path = os.path.join(self.tmpdir.name, "wrapper.sock")
+
+    def start_server(self, calls=None, options=None):
+        async def fake_run_command_async(command, **limits):
+            if calls is not None:
+                calls.append(command)
+            if options is not None:
+                options.append(limits)
+            return OK_OUTPUT, "", 0
+
+        started = threading.Event()
+        handles = {}
+
+        def ready(stop):
+            handles["loop"], handles["stop"] = asyncio.get_running_loop(), stop
+            started.set()
+
+        def run():
+            with patch(
+                "check_with_thresholds_as_perfdata_lib.run_command_async",
+                new=fake_run_command_async,
+            ):
+                asyncio.run(serve(self.socket_path, ready=ready))
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.assertTrue(started.wait(5))
+
+        def stop():
+            handles["loop"].call_soon_threadsafe(handles["stop"].set)
+            thread.join(5)
+
+        self.addCleanup(stop)
+
+    def test_client_forwards_arguments_to_the_server(self):
+        self.start_server()
+        stdout, stderr, returncode = client.forward(
+            ["-w", "80"] + SINGLE_PART_CMD_LINE_ARGS, self.socket_path
+        )
+        self.assertEqual(
+            stdout,
+            "OK - Disk space is sufficient | '/var'=55%;80;90;0;100 "
+            "'/var_warning_threshold'=80%;;;0;100\n",
+        )
+        self.assertEqual(stderr, "")
+        self.assertEqual(returncode, 0)
+
+    def test_server_reports_errors_like_main(self):
+        self.start_server()
+        self.assertEqual(
+            client.forward(SINGLE_PART_CMD_LINE_ARGS, self.socket_path),
+            ("", "Error: --static, --warning, or --critical must be provided\n", 3),
+        )
+        stdout, stderr, returncode = client.forward(["-w", "80"], self.socket_path)
+        self.assertEqual(returncode, 2)
+        self.assertIn("one of the arguments -C/--command", stderr)
+
+    def test_server_uses_the_metrics_cache_and_stats_options(self):
+        calls = []
+        self.start_server(calls)
+        stats_path = os.path.join(self.tmpdir.name, "wrapper.stats")
+        argv = [
+            "-w",
+            "80",
+            "--self-metrics",
+            "--cache-ttl",
+            "60",
+            "--cache-file",
+            os.path.join(self.tmpdir.name, "cache.sqlite"),
+            "--stats-file",
+            stats_path,
+        ] + SINGLE_PART_CMD_LINE_ARGS
+        for _ in range(2):
+            stdout, stderr, returncode = client.forward(argv, self.socket_path)
+            self.assertEqual((stderr, returncode), ("", 0))
+            self.assertIn(" wrapper_execute_command=", stdout)
+            self.assertIn(" wrapper_append_thresholds=", stdout)
+            self.assertNotIn("wrapper_child_", stdout)
+
+        self.assertEqual(len(calls), 1)
+        stats = StatsFile(stats_path)
+        try:
+            self.assertEqual(stats.plugins()[0][1], [2, 0, 0, 0])
+        finally:
+            stats.close()
+
+    @patch("sys.stdout", new_callable=StringIO)
+    @patch("subprocess.run")
+    def test_client_runs_in_process_without_server(self, mock_subprocess_run, mock_stdout):
+        mock_result = MagicMock()
+        mock_result.stdout = OK_OUTPUT
+        mock_result.stderr = ""
+        mock_result.returncode = 0
+        mock_subprocess_run.return_value = mock_result
+
+        test_args = ["client", "-w", "80"] + SINGLE_PART_CMD_LINE_ARGS
+        with patch.dict(os.environ, {client.SOCKET_ENVIRONMENT_VARIABLE: self.socket_path}):
+            with patch.object(sys, "argv", test_args):
+                with self.assertRaises(SystemExit) as cm:
+                    client.main()
+        self.assertEqual(cm.exception.code, 0)
+        self.assertEqual(
+            mock_stdout.getvalue(),
+            "OK - Disk space is sufficient | '/var'=55%;80;90;0;100 "
+            "'/var_warning_threshold'=80%;;;0;100\n",
+        )
+
+    def test_commands_run_with_the_environment_and_directory_of_the_client(self):
+        options = []
+        self.start_server(options=options)
+        argv = ["-w", "80", "--stats-file", "wrapper.stats"] + SINGLE_PART_CMD_LINE_ARGS
+        with patch.dict(os.environ, {"PLUGIN_SETTING": "1"}), patch.object(
+            client.os, "getcwd", return_value=self.tmpdir.name
+        ):
+            _, stderr, returncode = client.forward(argv, self.socket_path)
+        self.assertEqual((stderr, returncode), ("", 0))
+        self.assertEqual(options[0]["cwd"], self.tmpdir.name)
+        self.assertEqual(options[0]["env"]["PLUGIN_SETTING"], "1")
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir.name, "wrapper.stats")))
+
+    def test_client_gives_up_on_a_server_that_does_not_answer(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(listener.close)
+        listener.bind(self.socket_path)
+        listener.listen()
+        with self.assertRaises(OSError):
+            client.forward(SINGLE_PART_CMD_LINE_ARGS, self.socket_path, timeout=0.1)
+        self.assertEqual(client.request_timeout(["-t", "10", "-w", "80"]), 15.0)
+        self.assertEqual(client.request_timeout(["--timeout=2.5"]), 7.5)
+        self.assertEqual(client.request_timeout(["-w", "80"]), client.DEFAULT_TIMEOUT)
+
+    @patch("sys.stdout", new_callable=StringIO)
+    @patch("subprocess.run")
+    def test_client_runs_in_process_after_a_connection_error(
+        self, mock_subprocess_run, mock_stdout
+    ):
+        mock_subprocess_run.return_value = MagicMock(stdout=OK_OUTPUT, stderr="", returncode=0)
+        test_args = ["client", "-w", "80"] + SINGLE_PART_CMD_LINE_ARGS
+        for error in (ConnectionResetError, BrokenPipeError, socket.timeout):
+            with patch.object(client, "forward", side_effect=error), patch.object(
+                sys, "argv", test_args
+            ):
+                with self.assertRaises(SystemExit) as cm:
+                    client.main()
+            self.assertEqual(cm.exception.code, 0)
+        self.assertEqual(mock_subprocess_run.call_count, 3)
+        self.assertIn("'/var_warning_threshold'=80%", mock_stdout.getvalue())
+
+    @patch("sys.stdout", new_callable=StringIO)
+    @patch("subprocess.run")
+    def test_client_ignores_a_server_run_by_another_user(self, mock_subprocess_run, mock_stdout):
+        calls = []
+        self.start_server(calls)
+        mock_result = MagicMock()
+        mock_result.stdout = OK_OUTPUT
+        mock_result.stderr = ""
+        mock_result.returncode = 0
+        mock_subprocess_run.return_value = mock_result
+
+        other_uid = os.getuid() + 1
+        with patch.object(client.os, "getuid", return_value=other_uid):
+            with self.assertRaises(PermissionError):
+                client.forward(["-w", "80"] + SINGLE_PART_CMD_LINE_ARGS, self.socket_path)
+            test_args = ["client", "-w", "80"] + SINGLE_PART_CMD_LINE_ARGS
+            with patch.dict(os.environ, {client.SOCKET_ENVIRONMENT_VARIABLE: self.socket_path}):
+                with patch.object(sys, "argv", test_args):
+                    with self.assertRaises(SystemExit) as cm:
+                        client.main()
+        self.assertEqual(cm.exception.code, 0)
+        self.assertEqual(calls, [])
+        mock_subprocess_run.assert_called_once()
+        self.assertIn("'/var_warning_threshold'=80%", mock_stdout.getvalue())
+
+    def test_default_socket_is_in_the_private_directory(self):
+        environment = {"TMPDIR": self.tmpdir.name, "XDG_RUNTIME_DIR": ""}
+        with patch.dict(os.environ, environment):
+            os.environ.pop(client.SOCKET_ENVIRONMENT_VARIABLE, None)
+            path = default_socket_path()
+            self.assertEqual(os.path.dirname(path), private_runtime_dir())
+            self.assertEqual(client.default_socket_path(), path)
+
+            self.socket_path = path
+            self.start_server()
+            self.assertEqual(os.stat(private_runtime_dir()).st_mode & 0o777, 0o700)
+            stdout, _, returncode = client.forward(["-w", "80"] + SINGLE_PART_CMD_LINE_ARGS, path)
+            self.assertEqual(returncode, 0)
+            self.assertIn("'/var_warning_threshold'=80%", stdout)
+
+
+class TestFastStartup(unittest.TestCase):
+
+    SCRIPT = os.path.join(os.path.dirname(__file__), "..", "check_with_thresholds_as_perfdata.py")
+
+    def test_common_arguments_match_argparse(self):
+        for argv in (
+            ["-w", "80", "-c", "90"] + SINGLE_PART_CMD_LINE_ARGS,
+            ["--static", "foo=1", "-s", "bar=2", "--command=/opt/opsview/x -H host"],
+            ["-c", "", "-w", "1", "-w", "2", "-C", "/opt/opsview/x"],
+            ["--threshold-config", "t.jsonl", "--host", "web1", "--service=Disk", "-C", "/opt/x"],
+        ):
+            with patch(
+                "check_with_thresholds_as_perfdata_lib.parse_common_arguments", return_value=None
+            ):
+                expected = vars(parse_arguments(argv))
+            self.assertEqual(vars(parse_common_arguments(argv)), expected)
+
+    def test_uncommon_arguments_are_left_to_argparse(self):
+        for argv in (
+            ["-h"],
+            ["-w", "80"],
+            ["-w80"] + SINGLE_PART_CMD_LINE_ARGS,
+            ["-w", "-5"] + SINGLE_PART_CMD_LINE_ARGS,
+            ["--warn", "80"] + SINGLE_PART_CMD_LINE_ARGS,
+            ["--manifest", "checks.jsonl"],
+        ):
+            self.assertIsNone(parse_common_arguments(argv))
+
+    def test_runs_with_isolated_and_no_site_flags(self):
+        result = subprocess.run(
+            [sys.executable, "-I", "-S", self.SCRIPT, "-w", "80", "-C", "/bin/echo foo"],
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+        self.assertEqual(result.returncode, 3)
+        self.assertIn("MUST start with a path", result.stderr)
+
+    def test_script_runs_through_a_symlink(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            link = os.path.join(tmpdir, "check_with_thresholds_as_perfdata.py")
+            os.symlink(os.path.abspath(self.SCRIPT), link)
+            result = subprocess.run(
+                [sys.executable, "-I", "-S", link, "-w", "80", "-C", "/bin/echo foo"],
+                capture_output=True,
+                text=True,
+                check=False,
+                cwd=tmpdir,
+            )
+        self.assertEqual(result.returncode, 3)
+        self.assertIn("MUST start with a path", result.stderr)
+
+    def test_import_does_not_load_heavy_modules(self):
+        code = (
+            "import sys; sys.path.insert(0, sys.argv[1]);"
+            "import check_with_thresholds_as_perfdata;"
+            "print(sorted({'argparse', 'asyncio', 'subprocess'} & set(sys.modules)))"
+        )
+        result = subprocess.run(
+            [sys.executable, "-I", "-S", "-c", code, os.path.dirname(self.SCRIPT)],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        self.assertEqual(result.stdout, "[]\n")
+
+
+class TestStreamingOutput(unittest.TestCase):
+
+    LONG_OUTPUT = (
+        b"OK - Disk space is sufficient | '/var'=55%;80;90;0;100\n"
+        b"/var is fine\n"
+        b"/tmp is fine | '/tmp'=55%;80;90;0;100\n"
+        b"'/'=40%;80;90;0;100\n"
+    )
+
+    def test_reader_keeps_the_output_across_chunks(self):
+        reader = PluginOutputReader()
+        for i in range(len(self.LONG_OUTPUT)):
+            reader.feed(self.LONG_OUTPUT[i : i + 1])
+        self.assertEqual(reader.getvalue(), self.LONG_OUTPUT.decode())
+
+    def test_reader_keeps_perfdata_beyond_the_text_limit(self):
+        reader = PluginOutputReader(max_text_bytes=4)
+        reader.feed(self.LONG_OUTPUT)
+        self.assertEqual(
+            reader.getvalue(),
+            "OK -| '/var'=55%;80;90;0;100\n| '/tmp'=55%;80;90;0;100\n'/'=40%;80;90;0;100\n",
+        )
+
+    def test_reader_cuts_perfdata_after_the_last_whole_entry(self):
+        reader = PluginOutputReader(max_perfdata_bytes=30)
+        for i in range(len(self.LONG_OUTPUT)):
+            reader.feed(self.LONG_OUTPUT[i : i + 1])
+        self.assertEqual(
+            reader.getvalue(),
+            "OK - Disk space is sufficient | '/var'=55%;80;90;0;100\n"
+            "/var is fine\n/tmp is fine | ",
+        )
+
+    def test_bounded_output_gives_the_same_result(self):
+        command = "printf 'OK | a=1;2;3\\nlong text | b=2\\nmore text\\n'"
+        processor = PerfdataProcessor(warning="80")
+        unbounded = execute_command(command)
+        bounded = execute_command(command, max_output_bytes=1000)
+        self.assertEqual(bounded.stdout, unbounded.stdout)
+        self.assertEqual(
+            processor.process(bounded.stdout, "", 0), processor.process(unbounded.stdout, "", 0)
+        )
+
+    def test_tail_buffer_keeps_the_last_bytes(self):
+        buffer = TailBuffer(max_bytes=5)
+        for chunk in (b"abc", b"defg", b"h", b"0123456789"):
+            buffer.feed(chunk)
+            self.assertLessEqual(len(buffer.data), 5)
+        self.assertEqual(buffer.getvalue(), "56789")
+
+    def test_chatty_command_output_is_bounded(self):
+        command = (
+            "printf 'OK | a=1;2;3\\n'; head -c 1000000 /dev/zero | tr '\\0' x;"
+            " head -c 1000000 /dev/zero | tr '\\0' y >&2; exit 1"
+        )
+        result = execute_command(command, max_output_bytes=10, max_stderr_bytes=3)
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual(result.stdout, "OK | a=1;2;3\nxxxxxxx")
+        self.assertEqual(result.stderr, "yyy")
+
+    def test_chatty_perfdata_is_bounded(self):
+        command = "printf 'OK | '; yes 'a=1' | head -c 3000001 | tr '\\n' ' '"
+        result = execute_command(command, max_output_bytes=10)
+        self.assertLessEqual(len(result.stdout), len("OK | ") + MAX_PERFDATA_BYTES)
+        self.assertTrue(result.stdout.endswith(" a=1"))
+
+
+class TestThresholdMap(unittest.TestCase):
+
+    PERFDATA = "'/'=40%;;;0;100 '/var'=55%;;;0;100 '/var/log'=70%;;;0;100 load1=0.5"
+
+    def append(self, rules):
+        return append_thresholds_to_perfdata(
+            self.PERFDATA, parse_perfdata(self.PERFDATA), None, None, [], ThresholdMap(rules)
+        )
+
+    def test_first_matching_rule_wins_and_unmatched_labels_are_skipped(self):
+        updated = self.append(
+            ["/var/*=critical=95", "/var*=warning=80,critical=90,static=max=100", "/=warning=70"]
+        ).split()
+        self.assertIn("'/var_warning_threshold'=80%;;;0;100", updated)
+        self.assertIn("'/var_critical_threshold'=90%;;;0;100", updated)
+        self.assertIn("'/var_max'=100%;;;0;100", updated)
+        self.assertIn("'/var/log_critical_threshold'=95%;;;0;100", updated)
+        self.assertNotIn("'/var/log_warning_threshold'=80%;;;0;100", updated)
+        self.assertIn("'/_warning_threshold'=70%;;;0;100", updated)
+        self.assertFalse([entry for entry in updated if entry.startswith("'load1_")])
+
+    def test_regex_rules_match_the_whole_label(self):
+        updated = self.append(["re:load\\d+=warning=2", "re:/v=warning=1"])
+        self.assertIn("'load1_warning_threshold'=2", updated)
+        self.assertNotIn("'/var_warning_threshold'", updated)
+
+    def test_regex_rules_keep_their_flags_and_groups(self):
+        threshold_map = ThresholdMap(
+            [
+                "/v*=warning=1",
+                "re:(?i)LOAD.*=warning=2",
+                "re:(\\w)\\1.*=warning=3",
+                "re:(?P<pattern0>x)=warning=4",
+                "re:(?x) / =warning=5",
+                "/var/*=warning=6",
+            ]
+        )
+        self.assertEqual(threshold_map.lookup("/var"), ("1", None, []))
+        self.assertEqual(threshold_map.lookup("load1"), ("2", None, []))
+        self.assertEqual(threshold_map.lookup("aab"), ("3", None, []))
+        self.assertEqual(threshold_map.lookup("x"), ("4", None, []))
+        self.assertEqual(threshold_map.lookup("/"), ("5", None, []))
+        self.assertEqual(threshold_map.lookup("/var/log"), ("1", None, []))
+        self.assertIsNone(threshold_map.lookup("ab"))
+
+    def test_invalid_rules_are_rejected(self):
+        for rule in ("/var", "/var=warn=80", "/var=static=100", "re:(=warning=1"):
+            with self.assertRaises(ValueError):
+                ThresholdMap([rule])
+
+    @patch("subprocess.run")
+    def test_main_with_threshold_map(self, mock_subprocess_run):
+        mock_subprocess_run.return_value = MagicMock(stdout=OK_OUTPUT, stderr="", returncode=0)
+        argv = ["script_name", "--threshold-map", "/v*=warning=80"] + SINGLE_PART_CMD_LINE_ARGS
+        with patch.object(sys, "argv", argv), patch(
+            "sys.stdout", new_callable=StringIO
+        ) as mock_stdout, self.assertRaises(SystemExit) as e:
+            main()
+        self.assertEqual(e.exception.code, 0)
+        self.assertEqual(
+            mock_stdout.getvalue(),
+            "OK - Disk space is sufficient | '/var'=55%;80;90;0;100"
+            " '/var_warning_threshold'=80%;;;0;100\n",
+        )
+
+    def test_main_rejects_threshold_map_with_other_thresholds(self):
+        argv = ["script_name", "-w", "80", "--threshold-map", "*=warning=80"]
+        with patch.object(sys, "argv", argv + SINGLE_PART_CMD_LINE_ARGS), patch(
+            "sys.stderr", new_callable=StringIO
+        ) as mock_stderr, self.assertRaises(SystemExit) as e:
+            main()
+        self.assertEqual(e.exception.code, 3)
+        self.assertIn("cannot be combined", mock_stderr.getvalue())
+
+
+class TestPerfdataFilter(unittest.TestCase):
+
+    PERFDATA = "'/'=40%;;;0;100 '/var'=55%;;;0;100 '/var/log'=70%;;;0;100 load1=0.5"
+
+    def test_include_and_exclude(self):
+        perfdata_filter = PerfdataFilter(include=["/*", "re:load\\d"], exclude=["/var/*"])
+        entries = parse_perfdata(self.PERFDATA, perfdata_filter)
+        self.assertEqual([entry["label"] for entry in entries], ["'/'", "'/var'", "load1"])
+        self.assertEqual(
+            perfdata_filter.perfdata(),
+            "'/'=40%;;;0;100 '/var'=55%;;;0;100 load1=0.5 wrapper_dropped_entries=1",
+        )
+
+    def test_regex_patterns_keep_their_flags(self):
+        perfdata_filter = PerfdataFilter(include=["re:(?i)LOAD.*", "/"])
+        entries = parse_perfdata(self.PERFDATA, perfdata_filter)
+        self.assertEqual([entry["label"] for entry in entries], ["'/'", "load1"])
+        with self.assertRaises(ValueError):
+            PerfdataFilter(exclude=["/var", "re:(?i"])
+
+    def test_max_entries_counts_the_appended_thresholds(self):
+        perfdata_filter = PerfdataFilter(max_entries=7, derived_entries=lambda label: 2)
+        entries = parse_perfdata(self.PERFDATA, perfdata_filter)
+        self.assertEqual([entry["label"] for entry in entries], ["'/'", "'/var'"])
+        self.assertEqual(perfdata_filter.dropped, 2)
+
+    @patch("subprocess.run")
+    def test_main_only_appends_thresholds_for_kept_labels(self, mock_subprocess_run):
+        mock_subprocess_run.return_value = MagicMock(
+            stdout=f"OK | {self.PERFDATA}", stderr="", returncode=0
+        )
+        argv = ["script_name", "-w", "80", "--exclude", "/*", "--max-entries", "2"]
+        with patch.object(sys, "argv", argv + SINGLE_PART_CMD_LINE_ARGS), patch(
+            "sys.stdout", new_callable=StringIO
+        ) as mock_stdout, self.assertRaises(SystemExit) as e:
+            main()
+        self.assertEqual(e.exception.code, 0)
+        self.assertEqual(
+            mock_stdout.getvalue(),
+            "OK | 'load1_warning_threshold'=80 load1=0.5 wrapper_dropped_entries=3\n",
+        )
+
+
+class TestEvaluate(unittest.TestCase):
+
+    def test_nagios_ranges(self):
+        for text, alerting, not_alerting in (
+            ("10", [-1, 10.5], [0, 10]),
+            ("10:", [9.9], [10, 1e9]),
+            ("~:10", [11], [-1e9, 10]),
+            ("10:20", [9, 21], [10, 20]),
+            ("@10:20", [10, 20], [9, 21]),
+        ):
+            nagios_range = NagiosRange(text)
+            for value in alerting:
+                self.assertTrue(nagios_range.alerts(value), (text, value))
+            for value in not_alerting:
+                self.assertFalse(nagios_range.alerts(value), (text, value))
+
+    def test_invalid_ranges(self):
+        for text in ("x", "20:10", "@", "1:2:3"):
+            with self.assertRaises(ValueError):
+                NagiosRange(text)
+
+    def test_worst_state(self):
+        entries = parse_perfdata("a=5 b=15 c=25")
+        self.assertEqual(evaluate_perfdata(entries, "30", "40"), 0)
+        self.assertEqual(evaluate_perfdata(entries, "20", "40"), 1)
+        self.assertEqual(evaluate_perfdata(entries, "20", "@0:10"), 2)
+
+    @patch("subprocess.run")
+    def test_main_evaluates_and_splits_ranges(self, mock_subprocess_run):
+        mock_subprocess_run.return_value = MagicMock(stdout=OK_OUTPUT, stderr="", returncode=0)
+        argv = ["script_name", "--evaluate", "-w", "~:50", "-c", "90"]
+        with patch.object(sys, "argv", argv + SINGLE_PART_CMD_LINE_ARGS), patch(
+            "sys.stdout", new_callable=StringIO
+        ) as mock_stdout, self.assertRaises(SystemExit) as e:
+            main()
+        self.assertEqual(e.exception.code, 1)
+        self.assertEqual(
+            mock_stdout.getvalue(),
+            "OK - Disk space is sufficient | '/var'=55%;80;90;0;100"
+            " '/var_critical_threshold'=90%;;;0;100 '/var_warning_threshold_end'=50%;;;0;100\n",
+        )
+
+
+class TestSelfMetrics(unittest.TestCase):
+
+    @patch("subprocess.run")
+    def test_main_appends_wrapper_metrics(self, mock_subprocess_run):
+        mock_subprocess_run.return_value = MagicMock(stdout=OK_OUTPUT, stderr="", returncode=0)
+        argv = ["script_name", "--self-metrics", "-w", "80"]
+        with patch.object(sys, "argv", argv + SINGLE_PART_CMD_LINE_ARGS), patch(
+            "sys.stdout", new_callable=StringIO
+        ) as mock_stdout, self.assertRaises(SystemExit) as e:
+            main()
+        self.assertEqual(e.exception.code, 0)
+        output, perfdata = mock_stdout.getvalue().split("|")
+        self.assertEqual(output, "OK - Disk space is sufficient ")
+        labels = [entry["label"] for entry in parse_perfdata(perfdata)]
+        self.assertEqual(labels[:2], ["'/var'", "'/var_warning_threshold'"])
+        self.assertEqual(
+            labels[2:],
+            [
+                "wrapper_parse_arguments",
+                "wrapper_execute_command",
+                "wrapper_process_command_output",
+                "wrapper_parse_perfdata",
+                "wrapper_append_thresholds",
+                "wrapper_total",
+                "wrapper_child_user_cpu",
+                "wrapper_child_system_cpu",
+                "wrapper_child_max_rss",
+            ],
+        )
+
+    def test_child_usage_of_long_lived_processes(self):
+        usages = iter(
+            [
+                SimpleNamespace(ru_utime=1.5, ru_stime=0.5, ru_maxrss=1000),
+                SimpleNamespace(ru_utime=2.0, ru_stime=0.75, ru_maxrss=1000),
+            ]
+        )
+        with patch(
+            "check_with_thresholds_as_perfdata_lib.child_usage", side_effect=lambda: next(usages)
+        ):
+            delta = SelfMetrics(0.0, lambda: 1.0, children="delta")
+            delta.lap("execute_command")
+            self.assertEqual(
+                delta.perfdata().split()[-2:],
+                ["wrapper_child_user_cpu=0.500000s", "wrapper_child_system_cpu=0.250000s"],
+            )
+            concurrent = SelfMetrics(0.0, lambda: 1.0, children=None)
+            concurrent.lap("execute_command")
+            self.assertEqual(
+                concurrent.perfdata(), "wrapper_execute_command=1.000000s wrapper_total=1.000000s"
+            )
+
+
+class TestStatsFile(unittest.TestCase):
+
+    COMMAND = "/opt/opsview/monitoringscripts/plugins/check_disk -p /var"
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.directory.name, "wrapper.stats")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_histograms_are_shared_through_the_file(self):
+        for seconds in (0.001, 0.002, 0.004, 1.0):
+            stats = StatsFile(self.path)
+            stats.record("/opt/opsview/a", [("execute_command", seconds)], 1)
+            stats.close()
+        stats = StatsFile(self.path)
+        stats.record("/opt/opsview/b", [("total", 0.5)], 7)
+        plugins = stats.plugins()
+        stats.close()
+
+        self.assertEqual([plugin[0] for plugin in plugins], ["/opt/opsview/a", "/opt/opsview/b"])
+        self.assertEqual(plugins[0][1], [0, 4, 0, 0])
+        self.assertEqual(plugins[1][1], [0, 0, 0, 1])
+        counts = plugins[0][2]["execute_command"]
+        self.assertAlmostEqual(histogram_percentile(counts, 0.5), 0.002, delta=0.0006)
+        self.assertAlmostEqual(histogram_percentile(counts, 0.99), 1.0, delta=0.3)
+        self.assertFalse(any(plugins[0][2]["total"]))
+
+    def test_other_files_are_rejected(self):
+        with open(self.path, "w", encoding="utf-8") as other:
+            other.write("not a stats file")
+        with self.assertRaises(ValueError):
+            StatsFile(self.path)
+
+    @patch("subprocess.run")
+    def test_main_records_checks_and_prints_percentiles(self, mock_subprocess_run):
+        mock_subprocess_run.return_value = MagicMock(stdout=WARNING_OUTPUT, stderr="", returncode=1)
+        argv = ["script_name", "-w", "80", "--stats-file", self.path, "-C", self.COMMAND]
+        with patch.object(sys, "argv", argv), patch(
+            "sys.stdout", new_callable=StringIO
+        ), self.assertRaises(SystemExit) as e:
+            main()
+        self.assertEqual(e.exception.code, 1)
+
+        with patch.object(sys, "argv", ["script_name", "--stats", self.path]), patch(
+            "sys.stdout", new_callable=StringIO
+        ) as mock_stdout, self.assertRaises(SystemExit) as e:
+            main()
+        self.assertEqual(e.exception.code, 0)
+        lines = mock_stdout.getvalue().splitlines()
+        self.assertEqual(
+            lines[0],
+            "/opt/opsview/monitoringscripts/plugins/check_disk: "
+            "1 checks, 0 OK, 1 WARNING, 0 CRITICAL, 0 UNKNOWN",
+        )
+        self.assertEqual(lines[1].split(), ["phase", "count", "p50", "p95", "p99"])
+        self.assertIn("total", [line.split()[0] for line in lines[2:]])
+
+
+class TestOutputFormat(unittest.TestCase):
+
+    OUTPUT = "OK - Disk space is sufficient | '/var'=55%;80;90;0;100 load=0.5"
+
+    def test_json(self):
+        stdout, stderr, returncode = render_check_result(
+            self.OUTPUT, "", 0, "80", None, ["foo=1"], output_format="json"
+        )
+        self.assertEqual((stderr, returncode), ("", 0))
+        result = json.loads(stdout)
+        self.assertEqual(result["output"], "OK - Disk space is sufficient")
+        self.assertEqual(result["returncode"], 0)
+        self.assertEqual(
+            result["perfdata"][:3],
+            [
+                {
+                    "label": "/var",
+                    "value": 55,
+                    "uom": "%",
+                    "warn": "80",
+                    "crit": "90",
+                    "min": 0,
+                    "max": 100,
+                },
+                {
+                    "label": "load",
+                    "value": 0.5,
+                    "uom": "",
+                    "warn": None,
+                    "crit": None,
+                    "min": None,
+                    "max": None,
+                },
+                {
+                    "label": "/var_warning_threshold",
+                    "value": 80,
+                    "uom": "%",
+                    "warn": None,
+                    "crit": None,
+                    "min": 0,
+                    "max": 100,
+                },
+            ],
+        )
+        self.assertEqual(
+            [entry["label"] for entry in result["perfdata"][3:]],
+            ["/var_foo", "load_warning_threshold", "load_foo"],
+        )
+
+    def test_openmetrics(self):
+        stdout, _, returncode = render_check_result(
+            self.OUTPUT, "", 1, "80", "10:20", output_format="openmetrics"
+        )
+        self.assertEqual(returncode, 1)
+        self.assertEqual(
+            stdout,
+            "# TYPE perfdata gauge\n"
+            "# HELP perfdata Plugin perfdata and appended thresholds\n"
+            'perfdata{label="/var",uom="%"} 55\n'
+            'perfdata{label="load"} 0.5\n'
+            'perfdata{label="/var_warning_threshold",uom="%"} 80\n'
+            'perfdata{label="load_warning_threshold"} 80\n'
+            "# TYPE check_return_code gauge\n"
+            "# HELP check_return_code Exit code of the check\n"
+            "check_return_code 1\n"
+            "# EOF\n",
+        )
+
+    @patch("subprocess.run")
+    def test_main_prints_json_for_unknown_results(self, mock_subprocess_run):
+        mock_subprocess_run.return_value = MagicMock(
+            stdout="UNKNOWN - No such host\n", stderr="", returncode=3
+        )
+        argv = ["script_name", "-w", "80", "--output-format", "json"]
+        with patch.object(sys, "argv", argv + SINGLE_PART_CMD_LINE_ARGS), patch(
+            "sys.stdout", new_callable=StringIO
+        ) as mock_stdout, self.assertRaises(SystemExit) as e:
+            main()
+        self.assertEqual(e.exception.code, 3)
+        self.assertEqual(
+            json.loads(mock_stdout.getvalue()),
+            {"output": "UNKNOWN - No such host", "returncode": 3, "perfdata": []},
+        )
+
+
+class TestPerfdataProcessor(unittest.TestCase):
+
+    def test_invalid_settings_raise_value_error(self):
+        for settings in (
+            {},
+            {"warning": "80", "threshold_map": ["*=warning=1"]},
+            {"warning": "80", "output_format": "xml"},
+            {"warning": "80", "max_entries": 0},
+            {"warning": "20:10", "evaluate": True},
+            {"threshold_map": ["/var"]},
+            {"warning": "80", "include": ["re:("]},
+        ):
+            with self.assertRaises(ValueError):
+                PerfdataProcessor(**settings)
+
+    def test_processor_is_reusable_and_never_exits(self):
+        processor = PerfdataProcessor(warning="80", max_entries=2)
+        for _ in range(2):
+            self.assertEqual(
+                processor.process("OK | a=1 b=2 c=3", "", 0),
+                ("OK | 'a_warning_threshold'=80 a=1 wrapper_dropped_entries=2\n", "", 0),
+            )
+        result = processor.process("OK - no perfdata", "", 0)
+        self.assertEqual(result.returncode, 3)
+        self.assertIn("No performance data found", result.stderr)
+        self.assertEqual(
+            processor.process("UNKNOWN - oops", "trace", 3), ("UNKNOWN - oops\n", "trace", 3)
+        )
+
+
+class TestPerfdataEntries(unittest.TestCase):
+
+    PERFDATA = " ".join(
+        f"'disk {i}'=1.5e{i % 3}MB;80;90;0;100 load{i}={i % 7} 'it''s'=-{i}.25%;;;;x"
+        for i in range(2000)
+    )
+
+    @staticmethod
+    def allocated(build):
+        tracemalloc.start()
+        try:
+            result = build()  # pylint: disable=unused-variable
+            return tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+    def test_entries_read_like_dictionaries(self):
+        entries = parse_perfdata_entries(self.PERFDATA)
+        self.assertEqual([entry.as_dict() for entry in entries], parse_perfdata(self.PERFDATA))
+        entry = entries[0]
+        self.assertEqual((entry.value, entry.min, entry.max), (1.5, 0.0, 100.0))
+        self.assertEqual(
+            (entry["value"], entry.get("min"), entry.get("nope", 1)), ("1.5e0", "0", 1)
+        )
+        self.assertIsNone(entries[2].max)
+        self.assertEqual(entries[2]["max"], "x")
+
+    def test_every_representation_gives_the_same_thresholds(self):
+        expected = append_thresholds_to_perfdata(
+            self.PERFDATA, parse_perfdata(self.PERFDATA), "80", "90", ["max=100"]
+        )
+        self.assertEqual(
+            append_thresholds_to_perfdata(
+                self.PERFDATA, parse_perfdata_entries(self.PERFDATA), "80", "90", ["max=100"]
+            ),
+            expected,
+        )
+        columns = PerfdataColumns.from_perfdata(self.PERFDATA)
+        self.assertEqual(len(columns), 6000)
+        self.assertEqual(columns[1], PerfdataEntry("load0", "0"))
+        self.assertEqual(evaluate_perfdata(columns, "~:1000", "@-2:-1"), 2)
+        self.assertEqual(
+            evaluate_perfdata(columns, "~:1000", "@-2:-1"),
+            evaluate_perfdata(parse_perfdata(self.PERFDATA), "~:1000", "@-2:-1"),
+        )
+
+    def test_entries_and_columns_use_less_memory_than_dictionaries(self):
+        dictionaries = self.allocated(lambda: parse_perfdata(self.PERFDATA))
+        entries = self.allocated(lambda: parse_perfdata_entries(self.PERFDATA))
+        columns = self.allocated(lambda: PerfdataColumns.from_perfdata(self.PERFDATA))
+        self.assertLess(entries, 0.85 * dictionaries)
+        self.assertLess(columns, 0.6 * entries)
+
+
+class TestOutputTemplates(unittest.TestCase):
+
+    def setUp(self):
+        output_template.cache_clear()
+
+    def assertSameOutput(self, stdout, **settings):
+        expected = PerfdataProcessor(**settings).process(stdout, "", 0)
+        processor = PerfdataProcessor(cache_templates=True, **settings)
+        for _ in range(2):
+            self.assertEqual(processor.process(stdout, "", 0), expected)
+
+    def test_template_is_reused_for_the_same_schema(self):
+        processor = PerfdataProcessor(warning="80", critical="@90:95", cache_templates=True)
+        first = processor.process("OK | '/var'=55%;;;0;100 load=0.5", "", 0)
+        second = processor.process("OK | '/var'=61%;;;0;100 load=1.25", "", 0)
+        self.assertEqual(
+            second.stdout,
+            "OK | '/var'=61%;;;0;100 '/var_critical_threshold'=@90:95%;;;0;100 "
+            "'/var_warning_threshold'=80%;;;0;100 'load_critical_threshold'=@90:95 "
+            "'load_warning_threshold'=80 load=1.25\n",
+        )
+        self.assertEqual(first.stdout, second.stdout.replace("61%", "55%").replace("1.25", "0.5"))
+        info = output_template.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+        processor.process("OK | '/var'=61%;;;0;90 load=1.25", "", 0)
+        self.assertEqual(output_template.cache_info().misses, 2)
+
+    def test_output_matches_uncached_output(self):
+        stdout = "OK | '/var'=55%;;;0;100 'it''s'=1 a=1 ab=2 a_b=3 'a b'=4s;;;;9"
+        self.assertSameOutput(stdout, warning="80", critical="90", static=["max=100"])
+        self.assertSameOutput(stdout, threshold_map=["a*=warning=5", "re:.*s=critical=1:2"])
+        self.assertSameOutput(stdout, warning="10:20", evaluate=True)
+        self.assertSameOutput(stdout, warning="80", max_entries=5)
+
+    def test_repeated_labels_and_invalid_entries_are_not_templated(self):
+        self.assertSameOutput("OK | a=2 a=1 b=3", warning="80")
+        self.assertSameOutput("OK | a=2 junk b=3", warning="80")
+        self.assertSameOutput("OK | a=2 'a_warning_threshold'=3", warning="80")
+        self.assertIsNone(output_template(((("a", "", None, None),) * 2), (), "80", None))
+
+
+class TestSpoolMode(unittest.TestCase):
+
+    CHECK_RESULT = (
+        "### Nagios Service Check Result ###\n"
+        "host_name=web1\n"
+        "service_description=Disk\n"
+        "return_code=0\n"
+        "output=OK - Disk\\nC:\\\\ is fine|'/var'=85%;;;0;100\n"
+    )
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.spool = os.path.join(self.tmpdir.name, "spool")
+        self.output = os.path.join(self.tmpdir.name, "output")
+        os.mkdir(self.spool)
+
+    def write_spool_file(self, name, text, complete=True):
+        with open(os.path.join(self.spool, name), "w", encoding="utf-8") as f:
+            f.write(text)
+        if complete:
+            with open(os.path.join(self.spool, name + ".ok"), "w", encoding="utf-8"):
+                pass
+
+    def test_rewrite_check_result(self):
+        processor = PerfdataProcessor(warning="80", evaluate=True)
+        self.assertEqual(
+            rewrite_check_result(self.CHECK_RESULT, processor),
+            self.CHECK_RESULT.replace("return_code=0", "return_code=1").replace(
+                "|'/var'=85%;;;0;100",
+                "| '/var'=85%;;;0;100 '/var_warning_threshold'=80%;;;0;100",
+            ),
+        )
+
+    def test_results_without_perfdata_are_unchanged(self):
+        processor = PerfdataProcessor(warning="80")
+        for text in ("host_name=web1\nreturn_code=2\noutput=CRITICAL - down\n", "junk"):
+            self.assertEqual(rewrite_check_result(text, processor), text)
+
+    def test_spool_once_processes_every_file(self):
+        for i in range(3):
+            self.write_spool_file(f"c{i}", self.CHECK_RESULT)
+        self.write_spool_file(".c3", self.CHECK_RESULT, complete=False)
+        argv = ["--spool", self.spool, "--spool-output", self.output, "-w", "80", "--once"]
+        with patch.object(sys, "argv", ["script_name"] + argv + ["--workers", "2"]):
+            with self.assertRaises(SystemExit) as cm:
+                main()
+        self.assertEqual(cm.exception.code, 0)
+        self.assertEqual(
+            sorted(os.listdir(self.output)), ["c0", "c0.ok", "c1", "c1.ok", "c2", "c2.ok"]
+        )
+        self.assertEqual(os.listdir(self.spool), [".c3"])
+        with open(os.path.join(self.output, "c1"), encoding="utf-8") as f:
+            self.assertIn("'/var_warning_threshold'=80%;;;0;100", f.read())
+
+    def test_files_without_an_ok_marker_are_left_alone(self):
+        self.write_spool_file("c0", self.CHECK_RESULT)
+        self.write_spool_file("c1", self.CHECK_RESULT[:40], complete=False)
+        self.write_spool_file("c2.ok", "", complete=False)
+        self.assertEqual(spool_files(self.spool), ["c0"])
+
+        argv = ["--spool", self.spool, "--spool-output", self.output, "-w", "80", "--once"]
+        with patch.object(sys, "argv", ["script_name"] + argv + ["--workers", "1"]):
+            with self.assertRaises(SystemExit) as cm:
+                main()
+        self.assertEqual(cm.exception.code, 0)
+        self.assertEqual(sorted(os.listdir(self.output)), ["c0", "c0.ok"])
+        self.assertEqual(sorted(os.listdir(self.spool)), ["c1", "c2.ok"])
+
+    @patch("sys.stderr", new_callable=StringIO)
+    def test_spool_requires_an_output_directory(self, mock_stderr):
+        with patch.object(sys, "argv", ["script_name", "--spool", self.spool, "-w", "80"]):
+            with self.assertRaises(SystemExit) as cm:
+                main()
+        self.assertEqual(cm.exception.code, 3)
+        self.assertIn("--spool-output must be provided", mock_stderr.getvalue())
+
+    def assertWatcherReportsNewFiles(self):
+        self.write_spool_file("old", "")
+        watcher = SpoolWatcher(self.spool, poll_interval=0.01)
+        self.addCleanup(watcher.close)
+        self.assertEqual(watcher.files(), ["old"])
+        for name in ("old", "old.ok"):
+            os.unlink(os.path.join(self.spool, name))
+        self.write_spool_file("new", "", complete=False)
+        self.assertEqual(watcher.files(0.05), [])
+        self.write_spool_file("new.ok", "", complete=False)
+        self.assertEqual(watcher.files(1), ["new"])
+        return watcher
+
+    def test_watcher_reports_new_files(self):
+        self.assertIsNotNone(self.assertWatcherReportsNewFiles().fd)
+
+    @patch("check_with_thresholds_as_perfdata_lib.inotify_watch", return_value=None)
+    def test_watcher_falls_back_to_polling(self, _mock_inotify_watch):
+        self.assertIsNone(self.assertWatcherReportsNewFiles().fd)
+
+    def test_claims_of_dead_workers_are_recovered(self):
+        # No process can have a PID above the kernel's limit of 2 ** 22
+        for pid in (2**22 + 1, os.getpid()):
+            claim = os.path.join(self.spool, f".claimed.{pid}")
+            os.mkdir(claim)
+            self.write_spool_file(os.path.join(claim, f"c{pid}"), self.CHECK_RESULT)
+        recover_spool_claims(self.spool)
+        self.assertEqual(
+            sorted(os.listdir(self.spool)),
+            [f".claimed.{os.getpid()}", f"c{2**22 + 1}", f"c{2**22 + 1}.ok"],
+        )
+
+
+class TestWatchMode(unittest.TestCase):
+
+    COMMAND = "/opt/opsview/monitoringscripts/plugins/check_disk -p /var"
+
+    def run_watch(self, argv, duration=0):
+        calls = []
+
+        async def fake_run_command_async(command, **_options):
+            calls.append(command)
+            await asyncio.sleep(duration)
+            return OK_OUTPUT, "", 0
+
+        with patch(
+            "check_with_thresholds_as_perfdata_lib.run_command_async", new=fake_run_command_async
+        ), patch("sys.stdout", new_callable=StringIO) as mock_stdout, patch.object(
+            sys, "argv", ["script_name", "-w", "80", "-C", self.COMMAND] + argv
+        ):
+            with self.assertRaises(SystemExit) as cm:
+                main()
+        self.assertEqual(cm.exception.code, 0)
+        self.assertEqual(set(calls), {self.COMMAND})
+        return [json.loads(line) for line in mock_stdout.getvalue().splitlines()]
+
+    def test_watch_writes_one_result_per_tick(self):
+        frames = self.run_watch(["--watch", "0.02", "--watch-count", "3"])
+        self.assertEqual([frame["tick"] for frame in frames], [0, 1, 2])
+        for frame in frames:
+            self.assertEqual(frame["skipped"], 0)
+            self.assertEqual(frame["returncode"], 0)
+            self.assertIn("'/var_warning_threshold'=80%;;;0;100", frame["stdout"])
+            self.assertGreaterEqual(frame["lag"], 0)
+
+    def test_watch_appends_self_metrics(self):
+        frames = self.run_watch(["--watch", "0.02", "--watch-count", "1", "--self-metrics"])
+        self.assertIn(" wrapper_execute_command=", frames[0]["stdout"])
+        self.assertIn(" wrapper_total=", frames[0]["stdout"])
+
+    def test_overlapping_runs_are_skipped(self):
+        frames = self.run_watch(["--watch", "0.02", "--watch-count", "2"], duration=0.07)
+        self.assertEqual(len(frames), 2)
+        self.assertGreaterEqual(frames[1]["tick"], 3)
+        self.assertEqual(frames[1]["skipped"], frames[1]["tick"] - 1)
+
+    def test_watch_writes_to_a_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "results")
+            self.assertEqual(
+                self.run_watch(["--watch", "1", "--watch-count", "1", "--watch-output", path]), []
+            )
+            with open(path, encoding="utf-8") as f:
+                self.assertEqual(json.loads(f.read())["tick"], 0)
+
+    @patch("sys.stderr", new_callable=StringIO)
+    def test_watch_needs_a_command(self, mock_stderr):
+        with patch.object(sys, "argv", ["script_name", "--manifest", "m.jsonl", "--watch", "5"]):
+            with self.assertRaises(SystemExit) as cm:
+                main()
+        self.assertEqual(cm.exception.code, 3)
+        self.assertIn("--watch only works with --command", mock_stderr.getvalue())
+
+
+class FakeNrpeServer:
+    """A stand-in NRPE daemon answering every query with the same v2 response packet."""
+
+    def __init__(self, result_code=0, output="OK", use_ssl=False, hang=False):
+        import ssl
+
+        self.response = nrpe_packet(2, result_code, output)
+        self.hang = hang
+        self.queries, self.resumed = [], []
+        self.context = None
+        if use_ssl:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.context.maximum_version = ssl.TLSVersion.TLSv1_2
+            self.context.set_ciphers("aNULL:@SECLEVEL=0")
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            try:
+                if self.context is not None:
+                    sock = self.context.wrap_socket(sock, server_side=True)
+                    self.resumed.append(sock.session_reused)
+                query = b""
+                while len(query) < 1036:
+                    query += sock.recv(1036 - len(query))
+                self.queries.append(query[10:1034].split(b"\0", 1)[0].decode())
+                if self.hang:
+                    time.sleep(2)
+                else:
+                    sock.sendall(self.response)
+            finally:
+                sock.close()
+
+    def close(self):
+        # Closing alone does not wake a thread blocked in accept(), which would keep
+        # the port listening
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+
+
+class TestBuiltinNrpe(unittest.TestCase):
+
+    PLUGIN = "/opt/opsview/monitoringscripts/plugins/check_nrpe"
+
+    def start_server(self, **options):
+        server = FakeNrpeServer(**options)
+        self.addCleanup(server.close)
+        return server
+
+    def test_parse_check_nrpe(self):
+        request = parse_check_nrpe(f"{self.PLUGIN} -H web1 -c check_disk -a -w 80 /var")
+        self.assertEqual(request, ("web1", 5666, "check_disk!-w!80!/var", 10, 2, True, False))
+        request = parse_check_nrpe(f"{self.PLUGIN} -Hweb1 --port=5667 -t 30:3 -n -2 -c load")
+        self.assertEqual(request, ("web1", 5667, "load", 30, 3, False, True))
+        request = parse_check_nrpe(f"{self.PLUGIN} -H h -c check_snmp -a public#1 -w 80")
+        self.assertEqual(request.query, "check_snmp!public#1!-w!80")
+        for command in (
+            f"{self.PLUGIN} -H web1 -C /etc/nrpe.crt -c check_disk",
+            f"{self.PLUGIN} -c check_disk",
+            f"{self.PLUGIN} -H web1 -t soon",
+            f"{self.PLUGIN} -H $HOST -c check_disk",
+            f"{self.PLUGIN} -H web1 -c check_disk # -a -w 80",
+            "/opt/opsview/monitoringscripts/plugins/check_disk -H web1",
+        ):
+            self.assertIsNone(parse_check_nrpe(command), command)
+
+    @patch("subprocess.run")
+    def test_main_queries_the_daemon_without_running_check_nrpe(self, mock_run):
+        server = self.start_server(output="DISK OK | '/var'=55%;;;0;100")
+        command = f"{self.PLUGIN} -H 127.0.0.1 -p {server.port} -n -c check_disk -a /var"
+        with patch.object(
+            sys, "argv", ["script_name", "--builtin-nrpe", "-w", "80", "-C", command]
+        ), patch("sys.stdout", new_callable=StringIO) as mock_stdout:
+            with self.assertRaises(SystemExit) as cm:
+                main()
+        self.assertEqual(cm.exception.code, 0)
+        mock_run.assert_not_called()
+        self.assertEqual(server.queries, ["check_disk!/var"])
+        self.assertEqual(
+            mock_stdout.getvalue(),
+            "DISK OK | '/var'=55%;;;0;100 '/var_warning_threshold'=80%;;;0;100\n",
+        )
+
+    def test_tls_sessions_are_resumed(self):
+        server = self.start_server(result_code=1, output="WARNING - load", use_ssl=True)
+        client = NrpeClient()
+        for _ in range(2):
+            result = client.query(parse_check_nrpe(f"{self.PLUGIN} -H 127.0.0.1 -p {server.port}"))
+            self.assertEqual(
+                (result.stdout, result.stderr, result.returncode), ("WARNING - load\n", "", 1)
+            )
+        self.assertEqual(server.resumed, [False, True])
+        self.assertEqual(server.queries, ["_NRPE_CHECK"] * 2)
+
+    def test_check_nrpe_is_run_for_results_it_would_report_differently(self):
+        closed = FakeNrpeServer()
+        closed.close()
+        full = self.start_server(output="x" * 2000)
+        for command in (
+            f"{self.PLUGIN} -H 127.0.0.1 -p {closed.port} -n",
+            f"{self.PLUGIN} -H 127.0.0.1 -p {full.port} -n",
+        ):
+            self.assertIsNone(run_builtin_nrpe(command), command)
+        result = run_builtin_nrpe(f"{self.PLUGIN} -H 127.0.0.1 -p {full.port} -n -2")
+        self.assertEqual(result.stdout, "x" * 1023 + "\n")
+        self.assertIsNone(run_builtin_nrpe(f"{self.PLUGIN} -H 127.0.0.1 -p {full.port} -n", 5))
+
+    def test_timeout_is_reported_like_check_nrpe(self):
+        server = self.start_server(hang=True)
+        result = run_builtin_nrpe(f"{self.PLUGIN} -H 127.0.0.1 -p {server.port} -n -t 1 -u")
+        self.assertEqual(
+            (result.stdout, result.returncode),
+            ("CHECK_NRPE STATE UNKNOWN: Socket timeout after 1 seconds.\n", 3),
+        )
+
+
+class TestBaseline(unittest.TestCase):
+
+    COMMAND = "/opt/opsview/monitoringscripts/plugins/check_disk -p /var"
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def test_rolling_mean_and_deviation_of_the_window(self):
+        path = os.path.join(self.tmpdir.name, "check.baseline")
+        values = [(i * 37 % 101) / 7 for i in range(50)]
+        baseline = BaselineFile(path, window=4)
+        try:
+            for i, value in enumerate(values):
+                recent = values[max(i - 4, 0) : i]
+                expected = None
+                if len(recent) >= 2:
+                    expected = (statistics.fmean(recent), statistics.pstdev(recent))
+                result = baseline.add("/var", value)
+                if expected is None:
+                    self.assertIsNone(result)
+                else:
+                    self.assertAlmostEqual(result[0], expected[0])
+                    self.assertAlmostEqual(result[1], expected[1])
+        finally:
+            baseline.close()
+        with self.assertRaises(ValueError):
+            BaselineFile(path, window=5)
+
+    @patch("subprocess.run")
+    def test_baseline_entries_are_appended_once_there_is_history(self, mock_run):
+        outputs = []
+        for value in (50, 60, 70):
+            mock_run.return_value = MagicMock(
+                stdout=f"OK | '/var'={value}%;;;0;100", stderr="", returncode=0
+            )
+            argv = ["--baseline", self.tmpdir.name, "-C", self.COMMAND]
+            with patch.object(sys, "argv", ["script_name"] + argv), patch(
+                "sys.stdout", new_callable=StringIO
+            ) as mock_stdout:
+                with self.assertRaises(SystemExit) as cm:
+                    main()
+            self.assertEqual(cm.exception.code, 0)
+            outputs.append(mock_stdout.getvalue())
+
+        self.assertEqual(outputs[:2], ["OK | '/var'=50%;;;0;100\n", "OK | '/var'=60%;;;0;100\n"])
+        self.assertEqual(
+            outputs[2],
+            "OK | '/var'=70%;;;0;100 '/var_baseline'=55%;;;0;100 '/var_upper_band'=70%;;;0;100\n",
+        )
+        (name,) = os.listdir(self.tmpdir.name)
+        self.assertTrue(name.endswith("-60.baseline"))
+        self.assertEqual(
+            baseline_path(self.tmpdir.name, self.COMMAND, 60, ("80",)),
+            baseline_path(self.tmpdir.name, f'"{self.COMMAND}"', 60, ("80",)),
+        )
+        self.assertNotEqual(
+            baseline_path(self.tmpdir.name, self.COMMAND, 60, ("80",)),
+            baseline_path(self.tmpdir.name, self.COMMAND, 60, ("90",)),
+        )
+
+    @patch("subprocess.run")
+    def test_services_sharing_a_command_keep_separate_baselines(self, mock_run):
+        outputs = []
+        for value in (50, 60, 70):
+            for service in ("Disk", "Disk usage"):
+                mock_run.return_value = MagicMock(
+                    stdout=f"OK | '/var'={value}%;;;0;100", stderr="", returncode=0
+                )
+                argv = ["--baseline", self.tmpdir.name, "--service", service, "-C", self.COMMAND]
+                with patch.object(sys, "argv", ["script_name"] + argv), patch(
+                    "sys.stdout", new_callable=StringIO
+                ) as mock_stdout:
+                    with self.assertRaises(SystemExit):
+                        main()
+                outputs.append(mock_stdout.getvalue())
+
+        baseline = (
+            "OK | '/var'=70%;;;0;100 '/var_baseline'=55%;;;0;100 '/var_upper_band'=70%;;;0;100\n"
+        )
+        self.assertEqual(outputs[4:], [baseline, baseline])
+        self.assertEqual(len(os.listdir(self.tmpdir.name)), 2)
+
+    @patch("subprocess.run")
+    def test_baseline_is_kept_when_other_settings_change(self, mock_run):
+        mock_run.return_value = MagicMock(stdout="OK | '/var'=50%;;;0;100", stderr="", returncode=0)
+        for extra in (
+            [],
+            ["-w", "80"],
+            ["-w", "90", "--self-metrics"],
+            ["--output-format", "json"],
+        ):
+            argv = ["--baseline", self.tmpdir.name, "-C", self.COMMAND] + extra
+            with patch.object(sys, "argv", ["script_name"] + argv), patch(
+                "sys.stdout", new_callable=StringIO
+            ) as mock_stdout:
+                with self.assertRaises(SystemExit):
+                    main()
+        self.assertEqual(len(os.listdir(self.tmpdir.name)), 1)
+        self.assertIn("_baseline", mock_stdout.getvalue())
+
+    def test_unusable_baseline_file_leaves_the_check_alone(self):
+        path = os.path.join(self.tmpdir.name, "check.baseline")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("not a baseline")
+        processor = PerfdataProcessor(warning="80", baseline_file=path)
+        self.assertEqual(
+            processor.process("OK | a=1", "", 0), ("OK | 'a_warning_threshold'=80 a=1\n", "", 0)
+        )
+
+
+class TestThresholdConfig(unittest.TestCase):
+
+    CONFIG = [
+        "# Thresholds of every check",
+        {"warning": "80", "critical": "90"},
+        {"host": "web1", "service": "Disk", "threshold_map": ["/var*=warning=70", "*=critical=95"]},
+        {"host": "web1", "warning": "60", "static": "max=100"},
+        {"service": "Load", "warning": "4"},
+    ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.config = os.path.join(self.tmpdir.name, "thresholds.jsonl")
+        self.index = os.path.join(self.tmpdir.name, "thresholds.index")
+        self.write_config(self.CONFIG)
+
+    def write_config(self, lines):
+        with open(self.config, "w", encoding="utf-8") as f:
+            for line in lines:
+                f.write((line if isinstance(line, str) else json.dumps(line)) + "\n")
+
+    def test_lookup_falls_back_to_any_host_or_service(self):
+        compile_threshold_config(self.config, self.index)
+        index = ThresholdIndex(self.index)
+        try:
+            self.assertEqual(
+                index.lookup("web1", "Disk"),
+                {"threshold_map": ["/var*=warning=70", "*=critical=95"]},
+            )
+            self.assertEqual(index.lookup("web1", "Load"), {"warning": "60", "static": ["max=100"]})
+            self.assertEqual(index.lookup("web2", "Load"), {"warning": "4"})
+            self.assertEqual(index.lookup("web2", "Disk"), {"warning": "80", "critical": "90"})
+            self.assertEqual(index.lookup(None, None), {"warning": "80", "critical": "90"})
+        finally:
+            index.close()
+
+    def test_lookup_of_many_entries(self):
+        self.write_config(
+            [{"host": f"host{i}", "service": "Disk", "warning": str(i)} for i in range(1000)]
+        )
+        compile_threshold_config(self.config, self.index)
+        index = ThresholdIndex(self.index)
+        try:
+            for i in (0, 1, 499, 998, 999):
+                self.assertEqual(index.lookup(f"host{i}", "Disk"), {"warning": str(i)})
+            self.assertEqual(index.lookup("host1000", "Disk"), {})
+        finally:
+            index.close()
+
+    def test_index_is_compiled_again_when_the_config_changes(self):
+        self.assertEqual(
+            config_thresholds(self.config, "web2", "Load", self.index), {"warning": "4"}
+        )
+        self.write_config(self.CONFIG + [{"service": "Load", "warning": "8"}])
+        self.assertEqual(
+            config_thresholds(self.config, "web2", "Load", self.index), {"warning": "8"}
+        )
+
+    def test_numeric_thresholds(self):
+        self.write_config([{"warning": 80, "critical": 90.5, "static": "max=100"}])
+        self.assertEqual(
+            config_thresholds(self.config, "web1", "Disk", self.index),
+            {"warning": "80", "critical": "90.5", "static": ["max=100"]},
+        )
+
+    def test_invalid_config(self):
+        for line in (
+            '{"warning": "80", "threshold_map": "*=warning=70"}',
+            '{"host": "web3"}',
+            '{"host": "web3", "warning": ["80"]}',
+            '{"host": 3, "warning": "80"}',
+            '{"static": [100]}',
+            "[]",
+            "{",
+        ):
+            self.write_config(self.CONFIG + [line])
+            with self.assertRaises(ValueError) as cm:
+                config_thresholds(self.config, "web1", "Disk", self.index)
+            self.assertIn("Invalid line 6", str(cm.exception))
+        with open(self.index, "wb") as f:
+            f.write(b"not an index")
+        with self.assertRaises(ValueError):
+            ThresholdIndex(self.index)
+
+    def run_with_config(self, argv, stdout):
+        return run_main(argv, stdout, env={"XDG_RUNTIME_DIR": self.tmpdir.name})
+
+    def test_main_uses_the_thresholds_of_the_host_and_service(self):
+        argv = ["--threshold-config", self.config, "--host", "web1", "--service", "Disk"]
+        stdout = "OK | '/var'=55%;;;0;100 '/tmp'=5%;;;0;100"
+        self.assertEqual(
+            self.run_with_config(argv + ["-C", "/opt/opsview/monitoringscripts/x"], stdout),
+            (
+                0,
+                "OK | '/tmp'=5%;;;0;100 '/tmp_critical_threshold'=95%;;;0;100 '/var'=55%;;;0;100"
+                " '/var_warning_threshold'=70%;;;0;100\n",
+                "",
+            ),
+        )
+        # Thresholds given on the command line are used instead of the config
+        self.assertEqual(
+            self.run_with_config(
+                argv + ["-w", "50", "-C", "/opt/opsview/monitoringscripts/x"], "OK | load=1;;;0;10"
+            ),
+            (0, "OK | 'load_warning_threshold'=50;;;0;10 load=1;;;0;10\n", ""),
+        )
+        with patch.dict(os.environ, {"XDG_RUNTIME_DIR": self.tmpdir.name}):
+            index = default_threshold_index_path(self.config)
+        self.assertEqual(
+            sorted(os.listdir(os.path.dirname(index))),
+            sorted(os.path.basename(path) for path in (index, f"{index}.lock")),
+        )
+
+    def test_main_exits_unknown_for_an_invalid_config(self):
+        self.write_config(['{"host": "web1"}'])
+        code, stdout, stderr = self.run_with_config(
+            ["--threshold-config", self.config, "-C", "/opt/opsview/monitoringscripts/x"], "OK"
+        )
+        self.assertEqual((code, stdout), (3, ""))
+        self.assertIn("Error: Invalid line 1", stderr)
+
+
+class TestSuppressUnchanged(unittest.TestCase):
+
+    COMMAND = "/opt/opsview/monitoringscripts/plugins/check_disk -p /var"
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, "check.suppression")
+
+    def entries(self, warning="80", uom="%", maximum="100"):
+        return [
+            dict(label=label, value=value, uom=uom, warn=None, crit=None, min="0", max=maximum)
+            for label, value in (("/var_warning_threshold", warning), ("/var_max", "100"))
+        ]
+
+    def test_entries_are_emitted_when_they_change_or_on_the_heartbeat(self):
+        def changed(entries, now):
+            return [e["label"] for e in changed_derived_entries(entries, self.path, 60, now)]
+
+        both = ["/var_warning_threshold", "/var_max"]
+        self.assertEqual(changed(self.entries(), 1000), both)
+        self.assertEqual(changed(self.entries(), 1030), [])
+        self.assertEqual(changed(self.entries(warning="85"), 1040), ["/var_warning_threshold"])
+        self.assertEqual(changed(self.entries(warning="85", uom="B"), 1045), both)
+        self.assertEqual(changed(self.entries(warning="85", uom="B", maximum="50"), 1050), both)
+        self.assertEqual(changed(self.entries(warning="85", uom="B", maximum="50"), 1109), [])
+        self.assertEqual(changed(self.entries(warning="85", uom="B", maximum="50"), 1110), both)
+        # A clock set back does not suppress the entries until it catches up
+        self.assertEqual(changed(self.entries(warning="85", uom="B", maximum="50"), 500), both)
+
+    def test_every_entry_is_emitted_if_the_file_can_not_be_written(self):
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write("not a directory")
+        path = os.path.join(self.path, "check.suppression")
+        for _ in range(2):
+            self.assertEqual(changed_derived_entries(self.entries(), path, 60), self.entries())
+
+    def run_check(self, argv, stdout):
+        code, output, _ = run_main(argv + ["-C", self.COMMAND], stdout)
+        self.assertEqual(code, 0)
+        return output
+
+    def test_unchanged_thresholds_are_left_out_of_the_output(self):
+        argv = ["--suppress-unchanged", self.tmpdir.name, "-w", "80", "-c", "90"]
+        outputs = [
+            self.run_check(argv, f"OK | '/var'={value}%;;;0;{maximum}")
+            for value, maximum in ((50, 100), (60, 100), (70, 200))
+        ]
+        self.assertEqual(
+            outputs,
+            [
+                "OK | '/var'=50%;;;0;100 '/var_critical_threshold'=90%;;;0;100"
+                " '/var_warning_threshold'=80%;;;0;100\n",
+                "OK | '/var'=60%;;;0;100\n",
+                "OK | '/var'=70%;;;0;200 '/var_critical_threshold'=90%;;;0;200"
+                " '/var_warning_threshold'=80%;;;0;200\n",
+            ],
+        )
+        self.assertEqual(len(os.listdir(self.tmpdir.name)), 1)
+
+    def test_services_sharing_a_command_keep_separate_state(self):
+        services = {
+            "a": ["-w", "80"],
+            "b": ["-w", "80", "-c", "90"],
+            "c": ["-w", "80", "--host", "web1", "--service", "Disk"],
+        }
+        outputs = {name: [] for name in services}
+        for _ in range(2):
+            for name, thresholds in services.items():
+                argv = ["--suppress-unchanged", self.tmpdir.name] + thresholds
+                outputs[name].append(self.run_check(argv, "OK | a=1;;;0;10"))
+
+        self.assertEqual(
+            outputs,
+            {
+                "a": ["OK | 'a_warning_threshold'=80;;;0;10 a=1;;;0;10\n", "OK | a=1;;;0;10\n"],
+                "b": [
+                    "OK | 'a_critical_threshold'=90;;;0;10 'a_warning_threshold'=80;;;0;10"
+                    " a=1;;;0;10\n",
+                    "OK | a=1;;;0;10\n",
+                ],
+                "c": ["OK | 'a_warning_threshold'=80;;;0;10 a=1;;;0;10\n", "OK | a=1;;;0;10\n"],
+            },
+        )
+        self.assertEqual(
+            suppression_path(self.tmpdir.name, self.COMMAND),
+            suppression_path(self.tmpdir.name, f'"{self.COMMAND}"'),
+        )
+
+    def test_structured_output(self):
+        processor = PerfdataProcessor(
+            warning="80", suppression_file=self.path, output_format="json"
+        )
+        labels = []
+        for _ in range(2):
+            result = processor.process("OK | '/var'=50%;;;0;100", "", 0)
+            labels.append([e["label"] for e in json.loads(result.stdout)["perfdata"]])
+        self.assertEqual(labels, [["/var", "/var_warning_threshold"], ["/var"]])
+
+    def test_negative_heartbeat_is_rejected(self):
+        with self.assertRaises(ValueError):
+            PerfdataProcessor(warning="80", suppression_file=self.path, heartbeat=-1)
+
+
 if __name__ == "__main__":
     unittest.main()  # pragma: no cover